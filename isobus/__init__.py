@@ -2,4 +2,7 @@
 
 # isobus imports:
 from isobus.vt.client import VTClient
+from isobus.vt.asyncclient import AsyncVTClient
+from isobus.vt.pool import VTObjectPool
+from isobus.vt.server import VTServer
 from isobus.common import IBSException
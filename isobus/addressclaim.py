@@ -0,0 +1,213 @@
+import random
+import threading
+from concurrent.futures import Future
+
+from isobus.common import IBSException
+from isobus.common import NumericValue
+from isobus.common import IBSRxHandler
+from isobus.constants import *
+from isobus.log import log
+
+# Address claim states (ISO 11783-5)
+CLAIM_IDLE        = 'idle'
+CLAIM_REQUESTING  = 'requesting'
+CLAIM_CLAIMING    = 'claiming'
+CLAIM_CLAIMED     = 'claimed'
+CLAIM_FAILED      = 'cannot claim'
+
+# Addresses a self-configurable CF picks from
+DYNAMIC_ADDRESSES = range(128, 248)
+
+CLAIM_TIMEOUT = 0.250
+
+def _NameFromData(data):
+    return NumericValue.FromLEBytes(data[0:8]).Value()
+
+def IsSelfConfigurable(ibsName):
+    return bool(ibsName >> 63)
+
+def _RTxD():
+    """ Pseudo random delay before a cannot claim, 0 - 153 ms """
+    return random.randint(0, 255) * 0.6 / 1000.0
+
+
+class IBSNameTable(IBSRxHandler):
+    """ The NAME of every address claimed on the network, kept up to date
+    from the address claims on the bus so lookups never wait for the bus
+    """
+
+    def __init__(self):
+        IBSRxHandler.__init__(self, [PGN_ADDRCLAIM])
+        self._lock = threading.Lock()
+        self._names = dict() # sa -> NAME
+        self._addresses = dict() # NAME -> sa
+
+    def RxMessage(self, ibsid, data):
+        if len(data) >= 8:
+            self.Claimed(ibsid.sa, _NameFromData(data))
+
+    def Claimed(self, sa, ibsName):
+        """ Record a claim of sa by ibsName, SA_NULL for a cannot claim """
+        with self._lock:
+            previous = self._addresses.pop(ibsName, None)
+            if previous is not None and self._names.get(previous) == ibsName:
+                del self._names[previous]
+            if sa != SA_NULL:
+                loser = self._names.get(sa)
+                if loser is not None and loser != ibsName:
+                    self._addresses.pop(loser, None)
+                self._names[sa] = ibsName
+                self._addresses[ibsName] = sa
+
+    def Name(self, sa):
+        """ NAME of the CF at sa, None if unknown """
+        with self._lock:
+            return self._names.get(sa)
+
+    def Address(self, ibsName):
+        """ Address of the CF with ibsName, None if unknown """
+        with self._lock:
+            return self._addresses.get(ibsName)
+
+    def Items(self):
+        """ List of (sa, NAME), ordered by address """
+        with self._lock:
+            return sorted(self._names.items())
+
+    def __len__(self):
+        return len(self._names)
+
+
+class IBSAddressClaimer(IBSRxHandler):
+    """ Claims and defends an address for one NAME as a state machine driven
+    by received claims and scheduler timers, so nothing blocks while claiming.
+    A competing claim of our address is won by the lowest NAME. Losing it, a
+    self-configurable NAME claims a free address in DYNAMIC_ADDRESSES, any
+    other NAME sends a cannot claim. Start returns a future resolved with the
+    claimed address, or failed with an IBSException. changed is called with
+    every address claimed, also when it changes after losing a contention
+    """
+
+    def __init__(self, interface, ibsName, changed=None):
+        IBSRxHandler.__init__(self, [PGN_ADDRCLAIM, PGN_REQUEST])
+        self.interface = interface
+        self.ibsName = ibsName
+        self.changed = changed
+        self.address = SA_NULL
+        self.state = CLAIM_IDLE
+        self.future = None
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def Start(self, sa):
+        with self._lock:
+            if self.future is None or self.future.done():
+                self.future = Future()
+            future = self.future
+            if self.state == CLAIM_IDLE:
+                self.interface.AddRxHandler(self)
+            self._Cancel()
+            self.address = sa
+            self.state = CLAIM_REQUESTING
+        # Learn who is on the network before claiming
+        self.interface.SendRequestAddressClaim(SA_NULL)
+        self._Later(CLAIM_TIMEOUT + _RTxD(), self._Claim, sa)
+        return future
+
+    def Stop(self):
+        with self._lock:
+            self._Cancel()
+            if self.state != CLAIM_IDLE:
+                self.interface.RemoveRxHandler(self)
+            self.interface._DropLocalAddress(self.address)
+            self.state = CLAIM_IDLE
+
+    def RxMessage(self, ibsid, data):
+        if ibsid.pgn == PGN_REQUEST:
+            if (len(data) >= 3 and (data[0] | (data[1] << 8) | (data[2] << 16)) == PGN_ADDRCLAIM
+                    and (ibsid.da == SA_GLOBAL or ibsid.da == self.address)):
+                self._AnswerRequest()
+        elif len(data) >= 8 and ibsid.sa == self.address:
+            self._Contention(_NameFromData(data))
+
+    def _AnswerRequest(self):
+        with self._lock:
+            if self.state == CLAIM_CLAIMED:
+                self.interface.SendAddressClaim(self.ibsName, self.address)
+            elif self.state == CLAIM_FAILED:
+                self._Later(_RTxD(), self.interface.SendAddressClaim, self.ibsName, SA_NULL)
+
+    def _Contention(self, otherName):
+        with self._lock:
+            if otherName == self.ibsName or self.state in (CLAIM_IDLE, CLAIM_FAILED,
+                                                           CLAIM_REQUESTING):
+                # Our own claim, or not claiming yet (_Claim checks the table)
+                return
+            if self.ibsName < otherName:
+                log.debug('(AC) Defending 0x{0:02X} against NAME {1:016X}'.format(
+                    self.address, otherName))
+                self.interface.SendAddressClaim(self.ibsName, self.address)
+                return
+            log.debug('(AC) Lost 0x{0:02X} to NAME {1:016X}'.format(self.address, otherName))
+            self.interface._DropLocalAddress(self.address)
+            self.interface.names.Claimed(self.address, otherName)
+            self._Cancel()
+            self._Claim(self._NextAddress())
+
+    def _Claim(self, sa):
+        with self._lock:
+            if self.state == CLAIM_IDLE:
+                return
+            owner = self.interface.names.Name(sa) if sa is not None else None
+            if owner is not None and owner != self.ibsName and owner < self.ibsName:
+                # Taken by a CF which would win the claim
+                sa = self._NextAddress(sa)
+            if sa is None:
+                log.warning('(AC) No address available for NAME {0:016X}'.format(self.ibsName))
+                self.state = CLAIM_FAILED
+                self.address = SA_NULL
+                self._Later(_RTxD(), self.interface.SendAddressClaim, self.ibsName, SA_NULL)
+                self._Resolve(exception=IBSException('Could not claim an address'))
+                return
+            self.address = sa
+            self.state = CLAIM_CLAIMING
+            self.interface.SendAddressClaim(self.ibsName, sa)
+            self._Later(CLAIM_TIMEOUT, self._Claimed)
+
+    def _Claimed(self):
+        with self._lock:
+            if self.state != CLAIM_CLAIMING:
+                return
+            self.state = CLAIM_CLAIMED
+            log.debug('(AC) Claimed 0x{0:02X}'.format(self.address))
+            self._Resolve(result=self.address)
+            if self.changed is not None:
+                self.changed(self.address)
+
+    def _NextAddress(self, exclude=None):
+        """ A free address to try next, None if this NAME can not pick one """
+        if not IsSelfConfigurable(self.ibsName):
+            return None
+        for sa in DYNAMIC_ADDRESSES:
+            if (sa != exclude and sa != self.address and self.interface.names.Name(sa) is None
+                    and sa not in self.interface.localAddresses):
+                return sa
+        return None
+
+    def _Resolve(self, result=None, exception=None):
+        future = self.future
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def _Later(self, delay, callback, *args):
+        with self._lock:
+            self._timer = self.interface.scheduler.CallLater(delay, callback, *args)
+
+    def _Cancel(self):
+        if self._timer is not None:
+            self._timer.Cancel()
+            self._timer = None
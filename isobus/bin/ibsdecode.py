@@ -0,0 +1,48 @@
+#! /usr/bin/env python3
+
+import argparse
+import sys
+
+from isobus.common import IBSException
+from isobus.logdecoder import IBSLogDecoder
+from isobus.export import ExportLog
+
+
+def FormatRecord(record):
+    line = '{t:.6f} {prio} {pgn:04X} {sa:02X} -> {da:02X} [{n}]'.format(
+        t=record.timestamp, prio=record.prio, pgn=record.pgn, sa=record.sa,
+        da=record.da, n=len(record.data))
+    if record.function is not None:
+        fields = ' '.join('{0}={1}'.format(name, value)
+                          for name, value in sorted(record.fields.items()))
+        return '{0} {1} {2}'.format(line, record.function, fields)
+    return '{0} {1}'.format(line, ' '.join('{0:02X}'.format(b) for b in record.data[:16]))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Decode ISOBUS traffic in a CAN log')
+    parser.add_argument('logfile', help='Log in a format python-can reads (.log, .asc, .blf)')
+    parser.add_argument('-p', '--pgn', type=lambda x: int(x, 16)
+                        , help='Only show this PGN (hex)')
+    parser.add_argument('-t', '--transport', action='store_true'
+                        , help='Also show TP/ETP frames, not only reassembled messages')
+    parser.add_argument('-o', '--export'
+                        , help='Write the decoded messages to a .parquet, .arrow or .npz file')
+    args = parser.parse_args()
+
+    try:
+        if args.export is not None:
+            rows = ExportLog(args.logfile, args.export, transport = args.transport)
+            print('Exported {0} messages to {1}'.format(rows, args.export))
+            return
+        decoder = IBSLogDecoder(transport = args.transport)
+        for record in decoder.DecodeFile(args.logfile):
+            if args.pgn is None or record.pgn == args.pgn:
+                print(FormatRecord(record))
+    except IBSException as e:
+        print('Error: {reason}'.format(reason=e.args[0]))
+        sys.exit(1)
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+
+if __name__ == "__main__":
+    main()
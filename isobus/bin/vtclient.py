@@ -86,11 +86,9 @@ class VTClientShell(cmd.Cmd) :
     def do_poolup(self, filename):
         'Upload a complete pool from file: poolup FILENAME.IOP'
         try:
-            with open(filename, "rb") as iopfile:
-                try:
-                    vtClient.UploadPoolData([byte for byte in iopfile.read()])
-                except isobus.IBSException as e:
-                    print('Error: {reason}'.format(reason=e.args[0]))
+            vtClient.UploadPoolFile(filename)
+        except isobus.IBSException as e:
+            print('Error: {reason}'.format(reason=e.args[0]))
         except FileNotFoundError:
             print('File not found')
         except IsADirectoryError:
@@ -99,11 +97,35 @@ class VTClientShell(cmd.Cmd) :
     def do_partpool(self, filename):
         'Upload part of a pool (does not send EoOP): poolpart FILENAME.IOP'
         try:
-            with open(filename, "rb") as iopfile:
-                try:
-                    vtClient.UploadPoolData([byte for byte in iopfile.read()], False)
-                except isobus.IBSException as e:
-                    print('Error: {reason}'.format(reason=e.args[0]))
+            vtClient.UploadPoolFile(filename, False)
+        except isobus.IBSException as e:
+            print('Error: {reason}'.format(reason=e.args[0]))
+        except FileNotFoundError:
+            print('File not found')
+
+    def do_checkpool(self, filename):
+        'Check object IDs of commands against a pool file: checkpool FILENAME.IOP'
+        try:
+            pool = isobus.VTObjectPool.FromFile(filename)
+            vtClient.SetObjectPool(pool)
+            print('{0} objects in pool'.format(len(pool)))
+        except isobus.IBSException as e:
+            print('Error: {reason}'.format(reason=e.args[0]))
+        except FileNotFoundError:
+            print('File not found')
+
+    def do_deltapool(self, args):
+        'Upload the objects changed between two pools (no EoOP): deltapool OLD.IOP NEW.IOP'
+        try:
+            oldfile, newfile = args.split()
+            removed = vtClient.UploadPoolDelta(isobus.VTObjectPool.FromFile(oldfile),
+                                               isobus.VTObjectPool.FromFile(newfile))
+            if removed:
+                print('{0} objects only in {1} are left on the VT'.format(len(removed), oldfile))
+        except ValueError:
+            print('Usage: deltapool OLD.IOP NEW.IOP')
+        except isobus.IBSException as e:
+            print('Error: {reason}'.format(reason=e.args[0]))
         except FileNotFoundError:
             print('File not found')
 
@@ -237,6 +259,12 @@ class VTClientShell(cmd.Cmd) :
     def complete_partpool(self, text, line, begidx, endidx):
         return self._tab_complete_filepath(text, line, begidx, endidx)
 
+    def complete_checkpool(self, text, line, begidx, endidx):
+        return self._tab_complete_filepath(text, line, begidx, endidx)
+
+    def complete_deltapool(self, text, line, begidx, endidx):
+        return self._tab_complete_filepath(text, line, begidx, endidx)
+
     def _tab_complete_filepath(self, text, line, begidx, endidx):
         before_arg = line.rfind(" ", 0, begidx)
         if before_arg == -1:
@@ -0,0 +1,38 @@
+#! /usr/bin/env python3
+
+import argparse
+import time
+
+import isobus
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Simulated VT for testing VT clients')
+    parser.add_argument('-i', '--interface'
+                        , default='socketcan_native'
+                        , help='Interface, default=socketcan_native, use virtual for an in-process bus')
+    parser.add_argument('-c', '--channel'
+                        , default='vcan0'
+                        , help='Channel/bus name, default=vcan0')
+    parser.add_argument('-a', '--address', type=lambda x: int(x, 0)
+                        , default=0x26
+                        , help='Source address of the VT, default=0x26')
+    parser.add_argument('-l', '--latency', type=float
+                        , default=0.0
+                        , help='Response latency in seconds, default=0')
+    args = parser.parse_args()
+
+    vt = isobus.VTServer(args.interface, args.channel, sa = args.address, latency = args.latency)
+    print('VT running on {0} with address 0x{1:02X}, Ctrl-C to stop'.format(
+        args.channel, args.address))
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        for name, n in sorted(vt.Statistics().items()):
+            print('{0:>24} {1}'.format(name, n))
+    finally:
+        vt.Shutdown()
+
+if __name__ == "__main__":
+    main()
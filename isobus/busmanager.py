@@ -0,0 +1,74 @@
+import threading
+
+from isobus.common import IBSException
+from isobus.log import log
+from isobus.vt.interface import IBSVTInterface
+
+
+class IBSBusManager():
+    """ Shares one connection per (interface, channel) between any number of
+    control functions, so they use one bus, one receive thread and one
+    decode per frame. Received messages are routed to each CF by the
+    interface's handler tables, which are keyed by address.
+    The shared connection is an IBSVTInterface, so it serves VT clients as
+    well as plain CFs. Messages between CFs on the same connection are not
+    looped back, except address claims
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = dict() # (interface, channel) -> [connection, users]
+
+    def Acquire(self, interface, channel, bitrate=250000):
+        """ Returns the shared connection for channel, opening it if needed.
+        Every Acquire needs a Release
+        """
+        key = (interface, channel)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is None:
+                entry = [IBSVTInterface(interface, channel, bitrate), 0]
+                self._connections[key] = entry
+            elif entry[0].flowControl.bitrate != bitrate:
+                raise IBSException('Channel {0} is already open at {1} bit/s'.format(
+                    channel, entry[0].flowControl.bitrate))
+            entry[1] += 1
+            return entry[0]
+
+    def Release(self, connection):
+        """ Drop a user of connection, shut it down when it was the last one """
+        with self._lock:
+            for key, entry in list(self._connections.items()):
+                if entry[0] is connection:
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        del self._connections[key]
+                        log.debug('Closing shared connection on {0}'.format(key[1]))
+                        connection.Shutdown()
+                    return
+        raise IBSException('Connection is not managed by this bus manager')
+
+    def Connect(self, interface, channel, shared=False, connectionClass=IBSVTInterface):
+        """ The connection of one CF: the shared connection of channel if
+        shared, else a new connectionClass(interface, channel) of its own.
+        Give it back with Disconnect and the same shared flag
+        """
+        if shared:
+            return self.Acquire(interface, channel)
+        return connectionClass(interface, channel)
+
+    def Disconnect(self, connection, shared=False):
+        """ Release a shared connection, shut down an own one """
+        if shared:
+            self.Release(connection)
+        else:
+            connection.Shutdown()
+
+    def Users(self, interface, channel):
+        with self._lock:
+            entry = self._connections.get((interface, channel))
+            return entry[1] if entry is not None else 0
+
+
+# The bus manager used by control functions created with shared=True
+busManager = IBSBusManager()
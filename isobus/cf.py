@@ -1,7 +1,9 @@
-import time
-import random
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 from isobus.ibsinterface import IBSInterface
+from isobus.busmanager import busManager
+from isobus.addressclaim import IBSAddressClaimer
+from isobus.common import IBSException
 from isobus.constants import *
 
 def BuildISOBUSName(**kwargs):
@@ -36,19 +38,53 @@ class IBSControlFunction():
     
     # Return True or False on commands based on success
 
-    def __init__(self, interface, channel) :
-        self.connection = IBSInterface(interface, channel)
+    # Opened when the CF does not share a connection
+    connectionClass = IBSInterface
+
+    def __init__(self, interface, channel, shared=False) :
+        # shared CFs use one connection per channel, see IBSBusManager
+        self.shared = shared
+        self.connection = busManager.Connect(interface, channel, shared, self.connectionClass)
         self.sa = 0xFE
         self.functionInstance = 0x00
+        self.claimer = None
+
+    def Close(self):
+        """ Release the address and the connection """
+        self.ReleaseAddress()
+        if self.connection is None:
+            return
+        busManager.Disconnect(self.connection, self.shared)
+        self.connection = None
+
+    def ClaimAddress(self, sa, ibsName, maxtime=3.0):
+        """ Claim sa (or another address if ibsName is self-configurable),
+        blocks until the claim succeeded. self.sa follows the claimed address
+        """
+        future = self.StartAddressClaim(sa, ibsName)
+        try:
+            self.sa = future.result(maxtime)
+        except FutureTimeoutError:
+            raise IBSException('Address claim timed out')
+
+    def StartAddressClaim(self, sa, ibsName):
+        """ Start claiming without blocking, returns a future for the address.
+        The claim is defended against other CFs until ReleaseAddress
+        """
+        if self.claimer is not None and self.claimer.ibsName != ibsName:
+            self.claimer.Stop()
+            self.claimer = None
+        if self.claimer is None:
+            self.claimer = IBSAddressClaimer(self.connection, ibsName, self._AddressChanged)
+        return self.claimer.Start(sa)
+
+    def ReleaseAddress(self):
+        if self.claimer is not None:
+            self.claimer.Stop()
+            self.claimer = None
 
-    def ClaimAddress(self, sa, ibsName):
-        # TODO: Check if SA is not already claimed
-        # TODO: Handle configurable address?
-        self.connection.SendRequestAddressClaim(sa)
-        waittime = 250 + (random.randint(0, 255) * 0.6)
-        time.sleep(waittime / 1000.0)
-        self.connection.SendAddressClaim(ibsName, sa)
-        time.sleep(0.250)
+    def _AddressChanged(self, sa):
+        self.sa = sa
 
     #TODO: Implement PART 12 here?
 
@@ -1,6 +1,101 @@
+import bisect
+import functools
+
 class IBSException(Exception):
     pass
 
+class IBSRxHandler():
+    """ Base class for receiving ISOBUS messages. RxMessage is called from the
+    receive thread for every message with a PGN in pgns, None for sa, da or
+    muxByte matches any value
+    """
+
+    def __init__(self, pgns, sa=None, da=None, muxByte=None):
+        self.pgnlist = pgns
+        self.sa = sa
+        self.da = da
+        self.muxByte = muxByte
+
+    def RxMessage(self, ibsid, data):
+        raise NotImplementedError('Rx handler not implemented!')
+
+class IBSMessageData():
+    """ Data of a multi-packet message, made of one or more buffers (bytes,
+    bytearray, memoryview, mmap or a list of ints) which are read in 7 byte
+    packets without ever being joined or copied as a whole
+    """
+
+    def __init__(self, *parts):
+        self._parts = list()
+        self._starts = list()
+        self._length = 0
+        for part in parts:
+            if isinstance(part, IBSMessageData):
+                views = part._parts
+            elif isinstance(part, list):
+                views = [memoryview(bytes(part))]
+            else:
+                views = [memoryview(part)]
+            for view in views:
+                if view.format != 'B' or view.ndim != 1:
+                    view = view.cast('B')
+                self._Append(view)
+
+    def __len__(self):
+        return self._length
+
+    def Parts(self):
+        """ The underlying buffers as a list of byte memoryviews """
+        return list(self._parts)
+
+    def Slice(self, start, end):
+        """ Returns bytes [start, end) as a new IBSMessageData on the same buffers """
+        result = IBSMessageData()
+        for part, partStart in zip(self._parts, self._starts):
+            lo = max(start, partStart)
+            hi = min(end, partStart + len(part))
+            if lo < hi:
+                result._Append(part[lo - partStart:hi - partStart])
+        return result
+
+    def _Append(self, view):
+        if len(view) > 0:
+            self._parts.append(view)
+            self._starts.append(self._length)
+            self._length += len(view)
+
+    def __bytes__(self):
+        return b''.join(self._parts)
+
+    def PacketFrame(self, seqN, packetIndex):
+        """ Returns an 8 byte data frame, seqN followed by the 7 bytes of
+        packet packetIndex (0 based), padded with 0xFF
+        """
+        frame = bytearray(_PADDED_FRAME)
+        frame[0] = seqN
+        start = packetIndex * 7
+        end = min(start + 7, self._length)
+        pos = 1
+        while start < end:
+            partIndex = bisect.bisect_right(self._starts, start) - 1
+            part = self._parts[partIndex]
+            offset = start - self._starts[partIndex]
+            n = min(end - start, len(part) - offset)
+            frame[pos:pos + n] = part[offset:offset + n]
+            pos += n
+            start += n
+        return frame
+
+    def Release(self):
+        """ Release the views, so an underlying mmap can be closed """
+        for part in self._parts:
+            part.release()
+        self._parts = list()
+        self._starts = list()
+        self._length = 0
+
+_PADDED_FRAME = b'\xFF' * 8
+
 #TODO: This doesn't make sense for negative numbers, should they even be allowed?
 class NumericValue():
     """ To store a number which can be read to/from LE or BE """
@@ -34,18 +129,30 @@ class NumericValue():
     def Value(self):
         return self.value
 
+@functools.lru_cache(maxsize=4096)
+def CachedCANID(da, sa, pgn, prio=6):
+    """ IBSID(da, sa, pgn, prio).GetCANID(), computed once per combination """
+    return IBSID(da, sa, pgn, prio).GetCANID()
+
 class IBSID():
-    """ Represents a CAN ID in ISOBUS communication """
+    """ Represents a CAN ID in ISOBUS communication. IDs decoded with
+    FromCANID are interned, so treat an IBSID as immutable
+    """
+    __slots__ = ('da', 'sa', 'pgn', 'prio', '_canid')
+
     def __init__(self, da, sa, pgn, prio=6):
         self.da = da
         self.sa = sa
         self.pgn = pgn
         self.prio = prio
+        self._canid = None
 
     def GetCANID(self):
         """ Return the CAN ID as a 29 bit identifier """
-        canid = 0
-        if ((self.pgn >> 8) & 0xFF) < 0xEF:
+        if self._canid is not None:
+            return self._canid
+
+        if ((self.pgn >> 8) & 0xFF) <= 0xEF:
             # PDU1
             canid = (((self.prio & 0x7) << 26)
                     | ((self.pgn & 0xFF00) << 8) 
@@ -57,11 +164,20 @@ class IBSID():
                     | ((self.pgn & 0xFFFF) << 8) 
                     | (self.sa & 0xFF))
 
+        self._canid = canid
         return canid
     
     @classmethod
     def FromCANID(cls, canid):
-        """ Get values from 29 bit identifier """
+        """ Get values from 29 bit identifier. The same IBSID is returned for
+        recently seen IDs instead of decoding them again
+        """
+        if cls is IBSID:
+            return _InternCANID(canid & 0x1FFFFFFF)
+        return cls._Decode(canid)
+
+    @classmethod
+    def _Decode(cls, canid):
         prio = (canid >> 26) & 0x7
         sa = canid & 0xFF
 
@@ -76,4 +192,43 @@ class IBSID():
             #Broadcast
             pgn = (canid >> 8) & 0xFFFF
             
-        return cls(da, sa, pgn, prio)
+        ibsid = cls(da, sa, pgn, prio)
+        ibsid._canid = canid & 0x1FFFFFFF
+        return ibsid
+
+    def __eq__(self, other):
+        return (isinstance(other, IBSID) and self.da == other.da and self.sa == other.sa
+                and self.pgn == other.pgn and self.prio == other.prio)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.da, self.sa, self.pgn, self.prio))
+
+    def __repr__(self):
+        return 'IBSID(da=0x{0:02X}, sa=0x{1:02X}, pgn=0x{2:04X}, prio={3})'.format(
+            self.da, self.sa, self.pgn, self.prio)
+
+@functools.lru_cache(maxsize=2048)
+def _InternCANID(canid):
+    return IBSID._Decode(canid)
+
+def DecodeCANIDs(canids):
+    """ Decode an array of 29 bit CAN IDs at once, e.g. from a log. Returns
+    NumPy arrays (pgn, sa, da, prio), da is 0xFF for broadcast PGNs.
+    Needs NumPy
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise IBSException('DecodeCANIDs needs NumPy (pip install isobus[numpy])')
+
+    canids = numpy.asarray(canids, dtype=numpy.uint32)
+    prio = ((canids >> 26) & 0x7).astype(numpy.uint8)
+    sa = (canids & 0xFF).astype(numpy.uint8)
+    pf = (canids >> 16) & 0xFF
+    pdu1 = pf <= 0xEF
+    pgn = numpy.where(pdu1, (canids >> 8) & 0xFF00, (canids >> 8) & 0xFFFF).astype(numpy.uint32)
+    da = numpy.where(pdu1, (canids >> 8) & 0xFF, 0xFF).astype(numpy.uint8)
+    return pgn, sa, da, prio
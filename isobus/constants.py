@@ -18,3 +18,29 @@ PGN_ETP_DT    = 0xC700
 
 #ISOBUS NAME
 FUNCTION_VT   = 0x3E
+
+# (E)TP connection management control bytes
+TP_RTS    = 0x10
+TP_CTS    = 0x11
+TP_EOMA   = 0x13
+TP_BAM    = 0x20
+TP_ABORT  = 0xFF
+ETP_RTS   = 0x14
+ETP_CTS   = 0x15
+ETP_DPO   = 0x16
+ETP_EOMA  = 0x17
+
+# (E)TP connection abort reasons
+ABORT_BUSY       = 0x01
+ABORT_RESOURCES  = 0x02
+ABORT_TIMEOUT    = 0x03
+ABORT_BAD_SEQ    = 0x07
+ABORT_CTS_SIZE   = 0x0C
+
+# (E)TP timeouts in seconds (ISO 11783-3)
+TP_TR = 0.200
+TP_TH = 0.500
+TP_T1 = 0.750
+TP_T2 = 1.250
+TP_T3 = 1.250
+TP_T4 = 1.050
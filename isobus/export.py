@@ -0,0 +1,157 @@
+import os
+
+from isobus.common import IBSException
+from isobus.logdecoder import IBSLogDecoder
+from isobus.vt.commands import VT_FUNCTIONS
+
+# Columns of an export, one row per (reassembled) message. mux is the first
+# data byte (the VT function code for VT messages) or -1 for empty messages,
+# function the VT function name or None
+COLUMNS = ('timestamp', 'pgn', 'sa', 'da', 'prio', 'mux', 'function', 'payload')
+
+FORMATS = ('parquet', 'arrow', 'npz')
+
+# One fixed dictionary for the function column, Arrow IPC files can not
+# change it between batches
+_FUNCTION_NAMES = sorted(set(VT_FUNCTIONS.values()))
+_FUNCTION_INDEX = dict((name, index) for index, name in enumerate(_FUNCTION_NAMES))
+
+
+def _FormatFromPath(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.parquet':
+        return 'parquet'
+    elif extension in ('.arrow', '.feather', '.ipc'):
+        return 'arrow'
+    elif extension == '.npz':
+        return 'npz'
+    raise IBSException('Unknown export format for {0}, use one of {1}'.format(
+        path, ', '.join(FORMATS)))
+
+
+class IBSColumnarWriter():
+    """ Writes IBSLogRecords column-wise in batches of batchSize rows to a
+    Parquet or Arrow IPC file (needs pyarrow) or to NumPy .npz files (needs
+    NumPy). The format follows from the file extension unless given.
+    NumPy can not append to an .npz, so every batch goes to its own file,
+    name.00000.npz, name.00001.npz, ... with the payloads concatenated in
+    'payload' and their start offsets in 'payloadOffsets'
+    """
+
+    def __init__(self, path, format=None, batchSize=65536):
+        self.path = path
+        self.format = format if format is not None else _FormatFromPath(path)
+        if self.format not in FORMATS:
+            raise IBSException('Unknown export format {0}'.format(self.format))
+        self.batchSize = batchSize
+        self.rows = 0
+        self.batches = 0
+        self._columns = dict((name, list()) for name in COLUMNS)
+        self._writer = None
+
+        try:
+            if self.format == 'npz':
+                import numpy
+                self._numpy = numpy
+            else:
+                import pyarrow
+                import pyarrow.parquet
+                import pyarrow.ipc
+                self._pyarrow = pyarrow
+        except ImportError as e:
+            raise IBSException('Export to {0} needs {1}'.format(self.format, e.name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Write(self, record):
+        columns = self._columns
+        columns['timestamp'].append(record.timestamp)
+        columns['pgn'].append(record.pgn)
+        columns['sa'].append(record.sa)
+        columns['da'].append(record.da)
+        columns['prio'].append(record.prio)
+        columns['mux'].append(record.data[0] if len(record.data) > 0 else -1)
+        columns['function'].append(record.function)
+        columns['payload'].append(bytes(record.data))
+        if len(columns['timestamp']) >= self.batchSize:
+            self.Flush()
+
+    def WriteAll(self, records):
+        for record in records:
+            self.Write(record)
+
+    def Flush(self):
+        """ Write the buffered rows as one batch """
+        n = len(self._columns['timestamp'])
+        if n == 0:
+            return
+        if self.format == 'npz':
+            self._WriteNumpy()
+        else:
+            self._WriteArrow()
+        self.rows += n
+        self.batches += 1
+        for column in self._columns.values():
+            del column[:]
+
+    def Close(self):
+        self.Flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _WriteArrow(self):
+        pa = self._pyarrow
+        columns = self._columns
+        batch = pa.RecordBatch.from_arrays([
+            pa.array(columns['timestamp'], pa.float64()),
+            pa.array(columns['pgn'], pa.uint32()),
+            pa.array(columns['sa'], pa.uint8()),
+            pa.array(columns['da'], pa.uint8()),
+            pa.array(columns['prio'], pa.uint8()),
+            pa.array(columns['mux'], pa.int16()),
+            pa.DictionaryArray.from_arrays(
+                pa.array([_FUNCTION_INDEX.get(name) for name in columns['function']], pa.int8()),
+                pa.array(_FUNCTION_NAMES, pa.string())),
+            pa.array(columns['payload'], pa.binary()),
+            ], names=list(COLUMNS))
+        if self._writer is None:
+            if self.format == 'parquet':
+                self._writer = pa.parquet.ParquetWriter(self.path, batch.schema)
+            else:
+                self._writer = pa.ipc.new_file(self.path, batch.schema)
+        if self.format == 'parquet':
+            self._writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+
+    def _WriteNumpy(self):
+        np = self._numpy
+        columns = self._columns
+        payloads = columns['payload']
+        offsets = np.zeros(len(payloads) + 1, dtype=np.int64)
+        np.cumsum([len(payload) for payload in payloads], out=offsets[1:])
+        stem = os.path.splitext(self.path)[0]
+        np.savez('{0}.{1:05d}.npz'.format(stem, self.batches),
+                 timestamp=np.array(columns['timestamp'], dtype=np.float64),
+                 pgn=np.array(columns['pgn'], dtype=np.uint32),
+                 sa=np.array(columns['sa'], dtype=np.uint8),
+                 da=np.array(columns['da'], dtype=np.uint8),
+                 prio=np.array(columns['prio'], dtype=np.uint8),
+                 mux=np.array(columns['mux'], dtype=np.int16),
+                 function=np.array([name or '' for name in columns['function']]),
+                 payload=np.frombuffer(b''.join(payloads), dtype=np.uint8),
+                 payloadOffsets=offsets)
+
+
+def ExportLog(logfile, path, format=None, batchSize=65536, reassemble=True, transport=False):
+    """ Decode logfile and write it to path, returns the number of rows. The
+    TP/ETP frames are only written as well if transport is set
+    """
+    with IBSColumnarWriter(path, format, batchSize) as writer:
+        writer.WriteAll(IBSLogDecoder(reassemble, transport).DecodeFile(logfile))
+    return writer.rows
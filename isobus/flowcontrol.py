@@ -0,0 +1,85 @@
+import can
+import time
+import threading
+
+from isobus.common import IBSException
+from isobus.log import log
+
+
+def FrameBits(dlc):
+    """ Approximate bits on the bus for an extended data frame with dlc data
+    bytes: 67 bits of framing and interframe space, plus one stuff bit per
+    ten bits of the stuffed part on average
+    """
+    return 67 + 8 * dlc + (54 + 8 * dlc) // 10
+
+
+class IBSFlowControl():
+    """ Paces the data frames of multi-packet messages. A token bucket in bits
+    keeps the sending rate under maxBusLoad of the bitrate, the rate is halved
+    whenever the interface reports a full transmit queue (CanError, e.g.
+    ENOBUFS) and grows back by small steps on every successful send
+    """
+
+    MAX_RETRIES = 10
+    MAX_BACKOFF = 0.050
+
+    def __init__(self, bitrate=250000, maxBusLoad=1.0, burst=16):
+        self.bitrate = bitrate
+        self.burstBits = burst * FrameBits(8)
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._tokens = self.burstBits
+        self._last = time.monotonic()
+        self.SetMaxBusLoad(maxBusLoad)
+
+    def SetMaxBusLoad(self, maxBusLoad):
+        """ Ceiling for the bus load caused by our data frames, 0 < load <= 1 """
+        if not (0.0 < maxBusLoad <= 1.0):
+            raise IBSException('Bus load must be between 0 and 1')
+        with self._lock:
+            self.maxBusLoad = maxBusLoad
+            self._ceiling = maxBusLoad * self.bitrate
+            self._rate = self._ceiling
+
+    def Rate(self):
+        """ Current sending rate in frames/s for 8 byte frames """
+        return self._rate / FrameBits(8)
+
+    def Send(self, bus, msg):
+        """ Send msg on bus when the bucket allows, retrying on a full transmit
+        queue. Returns False if the frame could not be sent
+        """
+        self._Acquire(FrameBits(len(msg.data)))
+
+        backoff = FrameBits(8) / float(self.bitrate)
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                bus.send(msg)
+            except (can.CanError, OSError):
+                self.retries += 1
+                with self._lock:
+                    self._rate = max(self._ceiling / 16.0, self._rate / 2.0)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.MAX_BACKOFF)
+                continue
+
+            if self._rate < self._ceiling:
+                with self._lock:
+                    self._rate = min(self._ceiling, self._rate + self._ceiling / 32.0)
+            return True
+
+        log.warning('Error sending message, transmit queue stays full')
+        return False
+
+    def _Acquire(self, bits):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burstBits, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= bits
+            deficit = -self._tokens
+            rate = self._rate
+        # The tokens are already taken, so concurrent senders queue up behind us
+        if deficit > 0:
+            time.sleep(deficit / rate)
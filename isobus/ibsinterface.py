@@ -1,23 +1,55 @@
 import can
 import math # ceil
-import time #sleep
+import threading
+import time
+import collections
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import InvalidStateError
 
 from isobus.common import NumericValue
 from isobus.common import IBSID
+from isobus.common import CachedCANID
 from isobus.common import IBSException
+from isobus.common import IBSRxHandler
+from isobus.common import IBSMessageData
 from isobus.constants import *
 from isobus.log import log
-
-from can.interfaces.interface import Bus
-
-class IBSRxHandler():
-
-    def __init__(self, pgns):
-        self.pgnlist = pgns
-
-    def RxMessage(ibsid, data):
-        raise NotImplemented('Rx handler not implemented!')
-
+from isobus.tp import IBSTPReceiver
+from isobus.tp import IBSTxSession
+from isobus.addressclaim import IBSNameTable
+from isobus.scheduler import IBSScheduler
+from isobus.flowcontrol import IBSFlowControl
+from isobus.periodic import IBSPeriodicTask
+from isobus.periodic import IBSBCMTask
+from isobus.metrics import IBSMetrics
+from isobus.metrics import RX
+from isobus.metrics import TX
+
+from can.interface import Bus
+
+# SocketCAN accepts at most this many filters, with more everything is received
+MAX_CAN_FILTERS = 512
+
+def _FilterKey(pgn, sa, da):
+    # The PDU specific byte of broadcast (PDU2) PGNs is part of the PGN
+    return (pgn, sa, da if ((pgn >> 8) & 0xFF) <= 0xEF else None)
+
+def _CANFilter(pgn, sa, da):
+    """ python-can acceptance filter for pgn from sa to da, None for sa or da
+    accepts any address. The data page is ignored, like IBSID does
+    """
+    canid = (pgn & 0xFFFF) << 8
+    mask = 0xFF0000
+    if ((pgn >> 8) & 0xFF) > 0xEF:
+        mask |= 0xFF00
+    elif da is not None:
+        canid |= da << 8
+        mask |= 0xFF00
+    if sa is not None:
+        canid |= sa
+        mask |= 0xFF
+    return dict(can_id = canid, can_mask = mask, extended = True)
 
 class IBSInterface(can.Listener):
     """ This class defines the methods for a minimal ISOBUS CF.
@@ -26,70 +58,214 @@ class IBSInterface(can.Listener):
     IBSVTInterface (part 6).
     """
 
-    def __init__(self, interface, channel):
-        can.rc['interface'] = interface
-        can.rc['channel'] = channel
-        log.info('Opening CAN connection on {0}'.format(
-            can.rc['channel']))
-        self.bus = Bus(bitrate=250000)
-        self.periodic_tasks = list()
-        self._rxHandlers = list()
-
-        #Have to use a separate bus object, otherwise WaitForIsobusmessage does not work
-        #self.notifier =  can.Notifier(Bus(), [self])
+    def __init__(self, interface, channel, bitrate=250000):
+        self.interface = interface
+        self.channel = channel
+        log.info('Opening CAN connection on {0}'.format(channel))
+        self.bus = Bus(channel, interface=interface, bitrate=bitrate)
+        # Periodic messages by CAN ID. On SocketCAN the kernel broadcast
+        # manager sends them, elsewhere the scheduler thread does
+        self._periodicLock = threading.Lock()
+        self.periodicTasks = dict()
+        self.useBCM = (interface.startswith('socketcan')
+                       and hasattr(self.bus, 'send_periodic'))
+        self.flowControl = IBSFlowControl(bitrate)
+        # Opt-in traffic and timing metrics, see EnableMetrics
+        self.metrics = None
+
+        # Routing tables, keyed by (pgn, sa, da, muxbyte). For handlers a None
+        # field is a wildcard, _rxMasks holds which fields are used by any
+        # handler so a lookup is a handful of dict accesses, not a scan
+        self._rxLock = threading.Lock()
+        self._rxHandlers = dict()
+        self._rxMasks = set()
+        self._rxWaiters = dict()
+
+        # Acceptance filters of the bus, derived from the handlers and waiters,
+        # so irrelevant frames are dropped by the driver. _filterKeys holds the
+        # (pgn, sa, da) accepted, None when everything is received. Turned off
+        # when the bus can not filter, dispatching filters in software anyway
+        self.canFilters = True
+        self._filterLock = threading.Lock()
+        self._filterKeys = None
+
+        self.scheduler = IBSScheduler()
+
+        # Queued BAM transfers per source address, only one runs at a time
+        self.bamInterval = 0.050
+        self._bamLock = threading.Lock()
+        self._bamQueues = dict()
+        self._bamStarted = dict()
+
+        # Addresses claimed through this interface, (E)TP sessions to these are answered
+        self.localAddresses = set()
+        self.tpReceiver = IBSTPReceiver(self)
+        self.AddRxHandler(self.tpReceiver)
+
+        # NAME of every address claimed on the network, including our own
+        self.names = IBSNameTable()
+        self.AddRxHandler(self.names)
+
+        # The notifier owns the receive thread, all frames are dispatched from there
+        self.notifier = can.Notifier(self.bus, [self], timeout=0.5)
 
     def __del__(self):
-        self.bus.shutdown()
+        self.Shutdown()
+
+    def Shutdown(self):
+        notifier = getattr(self, 'notifier', None)
+        if notifier is not None:
+            with self._periodicLock:
+                tasks = list(self.periodicTasks.values())
+                self.periodicTasks.clear()
+            for task in tasks:
+                task.Stop()
+            notifier.stop()
+            self.notifier = None
+            self.scheduler.Stop()
+            self.bus.shutdown()
 
     def on_message_received(self, mesg):
-        #TODO: Check 'listening' flag, if listening, store in queue
-        #      Change 'WaitForIBSMessage' accordingly, so we don't have to call recv on bus
-        #      Then we need a 'Start listening' and 'StopListening' + flushqueue method
-
         ibsid = IBSID.FromCANID(mesg.arbitration_id)
-        log.debug('Rx Mesg PGN {pgn:04X} SA {sa:02X} DA {da:02X}'.format(
-            pgn=ibsid.pgn, sa=ibsid.sa, da=ibsid.da))
-
-        #TODO: Smarter filters, SA, DA, PGN, muxbyte?
-        for handler in self._rxHandlers:
-            if pgn in handler.pgnlist:
-                handler.RxMessage(ibsid, mesg.data)
-        
+        if self.metrics is not None:
+            self.metrics.Frame(RX, ibsid, len(mesg.data))
+        self._DispatchIBSMessage(ibsid, mesg.data)
+
+    def EnableMetrics(self, enable=True):
+        """ Start (or stop) collecting metrics in self.metrics, an IBSMetrics """
+        if enable and self.metrics is None:
+            self.metrics = IBSMetrics(self.flowControl.bitrate)
+        elif not enable:
+            self.metrics = None
+
     def AddRxHandler(self, handler):
-        self._rxHandlers.append(handler)
+        mask = (handler.sa is not None,
+                handler.da is not None,
+                handler.muxByte is not None)
+        with self._rxLock:
+            for pgn in handler.pgnlist:
+                key = (pgn, handler.sa, handler.da, handler.muxByte)
+                self._rxHandlers.setdefault(key, list()).append(handler)
+            self._rxMasks.add(mask)
+        self._RefreshCANFilters()
+
+    def RemoveRxHandler(self, handler):
+        with self._rxLock:
+            for pgn in handler.pgnlist:
+                key = (pgn, handler.sa, handler.da, handler.muxByte)
+                handlers = self._rxHandlers.get(key, list())
+                if handler in handlers:
+                    handlers.remove(handler)
+                if len(handlers) == 0:
+                    self._rxHandlers.pop(key, None)
+            self._rxMasks = set((key[1] is not None, key[2] is not None, key[3] is not None)
+                                for key in self._rxHandlers.keys())
+        self._RefreshCANFilters()
+
+    def EnableCANFilters(self, enable=True):
+        """ Only receive frames that a handler or waiter is registered for
+        (the default if the bus supports filters), or everything
+        """
+        self.canFilters = enable
+        self._RefreshCANFilters()
+
+    def _RefreshCANFilters(self):
+        """ Set the bus filters to what the handlers and waiters need. Filters
+        for waiters stay until the next refresh, as a response is usually
+        waited for again soon
+        """
+        with self._filterLock:
+            keys = None
+            if self.canFilters:
+                keys = set()
+                with self._rxLock:
+                    for (pgn, sa, da, _), handlers in self._rxHandlers.items():
+                        if da is None and self.tpReceiver in handlers:
+                            # Sessions to us or broadcast, the bulk of TP traffic is not
+                            for local in self.localAddresses | set([SA_GLOBAL]):
+                                keys.add(_FilterKey(pgn, sa, local))
+                            if len(handlers) == 1:
+                                continue
+                        keys.add(_FilterKey(pgn, sa, da))
+                    for (pgn, sa, da, _) in self._rxWaiters.keys():
+                        keys.add(_FilterKey(pgn, sa, da))
+                # Leave out filters a wildcard filter already covers
+                keys = set(key for key in keys
+                           if not any(wide != key and wide in keys for wide in (
+                               (key[0], None, key[2]), (key[0], key[1], None),
+                               (key[0], None, None))))
+                if len(keys) > MAX_CAN_FILTERS:
+                    keys = None
+            if keys == self._filterKeys:
+                return
+            log.debug('Setting {0} CAN filters'.format(
+                len(keys) if keys is not None else 'no'))
+            try:
+                self.bus.set_filters([_CANFilter(*key) for key in keys]
+                                     if keys is not None else None)
+            except (NotImplementedError, AttributeError):
+                log.debug('Bus does not support CAN filters')
+                self.canFilters = False
+                keys = None
+            self._filterKeys = keys
+
+    def _Accepted(self, pgn, sa, da):
+        """ True if the bus filters let messages for this key through """
+        keys = self._filterKeys
+        if keys is None:
+            return True
+        pgn, sa, da = _FilterKey(pgn, sa, da)
+        return ((pgn, sa, da) in keys or (pgn, None, da) in keys
+                or (pgn, sa, None) in keys or (pgn, None, None) in keys)
 
-    
     def AddPeriodicMessage(self, ibsid, contents, period):
-        # For socketcan_native, bit 32 (MSb) needs to be set for extended ID
-        # Is fixed in latest python-can though!
+        """ Send contents every period seconds until StopPeriodicMessage, replaces
+        a periodic message with the same CAN ID. Returns the task
+        """
+        canid = ibsid.GetCANID()
         log.debug('Adding periodic message ID : 0x{mesgid:08X} period {T}'.format(
-            mesgid = ibsid.GetCANID(), T=period))
-        msg = can.Message(arbitration_id=(ibsid.GetCANID() | (1 << 31)),
-                          data=contents,
-                          extended_id=True)
-        self.periodic_tasks.append(can.send_periodic(can.rc['channel'], msg, period))
+            mesgid = canid, T=period))
+        self.StopPeriodicMessage(ibsid)
+        if self.useBCM:
+            task = IBSBCMTask(self.bus, canid, contents, period)
+        else:
+            task = IBSPeriodicTask(self, canid, contents, period)
+        with self._periodicLock:
+            self.periodicTasks[canid] = task
+        return task
 
     def StopPeriodicMessage(self, ibsid):
-        # For socketcan_native, bit 32 (MSb) needs to be set for extended ID
-        # Is fixed in latest python-can though!
-        for periodMsg in self.periodic_tasks:
-            if periodMsg.can_id == (ibsid.GetCANID() | (1 << 31)):
-                log.debug('Stopping periodic message ID : 0x{mesgid:08X}'.format(
-                    mesgid = ibsid.GetCANID()))
-                self.periodic_tasks.remove(periodMsg)
-                periodMsg.stop()
-                break
+        with self._periodicLock:
+            task = self.periodicTasks.pop(ibsid.GetCANID(), None)
+        if task is not None:
+            log.debug('Stopping periodic message ID : 0x{mesgid:08X}'.format(
+                mesgid = task.canid))
+            task.Stop()
 
     def ModifyPeriodicMessage(self, ibsid, newContent):
-        # For socketcan_native, bit 32 (MSb) needs to be set for extended ID
-        # Is fixed in latest python-can though!
-        msg = can.Message(arbitration_id=(ibsid.GetCANID() | (1 << 31)),
-                          data=newContent,
-                          extended_id=True)
-        for periodMsg in self.periodic_task:
-            if periodMsg.can_id == canid:
-                periodMsg.modify_data(self, msg)
-                break
+        """ Change the contents of a periodic message, from its next send on """
+        with self._periodicLock:
+            task = self.periodicTasks.get(ibsid.GetCANID())
+        if task is None:
+            raise IBSException('No periodic message with ID 0x{0:08X}'.format(
+                ibsid.GetCANID()))
+        task.Modify(newContent)
+
+    def PeriodicStatistics(self):
+        """ Sends, missed periods and jitter per periodic message, by CAN ID """
+        with self._periodicLock:
+            tasks = list(self.periodicTasks.values())
+        return dict((task.canid, task.Statistics()) for task in tasks)
+
+    def SetMaxBusLoad(self, maxBusLoad):
+        """ Limit the bus load of (E)TP data transfers, as a fraction (0 - 1] """
+        self.flowControl.SetMaxBusLoad(maxBusLoad)
+
+    def SetBAMInterval(self, interval):
+        """ Time between BAM data packets in seconds, 50 to 200 ms """
+        if not (0.050 <= interval <= 0.200):
+            raise IBSException('BAM interval must be between 50 and 200 ms')
+        self.bamInterval = interval
 
     def SendRequestAddressClaim(self, sa):
         log.debug('Sending Request Address Claim')
@@ -100,167 +276,282 @@ class IBSInterface(can.Listener):
             ibsName))
         candata = NumericValue(ibsName).AsLEBytes(8)
         self._SendIBSMessage(PGN_ADDRCLAIM, SA_GLOBAL, sa, candata)
+        self.names.Claimed(sa, ibsName)
+        # Other CFs sharing this interface don't receive our frames from the
+        # bus, but must see our claims. From the scheduler thread, so no
+        # claimer lock is held while another claimer handles it
+        self.scheduler.CallLater(0, self._DispatchIBSMessage,
+                                 IBSID(da = SA_GLOBAL, sa = sa, pgn = PGN_ADDRCLAIM), candata)
+        if sa != SA_NULL:
+            self._SetLocalAddress(sa)
+
+    def _SetLocalAddress(self, sa):
+        """ Answer (E)TP sessions to sa and let them through the CAN filters """
+        if sa not in self.localAddresses:
+            self.localAddresses.add(sa)
+            self._RefreshCANFilters()
+
+    def _DropLocalAddress(self, sa):
+        if sa in self.localAddresses:
+            self.localAddresses.discard(sa)
+            self._RefreshCANFilters()
+
+    def RequestName(self, sa, da, maxtime=1.0):
+        """ Ask da for its address claim, returns received and the 64 bit NAME.
+        Addresses claimed since the interface was opened are answered from
+        the NAME table without a request
+        """
+        ibsName = self.names.Name(da)
+        if ibsName is not None:
+            return True, ibsName
+        future = self._AddWaiter((PGN_ADDRCLAIM, da, SA_GLOBAL, None), None)
+        self.SendRequest(sa, da, reqPGN=PGN_ADDRCLAIM)
+        received, data = self._WaitForFuture((PGN_ADDRCLAIM, da, SA_GLOBAL, None), future, maxtime)
+        return received, NumericValue.FromLEBytes(data[0:8]).Value()
 
     def SendRequest(self, sa, da, reqPGN):
-        self._SendIBSMessage(PGN_REQUEST, sa, da, NumericValue(reqPGN).AsLEBytes(3))
+        self._SendIBSMessage(PGN_REQUEST, da, sa, NumericValue(reqPGN).AsLEBytes(3))
 
     ## PROTECTED FUNCTIONS
     def _SendCANMessage(self, canid, candata):
-        if len(candata) <= 8:
-            msg = can.Message(arbitration_id=canid,
-                              data=candata,
-                              extended_id=True)
+        """ Returns False if the frame could not be sent """
+        if len(candata) > 8:
+            log.warning('ERROR : CAN frame data longer than 8 bytes')
+            return False
+        msg = can.Message(arbitration_id=canid,
+                          data=candata,
+                          extended_id=True)
+        if self.metrics is not None:
+            self.metrics.Frame(TX, IBSID.FromCANID(canid), len(candata))
+        try:
+            self.bus.send(msg)
+        except can.CanError:
+            log.warning('Error sending message')
+            return False
+        return True
+
+    def _SendCANFrame(self, canid, candata):
+        """ Send a data frame of a multi-packet message as fast as the flow
+        control allows. Returns False if it could not be sent
+        """
+        msg = can.Message(arbitration_id=canid,
+                          data=candata,
+                          extended_id=True)
+        sent = self.flowControl.Send(self.bus, msg)
+        if sent and self.metrics is not None:
+            self.metrics.Frame(TX, IBSID.FromCANID(canid), len(candata))
+        return sent
+
+    def _DispatchIBSMessage(self, ibsid, data):
+        """ Route a received (or reassembled) message to the handlers and waiters
+        registered for it
+        """
+        muxByte = data[0] if len(data) > 0 else None
+        handlers = list()
+        future = None
+        with self._rxLock:
+            for useSA, useDA, useMux in self._rxMasks:
+                key = (ibsid.pgn,
+                       ibsid.sa if useSA else None,
+                       ibsid.da if useDA else None,
+                       muxByte if useMux else None)
+                handlers.extend(self._rxHandlers.get(key, ()))
+
+            for key in ((ibsid.pgn, ibsid.sa, ibsid.da, muxByte),
+                        (ibsid.pgn, ibsid.sa, ibsid.da, None)):
+                waiters = self._rxWaiters.get(key)
+                if waiters is not None:
+                    future = self._PopWaiter(key, waiters, data)
+                    if future is not None:
+                        break
+
+        # Resolve outside the lock, done callbacks may register new waiters
+        if future is not None:
             try:
-                self.bus.send(msg)
-            except can.CanError:
-                log.warning('Error sending message')
-
-    def _WaitForIBSMessage(self, pgn, fromsa, tosa, muxByte, maxtime=3.0):
-        # TODO: Also accept incoming TP session
-        # TODO: Can we miss messages because we start listening too late?
+                future.set_result(data)
+            except InvalidStateError:
+                pass # Timed out in the meantime
 
+        for handler in handlers:
+            try:
+                handler.RxMessage(ibsid, data)
+            except Exception:
+                log.exception('Rx handler failed for PGN {pgn:04X}'.format(pgn=ibsid.pgn))
+
+    def _PopWaiter(self, key, waiters, data):
+        # Called with _rxLock held, the oldest matching waiter gets the message
+        matched = None
+        for waiter in list(waiters):
+            future, match = waiter
+            if future.done():
+                waiters.remove(waiter)
+            elif match is None or match(data):
+                waiters.remove(waiter)
+                matched = future
+                break
+        if len(waiters) == 0:
+            del self._rxWaiters[key]
+        return matched
+
+    def _AddWaiter(self, key, match):
+        future = Future()
+        # The CTS waits of a TP/ETP send are timed by the session metrics
+        if self.metrics is not None and key[0] not in (PGN_TP_CM, PGN_ETP_CM):
+            future.add_done_callback(self._ResponseMetrics(key, self.metrics))
+        with self._rxLock:
+            self._rxWaiters.setdefault(key, collections.deque()).append((future, match))
+        if not self._Accepted(key[0], key[1], key[2]):
+            self._RefreshCANFilters()
+        return future
+
+    @staticmethod
+    def _ResponseMetrics(key, metrics):
+        # Latency from registering the waiter (just before the request is
+        # sent) until the response, a cancelled waiter timed out
+        started = time.monotonic()
+        def Done(future):
+            if future.cancelled():
+                metrics.Timeout(key[0], key[3])
+            else:
+                metrics.Response(key[0], key[3], time.monotonic() - started)
+        return Done
+
+    def _RemoveWaiter(self, key, future):
+        """ Cancel future and unregister it, key None searches all keys """
+        future.cancel()
+        with self._rxLock:
+            keys = [key] if key is not None else list(self._rxWaiters.keys())
+            for key in keys:
+                waiters = self._rxWaiters.get(key)
+                if waiters is None:
+                    continue
+                for waiter in list(waiters):
+                    if waiter[0] is future:
+                        waiters.remove(waiter)
+                if len(waiters) == 0:
+                    del self._rxWaiters[key]
+
+    def _ExpectIBSMessage(self, pgn, fromsa, tosa, muxByte, match=None):
+        """ Start listening for a message before the request that triggers it is
+        sent, so the response can not be missed. muxByte None matches any first
+        byte, match is an optional function on the data for finer correlation.
+        Returns a Future which resolves to the message data
+        """
+        return self._AddWaiter((pgn, fromsa, tosa, muxByte), match)
+
+    def _WaitForIBSMessage(self, pgn, fromsa, tosa, muxByte, maxtime=3.0, future=None):
+        """ Wait for the message on future, from _ExpectIBSMessage with the same
+        key. Without a future only a message received from now on is seen
+        """
+        key = (pgn, fromsa, tosa, muxByte)
+        if future is None:
+            future = self._AddWaiter(key, None)
+
+        return self._WaitForFuture(key, future, maxtime)
+
+    def _WaitForFuture(self, key, future, maxtime):
         received = False
         data = [RESERVED] * 8 # Dummy data for when nothing is received
-        starttime = time.time()
-        matchID = IBSID(da = tosa, sa = fromsa, pgn = pgn, prio = 6)
-        while not(received):
-            mesg = self.bus.recv(0.5)
-            if mesg is not None:
-                receivedID = IBSID.FromCANID(mesg.arbitration_id)
-                if (receivedID.pgn == matchID.pgn
-               and receivedID.da  == matchID.da
-               and receivedID.sa  == matchID.sa
-               and mesg.data[0]   == muxByte):
-                    received= True
-                    data = mesg.data
-                    break
-            if (time.time() - starttime) > maxtime:
-                log.debug('Timeout waiting for CAN ID {canid:08X}'.format(canid=matchID.GetCANID()))
-                break
-
-        return received, data 
-
-    def _SendIBSMessage(self, pgn, da, sa, data, prio=6):
+        try:
+            data = future.result(maxtime)
+            received = True
+        except FutureTimeoutError:
+            self._RemoveWaiter(key, future)
+            log.debug('Timeout waiting for CAN ID {canid:08X}'.format(
+                canid=IBSID(da = key[2], sa = key[1], pgn = key[0], prio = 6).GetCANID()))
+
+        return received, data
+
+    def _SendIBSMessage(self, pgn, da, sa, data, prio=6, progress=None):
+        """ Send data in a single frame, with BAM when it is longer and global,
+        else with TP or ETP. Returns a Future resolved when the last packet is
+        sent for BAM, otherwise True when the frame was sent or the receiver
+        acknowledged the (E)TP message, False if it could not be sent
+        """
         if len(data) <= 8:
-            canid = IBSID(da, sa, pgn, prio).GetCANID()
-            self._SendCANMessage(canid, data)
+            if isinstance(data, IBSMessageData):
+                data = bytes(data)
+            return self._SendCANMessage(CachedCANID(da, sa, pgn, prio), data)
+
+        # Multi-packet data is only read per packet, never copied as a whole
+        if not isinstance(data, IBSMessageData):
+            data = IBSMessageData(data)
+
+        if da == SA_GLOBAL and len(data) <= 1785:
+            return self._SendBAMMessage(pgn, sa, data)
+        elif da == SA_GLOBAL:
+            log.warning('ERROR : CAN message too large to broadcast')
+            return False
         elif len(data) <= 1785:
-            self._SendTPMessage(pgn, da, sa, data)
+            return self._SendTPMessage(pgn, da, sa, data, progress)
         elif len(data) <= 117440505:
-            self._SendETPMessage(pgn, da, sa, data)
+            return self._SendETPMessage(pgn, da, sa, data, progress)
         else:
             log.warning('ERROR : CAN message too large to send')
+            return False
 
-    def _SendTPMessage(self, pgn, da, sa, data):
-        log.debug('(TP) Request starting TP for {n} bytes'.format(n=len(data)))
-        tpcm_id = IBSID(da, sa, pgn=PGN_TP_CM, prio=6)
-        tpdt_id = IBSID(da, sa, pgn=PGN_TP_DT, prio=7)
-
-        # Send RTS
-        rts_control = 0x10
+    def _SendBAMMessage(self, pgn, sa, data):
+        """ Broadcast data with the BAM, packets are sent from the scheduler
+        every bamInterval. A source address can only run one BAM at a time,
+        later ones are queued. Returns a future which is resolved when the
+        last packet is sent
+        """
+        future = Future()
+        with self._bamLock:
+            queue = self._bamQueues.setdefault(sa, collections.deque())
+            queue.append((pgn, data, future))
+            if len(queue) == 1:
+                self._StartBAM(sa)
+        return future
+
+    def _StartBAM(self, sa):
+        # Called with _bamLock held
+        pgn, data, _ = self._bamQueues[sa][0]
         nr_of_packets = int(math.ceil(len(data) / 7.0))
-        rts_data = ([rts_control] 
-                    + NumericValue(len(data)).AsLEBytes(2) 
+        log.debug('(BAM) Broadcasting PGN {0:04X} : {1} bytes in {2} packets'.format(
+            pgn, len(data), nr_of_packets))
+        bam_data = ([TP_BAM]
+                    + NumericValue(len(data)).AsLEBytes(2)
                     + [nr_of_packets, RESERVED]
                     + NumericValue(pgn).AsLEBytes(3))
-
-        log.debug('(TP) Sending RTS for PGN {0} : {1} bytes in {2} packets'.format(
-            pgn, len(data), nr_of_packets))
-        self._SendCANMessage(tpcm_id.GetCANID(), rts_data)
-
-        # Check the CTS
-        #FIXME: Only send min(nrOfPackets,maxPackets), what to do if less?
-        [received, ctsdata] = self._WaitForIBSMessage(0xEC00, da, sa, 0x11)
-        if received:
-            log.debug('(TP) Received CTS for max {0} packets, next packet {1}'.format(
-                ctsdata[1], ctsdata[2]))
-
-        else:
-            return False
-
-        
-        # Pack with 0xFF
-        if len(data) % 7 > 0:
-            data = data + list([RESERVED] * (7 - (len(data) % 7)))
-
-
-        # Send bytes
-        for seqN in range(nr_of_packets):
-            log.debug('(TP) Send package {n}'.format(n=seqN + 1))
-            startByte = seqN * 7
-            self._SendCANMessage(tpdt_id.GetCANID(), [seqN + 1] + data[startByte:startByte + 7])
-            # sleep 1 msec, otherwise hardware buffer gets full!
-            time.sleep(0.001)
-
-
-    def _SendETPMessage(self, pgn, da, sa, data):
-        log.debug('(ETP) Request starting ETP for {n} bytes'.format(n=len(data)))
-        etpcm_id = IBSID(da, sa, PGN_ETP_CM, prio=6)
-        etpdt_id = IBSID(da, sa, PGN_ETP_DT, prio=7)
-
-        mesg_size = len(data)
-
-        # Send RTS
-        rts_control = 0x14
-        totalPackets = int(math.ceil(len(data) / 7.0))
-
-        log.debug("(ETP) Sending {0} bytes in {1} packets".format(
-                len(data), totalPackets))
-
-        rts_data = ([rts_control]
-                    + NumericValue(mesg_size).AsLEBytes(4)
-                    + NumericValue(pgn).AsLEBytes(3)
-                   ) 
-        self._SendCANMessage(etpcm_id.GetCANID(), rts_data)
-        
-        # Pack data with 0xFF to multiple of 7
-        if len(data) % 7 > 0:
-            data = data + list([RESERVED] * (7 - (len(data) % 7)))
-
-        
-        # Setup for the data transfer
-        nextPacket = 1
-        maxSentPackets = 0
-        done = False
-
-        while not(done):
-            # TODO: What is the time out for this one?
-            [received, ctsdata] = self._WaitForIBSMessage(0xC800, da, sa, 0x15)
-            if received:
-                nextPacket = NumericValue.FromLEBytes(ctsdata[2:5]).Value()
-                maxSentPackets = ctsdata[1]
-                log.debug("(ETP) Received CTS for max {0} packets, next packet {1}".format(
-                    maxSentPackets, nextPacket)
-                    )
-            else :
-                log.warning('(ETP) Wait for CTS timed out')
-                break
-            
-            packetOffset = nextPacket - 1
-            
-            nPackets = min(maxSentPackets, totalPackets - packetOffset)
-
-            log.debug('(ETP) Sending {0} packets with packet offset {1}'.format(
-                nPackets, packetOffset))
-            log.debug('(ETP) bytes[{0} - {1}]'.format(
-                packetOffset * 7, packetOffset * 7 + nPackets * 7 - 1))
-
-            dpoData = ([0x16]
-                       + [nPackets]
-                       + NumericValue(packetOffset).AsLEBytes(3)
-                       + NumericValue(pgn).AsLEBytes(3))
-            self._SendCANMessage(etpcm_id.GetCANID(), dpoData)
-
-            for n in range(nPackets) :
-                startByte = (n * 7) + (packetOffset * 7)
-                # Send send data[n * 7 + dataoffset: n* 7 +7 + dataoffset]
-                self._SendCANMessage(etpdt_id.GetCANID(), [n + 1] + data[startByte:startByte+7])
-
-                 # If it is the last packet, quit the loop
-                if (n + nextPacket) >= totalPackets:
-                    done = True
-                    break
-
-                time.sleep(0.001)
-
-        # TODO: Optionally wait for EOMA
+        self._SendCANMessage(CachedCANID(SA_GLOBAL, sa, PGN_TP_CM, 6), bam_data)
+        self._bamStarted[sa] = time.monotonic()
+        self.scheduler.CallLater(self.bamInterval, self._SendBAMPacket, sa, 1)
+
+    def _SendBAMPacket(self, sa, seqN):
+        with self._bamLock:
+            queue = self._bamQueues[sa]
+            pgn, data, future = queue[0]
+            self._SendCANMessage(CachedCANID(SA_GLOBAL, sa, PGN_TP_DT, 7),
+                                 data.PacketFrame(seqN, seqN - 1))
+
+            if seqN * 7 < len(data):
+                self.scheduler.CallLater(self.bamInterval, self._SendBAMPacket, sa, seqN + 1)
+                return
+
+            queue.popleft()
+            if self.metrics is not None:
+                self.metrics.Session('bam', TX, time.monotonic() - self._bamStarted[sa], True)
+            if len(queue) > 0:
+                self._StartBAM(sa)
+            else:
+                del self._bamQueues[sa]
+        future.set_result(True)
+
+    def _SendTPMessage(self, pgn, da, sa, data, progress=None):
+        """ Returns True if the receiver acknowledged the message (EoMA) """
+        return self._RunTxSession(IBSTxSession(self, pgn, da, sa, data, False, progress))
+
+    def _SendETPMessage(self, pgn, da, sa, data, progress=None):
+        """ Returns True if the receiver acknowledged the message (EoMA) """
+        return self._RunTxSession(IBSTxSession(self, pgn, da, sa, data, True, progress))
+
+    def _RunTxSession(self, session):
+        metrics = self.metrics
+        if metrics is None:
+            return session.Run()
+        started = time.monotonic()
+        ok = session.Run()
+        metrics.Session('etp' if session.extended else 'tp', TX,
+                        time.monotonic() - started, ok, session.retransmits)
+        return ok
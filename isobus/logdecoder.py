@@ -0,0 +1,100 @@
+import collections
+
+import can
+
+from isobus.common import IBSID
+from isobus.common import IBSException
+from isobus.constants import *
+from isobus.tp import IBSTPReceiver
+from isobus.vt.commands import DecodeVTMessage
+
+IBSLogRecord = collections.namedtuple('IBSLogRecord', [
+    'timestamp', 'pgn', 'sa', 'da', 'prio', 'data', 'function', 'fields'])
+IBSLogRecord.__doc__ = """ A decoded message from a log. data is the complete
+(reassembled) payload, function the VT function name and fields its decoded
+fields, both None if the message is not a VT message """
+
+_TRANSPORT_PGNS = frozenset([PGN_TP_CM, PGN_TP_DT, PGN_ETP_CM, PGN_ETP_DT])
+
+
+class _LogTPReceiver(IBSTPReceiver):
+    """ Passive TP receiver which collects completed messages. Time is the
+    timestamp of the logged messages, sessions without traffic for the TP
+    timeouts are dropped so a truncated session does not stay in memory
+    """
+
+    def __init__(self):
+        IBSTPReceiver.__init__(self, None, passive=True)
+        self.completed = list()
+        self.now = 0.0
+        self._nextExpire = None
+
+    def Feed(self, timestamp, ibsid, data):
+        self.now = timestamp
+        if self._nextExpire is None or timestamp >= self._nextExpire:
+            self.Expire(timestamp)
+            self._nextExpire = timestamp + TP_T1 / 3.0
+        if ibsid.pgn in _TRANSPORT_PGNS:
+            self.RxMessage(ibsid, data)
+
+    def _Deliver(self, ibsid, data):
+        self.completed.append((ibsid, data))
+
+    def _Now(self):
+        return self.now
+
+
+def ReadLog(filename):
+    """ Yield the CAN messages of a log file in any format python-can reads
+    (candump .log, .asc, .blf, ...), one at a time
+    """
+    try:
+        reader = can.LogReader(filename)
+    except (ValueError, NotImplementedError) as e:
+        raise IBSException('Can not read log {0}: {1}'.format(filename, e))
+    for msg in reader:
+        if msg.is_error_frame or msg.is_remote_frame:
+            continue
+        yield msg
+
+
+class IBSLogDecoder():
+    """ Decodes recorded CAN messages to IBSLogRecords as a stream, so logs
+    of any size are decoded in constant memory. TP, ETP and BAM sessions are
+    reassembled and yielded as one record at the time of their last packet,
+    the transport frames themselves only if transport is set
+    """
+
+    def __init__(self, reassemble=True, transport=False):
+        self.reassemble = reassemble
+        self.transport = transport
+        self.frames = 0
+        self._tp = _LogTPReceiver() if reassemble else None
+
+    def DecodeFile(self, filename):
+        return self.Decode(ReadLog(filename))
+
+    def Decode(self, messages):
+        """ Generator of IBSLogRecords for an iterable of can.Messages """
+        for msg in messages:
+            if not msg.is_extended_id:
+                continue
+            self.frames += 1
+            ibsid = IBSID.FromCANID(msg.arbitration_id)
+            data = msg.data
+
+            if ibsid.pgn not in _TRANSPORT_PGNS or self.transport or not self.reassemble:
+                yield self._Record(msg.timestamp, ibsid, bytes(data))
+
+            if self._tp is not None:
+                self._tp.Feed(msg.timestamp, ibsid, data)
+                for tpid, tpdata in self._tp.completed:
+                    yield self._Record(msg.timestamp, tpid, bytes(tpdata))
+                del self._tp.completed[:]
+
+    def _Record(self, timestamp, ibsid, data):
+        function = fields = None
+        if ibsid.pgn == PGN_ECU2VT or ibsid.pgn == PGN_VT2ECU:
+            function, fields = DecodeVTMessage(ibsid.pgn == PGN_ECU2VT, data)
+        return IBSLogRecord(timestamp, ibsid.pgn, ibsid.sa, ibsid.da, ibsid.prio,
+                            data, function, fields)
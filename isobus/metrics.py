@@ -0,0 +1,212 @@
+import bisect
+import threading
+import time
+
+from isobus.constants import *
+from isobus.flowcontrol import FrameBits
+from isobus.vt.commands import VT_FUNCTIONS
+
+RX = 'rx'
+TX = 'tx'
+
+# Upper bounds of the histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SESSION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _FunctionName(pgn, muxByte):
+    if muxByte is None:
+        return ''
+    if pgn in (PGN_VT2ECU, PGN_ECU2VT):
+        return VT_FUNCTIONS.get(muxByte, '0x{0:02X}'.format(muxByte))
+    return '0x{0:02X}'.format(muxByte)
+
+def _Labels(**labels):
+    return '{' + ','.join('{0}="{1}"'.format(name, value)
+                          for name, value in sorted(labels.items())) + '}'
+
+
+class IBSHistogram():
+    """ Counts of observed values per bucket, buckets are upper bounds.
+    Not thread safe, IBSMetrics locks around it
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # The last is above all buckets
+        self.sum = 0.0
+        self.count = 0
+
+    def Observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def Quantile(self, q):
+        """ Upper bound of the bucket holding quantile q (0 - 1), None if empty
+        or above the last bucket
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    def Cumulative(self):
+        """ (upper bound, values up to it) per bucket, ending with +Inf """
+        result = list()
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            result.append((bound, seen))
+        return result
+
+    def AsDict(self):
+        return dict(count = self.count, sum = self.sum,
+                    p50 = self.Quantile(0.5), p99 = self.Quantile(0.99))
+
+
+class IBSMetrics():
+    """ Traffic and timing of one interface: frames and bytes per PGN and
+    source address, response latency per PGN and first data byte (the VT
+    function for VT messages), (E)TP/BAM session durations and retransmitted
+    packets, and the bus load from the frames seen over the last window
+    seconds. Received frames dropped by the CAN filters are not counted,
+    disable them (EnableCANFilters) to measure the load of the whole bus
+    """
+
+    def __init__(self, bitrate=250000, window=1.0):
+        self.bitrate = bitrate
+        self.window = window
+        self._lock = threading.Lock()
+        self.Reset()
+
+    def Reset(self):
+        with self._lock:
+            self.frames = dict()    # (direction, pgn, sa) -> [frames, bytes]
+            self.responses = dict() # (pgn, muxByte) -> IBSHistogram
+            self.timeouts = dict()  # (pgn, muxByte) -> count
+            self.sessions = dict()  # (protocol, direction, ok) -> IBSHistogram
+            self.retransmits = dict() # (protocol, direction) -> packets
+            self._loadStart = time.monotonic()
+            self._loadBits = 0
+            self._load = 0.0
+
+    def Frame(self, direction, ibsid, length):
+        with self._lock:
+            key = (direction, ibsid.pgn, ibsid.sa)
+            counts = self.frames.get(key)
+            if counts is None:
+                counts = self.frames[key] = [0, 0]
+            counts[0] += 1
+            counts[1] += length
+            self._loadBits += FrameBits(length)
+            self._RollLoad(time.monotonic())
+
+    def Response(self, pgn, muxByte, seconds):
+        with self._lock:
+            histogram = self.responses.get((pgn, muxByte))
+            if histogram is None:
+                histogram = self.responses[(pgn, muxByte)] = IBSHistogram(LATENCY_BUCKETS)
+            histogram.Observe(seconds)
+
+    def Timeout(self, pgn, muxByte):
+        with self._lock:
+            self.timeouts[(pgn, muxByte)] = self.timeouts.get((pgn, muxByte), 0) + 1
+
+    def Session(self, protocol, direction, seconds, ok, retransmits=0):
+        """ A finished transfer, protocol is 'tp', 'etp' or 'bam' """
+        with self._lock:
+            key = (protocol, direction, ok)
+            histogram = self.sessions.get(key)
+            if histogram is None:
+                histogram = self.sessions[key] = IBSHistogram(SESSION_BUCKETS)
+            histogram.Observe(seconds)
+            if retransmits > 0:
+                key = (protocol, direction)
+                self.retransmits[key] = self.retransmits.get(key, 0) + retransmits
+
+    def BusLoad(self):
+        """ Fraction of the bitrate used over the last complete window """
+        with self._lock:
+            self._RollLoad(time.monotonic())
+            return self._load
+
+    def _RollLoad(self, now):
+        # Called with _lock held
+        elapsed = now - self._loadStart
+        if elapsed >= self.window:
+            self._load = self._loadBits / float(self.bitrate * elapsed)
+            self._loadStart = now
+            self._loadBits = 0
+
+    def Snapshot(self):
+        """ The metrics as plain dicts and numbers """
+        busLoad = self.BusLoad()
+        with self._lock:
+            return dict(
+                busLoad = busLoad,
+                frames = dict((key, tuple(counts)) for key, counts in self.frames.items()),
+                responses = dict(((pgn, _FunctionName(pgn, mux)), histogram.AsDict())
+                                 for (pgn, mux), histogram in self.responses.items()),
+                timeouts = dict(((pgn, _FunctionName(pgn, mux)), n)
+                                for (pgn, mux), n in self.timeouts.items()),
+                sessions = dict((key, histogram.AsDict())
+                                for key, histogram in self.sessions.items()),
+                retransmits = dict(self.retransmits))
+
+    def Prometheus(self, prefix='isobus'):
+        """ The metrics in the Prometheus text exposition format """
+        busLoad = self.BusLoad()
+        lines = list()
+
+        def Header(name, kind, text):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, text))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+
+        def Histogram(name, labels, histogram):
+            for bound, n in histogram.Cumulative():
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{0}_{1}_bucket{2} {3}'.format(
+                    prefix, name, _Labels(le = le, **labels), n))
+            lines.append('{0}_{1}_sum{2} {3!r}'.format(prefix, name, _Labels(**labels), histogram.sum))
+            lines.append('{0}_{1}_count{2} {3}'.format(prefix, name, _Labels(**labels), histogram.count))
+
+        with self._lock:
+            Header('bus_load_ratio', 'gauge', 'Fraction of the bitrate in use')
+            lines.append('{0}_bus_load_ratio {1!r}'.format(prefix, busLoad))
+
+            Header('frames_total', 'counter', 'CAN frames per PGN and source address')
+            for (direction, pgn, sa), counts in sorted(self.frames.items()):
+                lines.append('{0}_frames_total{1} {2}'.format(prefix, _Labels(
+                    direction = direction, pgn = '{0:04X}'.format(pgn),
+                    sa = '{0:02X}'.format(sa)), counts[0]))
+            Header('bytes_total', 'counter', 'CAN data bytes per PGN and source address')
+            for (direction, pgn, sa), counts in sorted(self.frames.items()):
+                lines.append('{0}_bytes_total{1} {2}'.format(prefix, _Labels(
+                    direction = direction, pgn = '{0:04X}'.format(pgn),
+                    sa = '{0:02X}'.format(sa)), counts[1]))
+
+            Header('response_seconds', 'histogram', 'Time from request to response')
+            for (pgn, mux), histogram in sorted(self.responses.items(), key=str):
+                Histogram('response_seconds', dict(pgn = '{0:04X}'.format(pgn),
+                                                   function = _FunctionName(pgn, mux)), histogram)
+            Header('response_timeouts_total', 'counter', 'Requests without a response')
+            for (pgn, mux), n in sorted(self.timeouts.items(), key=str):
+                lines.append('{0}_response_timeouts_total{1} {2}'.format(prefix, _Labels(
+                    pgn = '{0:04X}'.format(pgn), function = _FunctionName(pgn, mux)), n))
+
+            Header('session_seconds', 'histogram', 'Duration of TP, ETP and BAM transfers')
+            for (protocol, direction, ok), histogram in sorted(self.sessions.items()):
+                Histogram('session_seconds', dict(protocol = protocol, direction = direction,
+                                                  result = 'ok' if ok else 'failed'), histogram)
+            Header('retransmitted_packets_total', 'counter', 'TP and ETP packets sent again')
+            for (protocol, direction), n in sorted(self.retransmits.items()):
+                lines.append('{0}_retransmitted_packets_total{1} {2}'.format(prefix, _Labels(
+                    protocol = protocol, direction = direction), n))
+
+        return '\n'.join(lines) + '\n'
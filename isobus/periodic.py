@@ -0,0 +1,94 @@
+import can
+import threading
+import time
+
+
+class IBSPeriodicTask():
+    """ A message sent every period seconds from the interface's scheduler.
+    Sends are planned on a fixed grid (start + n * period), so a late send
+    does not shift the ones after it; a send more than a period late skips
+    the missed ones. Jitter is the time between the planned and the actual
+    send, in seconds
+    """
+
+    def __init__(self, interface, canid, data, period):
+        self.interface = interface
+        self.canid = canid
+        self.data = bytes(data)
+        self.period = period
+        self.sent = 0
+        self.missed = 0
+        self._jitterSum = 0.0
+        self._jitterMax = 0.0
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._next = time.monotonic()
+        self._call = interface.scheduler.CallAt(self._next, self._Send)
+
+    def Modify(self, data):
+        """ Send data from the next period on """
+        with self._lock:
+            self.data = bytes(data)
+
+    def Stop(self):
+        with self._lock:
+            self._stopped = True
+            self._call.Cancel()
+
+    def Statistics(self):
+        with self._lock:
+            return dict(period = self.period,
+                        sent = self.sent,
+                        missed = self.missed,
+                        meanJitter = self._jitterSum / self.sent if self.sent > 0 else 0.0,
+                        maxJitter = self._jitterMax)
+
+    def _Send(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._stopped:
+                return
+            data = self.data
+            planned = self._next
+        self.interface._SendCANMessage(self.canid, data)
+        jitter = now - planned
+        with self._lock:
+            self.sent += 1
+            self._jitterSum += jitter
+            self._jitterMax = max(self._jitterMax, jitter)
+            self._next = planned + self.period
+            if self._next <= now:
+                skipped = int((now - planned) / self.period)
+                self.missed += skipped
+                self._next = planned + (skipped + 1) * self.period
+            if not self._stopped:
+                self._call = self.interface.scheduler.CallAt(self._next, self._Send)
+
+
+class IBSBCMTask():
+    """ A message sent every period seconds by the SocketCAN broadcast manager
+    in the kernel, so it keeps its timing whatever Python is doing. The
+    kernel does not report sends, so there are no statistics
+    """
+
+    def __init__(self, bus, canid, data, period):
+        self.canid = canid
+        self.data = bytes(data)
+        self.period = period
+        self._task = bus.send_periodic(self._Message(self.data), period)
+
+    def Modify(self, data):
+        self.data = bytes(data)
+        self._task.modify_data(self._Message(self.data))
+
+    def Stop(self):
+        self._task.stop()
+
+    def Statistics(self):
+        return dict(period = self.period, sent = None, missed = None,
+                    meanJitter = None, maxJitter = None)
+
+    def _Message(self, data):
+        return can.Message(arbitration_id=self.canid,
+                           data=data,
+                           extended_id=True)
@@ -0,0 +1,77 @@
+import heapq
+import itertools
+import threading
+import time
+
+from isobus.log import log
+
+
+class IBSScheduledCall():
+    """ Handle for a callback queued on the IBSScheduler """
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def Cancel(self):
+        self.cancelled = True
+
+
+class IBSScheduler():
+    """ Runs callbacks at a given time from a single thread, ordered in a heap.
+    Callbacks should return quickly, they delay everything scheduled after them.
+    Times are from time.monotonic()
+    """
+
+    def __init__(self):
+        self._queue = list()
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = True
+
+    def CallAt(self, when, callback, *args):
+        call = IBSScheduledCall(when, callback, args)
+        with self._cond:
+            heapq.heappush(self._queue, (when, next(self._counter), call))
+            if self._thread is None and self._running:
+                self._thread = threading.Thread(target=self._Run, name='isobus-scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return call
+
+    def CallLater(self, delay, callback, *args):
+        return self.CallAt(time.monotonic() + delay, callback, *args)
+
+    def Stop(self):
+        with self._cond:
+            self._running = False
+            self._queue = list()
+            self._cond.notify()
+
+    def _Run(self):
+        while True:
+            with self._cond:
+                call = None
+                while self._running and call is None:
+                    if len(self._queue) == 0:
+                        self._cond.wait()
+                        continue
+                    delay = self._queue[0][0] - time.monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    call = heapq.heappop(self._queue)[2]
+                    if call.cancelled:
+                        call = None
+                if not self._running:
+                    return
+
+            try:
+                call.callback(*call.args)
+            except Exception:
+                log.exception('Scheduled call failed')
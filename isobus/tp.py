@@ -0,0 +1,392 @@
+import math # ceil
+import time
+import threading
+
+from isobus.common import IBSRxHandler
+from isobus.common import IBSID
+from isobus.constants import *
+from isobus.log import log
+
+
+class IBSRxSession():
+    """ State of one incoming TP/ETP/BAM transfer, the buffer is allocated
+    once for the announced size
+    """
+    __slots__ = ('extended', 'pgn', 'sa', 'da', 'size', 'packets',
+                 'buffer', 'nextPacket', 'windowEnd', 'offset', 'deadline',
+                 'started', 'retransmits', 'resendFrom')
+
+    def __init__(self, extended, pgn, sa, da, size, packets, now):
+        self.extended = extended
+        self.pgn = pgn
+        self.sa = sa
+        self.da = da
+        self.size = size
+        self.packets = packets
+        self.buffer = bytearray(packets * 7)
+        self.nextPacket = 1 # Next expected absolute packet number
+        self.windowEnd = 0  # Last packet number of the current CTS window
+        self.offset = 0     # ETP data packet offset from the last DPO
+        self.deadline = 0.0
+        self.started = now
+        self.retransmits = 0 # Packets asked for again
+        self.resendFrom = 0  # Packet a retransmit was asked from, 0 if none
+
+
+def _PGNFromCM(data):
+    return data[5] | (data[6] << 8) | (data[7] << 16)
+
+
+class IBSTxSession():
+    """ Sends one message with TP or ETP to a single destination, following
+    the receiver: CTS windows (retransmitting from the requested packet),
+    holds (CTS for 0 packets), connection aborts and the closing EoMA.
+    progress is called with the number of packets the receiver acknowledged
+    """
+
+    def __init__(self, interface, pgn, da, sa, data, extended, progress=None):
+        self.interface = interface
+        self.pgn = pgn
+        self.da = da
+        self.sa = sa
+        self.data = data
+        self.extended = extended
+        self.progress = progress
+        self.name = 'ETP' if extended else 'TP'
+        self.packets = int(math.ceil(len(data) / 7.0))
+        self.retransmits = 0
+        self.highestSent = 0
+
+        cmPGN = PGN_ETP_CM if extended else PGN_TP_CM
+        dtPGN = PGN_ETP_DT if extended else PGN_TP_DT
+        self._cmID = IBSID(da, sa, cmPGN, prio=6).GetCANID()
+        self._dtID = IBSID(da, sa, dtPGN, prio=7).GetCANID()
+        self._key = (cmPGN, da, sa, None)
+        self._pgnBytes = [pgn & 0xFF, (pgn >> 8) & 0xFF, (pgn >> 16) & 0xFF]
+
+        controls = (ETP_CTS, ETP_EOMA, TP_ABORT) if extended else (TP_CTS, TP_EOMA, TP_ABORT)
+        pgnBytes = self._pgnBytes
+        self._match = lambda data: (data[0] in controls
+                                    and data[5] == pgnBytes[0]
+                                    and data[6] == pgnBytes[1]
+                                    and data[7] == pgnBytes[2])
+
+    def Run(self):
+        """ Returns True when the receiver acknowledged the whole message """
+        size = len(self.data)
+        log.debug('({0}) Sending PGN {1:04X} : {2} bytes in {3} packets'.format(
+            self.name, self.pgn, size, self.packets))
+        if self.extended:
+            rts = ([ETP_RTS, size & 0xFF, (size >> 8) & 0xFF, (size >> 16) & 0xFF,
+                    (size >> 24) & 0xFF] + self._pgnBytes)
+        else:
+            rts = ([TP_RTS, size & 0xFF, (size >> 8) & 0xFF, self.packets, RESERVED]
+                   + self._pgnBytes)
+
+        future = self.interface._AddWaiter(self._key, self._match)
+        self.interface._SendCANMessage(self._cmID, rts)
+        timeout = TP_T3
+
+        while True:
+            received, cm = self.interface._WaitForFuture(self._key, future, timeout)
+            if not received:
+                log.warning('({0}) Timeout waiting for CTS/EoMA'.format(self.name))
+                self._Abort(ABORT_TIMEOUT)
+                return False
+
+            control = cm[0]
+            if control == TP_EOMA or control == ETP_EOMA:
+                if self.progress is not None:
+                    self.progress(self.packets)
+                log.debug('({0}) Received EoMA, {1} retransmitted packets'.format(
+                    self.name, self.retransmits))
+                return True
+            elif control == TP_ABORT:
+                log.warning('({0}) Receiver aborted, reason {1}'.format(self.name, cm[1]))
+                return False
+
+            nPackets = cm[1]
+            if self.extended:
+                nextPacket = cm[2] | (cm[3] << 8) | (cm[4] << 16)
+            else:
+                nextPacket = cm[2]
+
+            if self.progress is not None and nextPacket > 0:
+                self.progress(nextPacket - 1)
+
+            future = self.interface._AddWaiter(self._key, self._match)
+            if nPackets == 0:
+                # Hold, the receiver sends a new CTS when it is ready
+                log.debug('({0}) Receiver holds the connection'.format(self.name))
+                timeout = TP_T4
+                continue
+
+            if nextPacket < 1 or nextPacket > self.packets:
+                log.warning('({0}) CTS for packet {1} of {2}'.format(
+                    self.name, nextPacket, self.packets))
+                self.interface._RemoveWaiter(self._key, future)
+                self._Abort(ABORT_CTS_SIZE if self.extended else ABORT_BAD_SEQ)
+                return False
+
+            nPackets = min(nPackets, self.packets - nextPacket + 1)
+            if not self._SendWindow(nextPacket, nPackets):
+                log.warning('({0}) Could not send packet, aborting'.format(self.name))
+                self.interface._RemoveWaiter(self._key, future)
+                self._Abort(ABORT_RESOURCES)
+                return False
+            timeout = TP_T3
+
+    def _SendWindow(self, nextPacket, nPackets):
+        """ Returns False as soon as a packet can not be sent """
+        if nextPacket <= self.highestSent:
+            resent = min(self.highestSent, nextPacket + nPackets - 1) - nextPacket + 1
+            self.retransmits += resent
+            log.debug('({0}) Retransmitting {1} packets from {2}'.format(
+                self.name, resent, nextPacket))
+
+        packetOffset = nextPacket - 1
+        if self.extended:
+            dpo = ([ETP_DPO, nPackets, packetOffset & 0xFF, (packetOffset >> 8) & 0xFF,
+                    (packetOffset >> 16) & 0xFF] + self._pgnBytes)
+            self.interface._SendCANMessage(self._cmID, dpo)
+        for n in range(nPackets):
+            sequence = n + 1 if self.extended else nextPacket + n
+            if not self.interface._SendCANFrame(self._dtID,
+                                                self.data.PacketFrame(sequence, packetOffset + n)):
+                return False
+            self.highestSent = max(self.highestSent, packetOffset + n + 1)
+        return True
+
+    def _Abort(self, reason):
+        self.interface._SendCANMessage(
+                self._cmID, [TP_ABORT, reason, RESERVED, RESERVED, RESERVED] + self._pgnBytes)
+
+
+class IBSTPReceiver(IBSRxHandler):
+    """ Receives TP (RTS/CTS and BAM) and ETP sessions for any number of
+    source addresses concurrently. Complete messages are dispatched through the
+    interface as if they were received in a single frame.
+    Only RTS sessions to one of the interface's local addresses are answered,
+    timed out sessions are swept every T1/3 from the interface's scheduler.
+    A passive receiver never sends anything, it follows all sessions on the
+    bus, e.g. to decode a recorded log. It has no timer, whoever feeds it
+    calls Expire with the time of the messages (_Now)
+    """
+
+    def __init__(self, interface, windowSize=16, etpWindowSize=255, passive=False):
+        IBSRxHandler.__init__(self, [PGN_TP_CM, PGN_TP_DT, PGN_ETP_CM, PGN_ETP_DT])
+        self.interface = interface
+        self.windowSize = windowSize
+        self.etpWindowSize = etpWindowSize
+        self.passive = passive
+        self._sessions = dict() # (extended, sa, da) -> IBSRxSession
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def RxMessage(self, ibsid, data):
+        if len(data) < 8:
+            return
+
+        if ibsid.pgn == PGN_TP_DT or ibsid.pgn == PGN_ETP_DT:
+            complete = self._RxData(ibsid.pgn == PGN_ETP_DT, ibsid, data)
+        else:
+            complete = self._RxConnectionManagement(ibsid.pgn == PGN_ETP_CM, ibsid, data)
+
+        if complete is not None:
+            del complete.buffer[complete.size:]
+            log.debug('(TP) Received PGN {pgn:04X} from {sa:02X}: {n} bytes'.format(
+                pgn=complete.pgn, sa=complete.sa, n=complete.size))
+            self._SessionMetrics(complete, True)
+            self._Deliver(IBSID(complete.da, complete.sa, complete.pgn), complete.buffer)
+
+    def _SessionMetrics(self, session, ok):
+        metrics = self.interface.metrics if not self.passive else None
+        if metrics is not None:
+            protocol = 'etp' if session.extended else (
+                    'bam' if session.da == SA_GLOBAL else 'tp')
+            metrics.Session(protocol, 'rx', self._Now() - session.started, ok,
+                            session.retransmits)
+
+    def _Deliver(self, ibsid, data):
+        self.interface._DispatchIBSMessage(ibsid, data)
+
+    def _Now(self):
+        # Monotonic like the interface's scheduler, so a clock change can not
+        # fire or hold back the T1 - T4 timeouts
+        return time.monotonic()
+
+    def ActiveSessions(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _RxConnectionManagement(self, extended, ibsid, data):
+        control = data[0]
+        key = (extended, ibsid.sa, ibsid.da)
+        complete = None
+
+        with self._lock:
+            if control == TP_BAM and not extended and ibsid.da == SA_GLOBAL:
+                size = data[1] | (data[2] << 8)
+                session = IBSRxSession(False, _PGNFromCM(data), ibsid.sa, ibsid.da,
+                                       size, data[3], self._Now())
+                session.windowEnd = session.packets
+                session.deadline = session.started + TP_T1
+                self._sessions[key] = session
+
+            elif control in (TP_RTS, ETP_RTS) and self.passive:
+                if extended:
+                    size = data[1] | (data[2] << 8) | (data[3] << 16) | (data[4] << 24)
+                else:
+                    size = data[1] | (data[2] << 8)
+                session = IBSRxSession(extended, _PGNFromCM(data), ibsid.sa, ibsid.da,
+                                       size, int(math.ceil(size / 7.0)), self._Now())
+                # The windows are set by the CTS of the real receiver
+                session.windowEnd = session.packets
+                session.deadline = session.started + TP_T2
+                self._sessions[key] = session
+
+            elif control in (TP_CTS, ETP_CTS) and self.passive:
+                # From the receiver of a session we follow, which continues it
+                session = self._sessions.get((extended, ibsid.da, ibsid.sa))
+                if session is not None:
+                    session.deadline = self._Now() + (TP_T4 if data[1] == 0 else TP_T2)
+
+            elif (control == TP_ABORT and self.passive
+                    and (extended, ibsid.da, ibsid.sa) in self._sessions):
+                # Aborted by the receiver
+                del self._sessions[(extended, ibsid.da, ibsid.sa)]
+
+            elif control in (TP_RTS, ETP_RTS) and ibsid.da in self.interface.localAddresses:
+                if extended:
+                    size = data[1] | (data[2] << 8) | (data[3] << 16) | (data[4] << 24)
+                else:
+                    size = data[1] | (data[2] << 8)
+                packets = int(math.ceil(size / 7.0))
+                if key in self._sessions:
+                    log.debug('(TP) New RTS from {0:02X} replaces running session'.format(ibsid.sa))
+                session = IBSRxSession(extended, _PGNFromCM(data), ibsid.sa, ibsid.da,
+                                       size, packets, self._Now())
+                self._sessions[key] = session
+                maxPackets = self.etpWindowSize if extended else min(self.windowSize, data[4])
+                self._SendCTS(session, maxPackets)
+
+            elif control == ETP_DPO and extended and key in self._sessions:
+                session = self._sessions[key]
+                session.offset = data[2] | (data[3] << 8) | (data[4] << 16)
+                session.deadline = self._Now() + TP_T1
+
+            elif control == TP_ABORT and key in self._sessions:
+                log.debug('(TP) Session from {0:02X} aborted, reason {1}'.format(
+                    ibsid.sa, data[1]))
+                self._SessionMetrics(self._sessions.pop(key), False)
+
+            # CTS and EoMA are for our own sending sessions, not handled here
+
+        self._ArmTimer()
+        return complete
+
+    def _RxData(self, extended, ibsid, data):
+        key = (extended, ibsid.sa, ibsid.da)
+        complete = None
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                return None
+
+            packet = data[0] + session.offset
+            if packet != session.nextPacket:
+                if self.passive and session.da != SA_GLOBAL:
+                    # Lost or repeated, the real receiver will ask for it again
+                    pass
+                elif packet > session.nextPacket and session.da != SA_GLOBAL:
+                    # Lost a packet, ask again from the first missing one. The
+                    # rest of the window is ignored until it arrives, or the
+                    # session times out (T2)
+                    if session.resendFrom != session.nextPacket:
+                        log.debug('(TP) Expected packet {0}, got {1}'.format(
+                            session.nextPacket, packet))
+                        session.resendFrom = session.nextPacket
+                        session.retransmits += session.windowEnd - session.nextPacket + 1
+                        self._SendCTS(session, session.windowEnd - session.nextPacket + 1)
+                elif packet > session.nextPacket:
+                    log.debug('(TP) BAM from {0:02X} lost packet {1}'.format(
+                        session.sa, session.nextPacket))
+                    del self._sessions[key]
+                    self._SessionMetrics(session, False)
+                return None
+
+            start = (packet - 1) * 7
+            session.buffer[start:start + 7] = data[1:8]
+            session.nextPacket += 1
+            session.resendFrom = 0
+            session.deadline = self._Now() + TP_T1
+
+            if packet >= session.packets:
+                del self._sessions[key]
+                if session.da != SA_GLOBAL and not self.passive:
+                    self._SendEoMA(session)
+                complete = session
+            elif packet >= session.windowEnd:
+                maxPackets = self.etpWindowSize if extended else self.windowSize
+                self._SendCTS(session, maxPackets)
+
+        return complete
+
+    def _SendCTS(self, session, maxPackets):
+        nPackets = max(1, min(maxPackets, session.packets - session.nextPacket + 1))
+        session.windowEnd = session.nextPacket + nPackets - 1
+        session.deadline = self._Now() + TP_T2
+        pgnBytes = [session.pgn & 0xFF, (session.pgn >> 8) & 0xFF, (session.pgn >> 16) & 0xFF]
+        if session.extended:
+            nextPacket = session.nextPacket
+            candata = ([ETP_CTS, nPackets,
+                        nextPacket & 0xFF, (nextPacket >> 8) & 0xFF, (nextPacket >> 16) & 0xFF]
+                       + pgnBytes)
+            self.interface._SendIBSMessage(PGN_ETP_CM, session.sa, session.da, candata)
+        else:
+            candata = [TP_CTS, nPackets, session.nextPacket, RESERVED, RESERVED] + pgnBytes
+            self.interface._SendIBSMessage(PGN_TP_CM, session.sa, session.da, candata)
+
+    def _SendEoMA(self, session):
+        size = session.size
+        pgnBytes = [session.pgn & 0xFF, (session.pgn >> 8) & 0xFF, (session.pgn >> 16) & 0xFF]
+        if session.extended:
+            candata = ([ETP_EOMA, size & 0xFF, (size >> 8) & 0xFF, (size >> 16) & 0xFF,
+                        (size >> 24) & 0xFF] + pgnBytes)
+            self.interface._SendIBSMessage(PGN_ETP_CM, session.sa, session.da, candata)
+        else:
+            candata = ([TP_EOMA, size & 0xFF, (size >> 8) & 0xFF, session.packets, RESERVED]
+                       + pgnBytes)
+            self.interface._SendIBSMessage(PGN_TP_CM, session.sa, session.da, candata)
+
+    def _SendAbort(self, session, reason):
+        pgnBytes = [session.pgn & 0xFF, (session.pgn >> 8) & 0xFF, (session.pgn >> 16) & 0xFF]
+        candata = [TP_ABORT, reason, RESERVED, RESERVED, RESERVED] + pgnBytes
+        pgn = PGN_ETP_CM if session.extended else PGN_TP_CM
+        self.interface._SendIBSMessage(pgn, session.sa, session.da, candata)
+
+    def _ArmTimer(self):
+        if self.passive:
+            return
+        with self._lock:
+            if self._timer is None and len(self._sessions) > 0:
+                self._timer = self.interface.scheduler.CallLater(TP_T1 / 3.0, self._Sweep)
+
+    def _Sweep(self):
+        with self._lock:
+            self._timer = None
+        self.Expire(self._Now())
+        self._ArmTimer()
+
+    def Expire(self, now):
+        """ Drop sessions which timed out at now, aborting the ones we were answering """
+        with self._lock:
+            for key, session in list(self._sessions.items()):
+                if now > session.deadline:
+                    log.debug('(TP) Session from {0:02X} for PGN {1:04X} timed out'.format(
+                        session.sa, session.pgn))
+                    del self._sessions[key]
+                    self._SessionMetrics(session, False)
+                    if session.da != SA_GLOBAL and not self.passive:
+                        self._SendAbort(session, ABORT_TIMEOUT)
@@ -0,0 +1,199 @@
+import asyncio
+
+from isobus.vt.client import VTClient
+from isobus.vt.client import OpenPoolData
+from isobus.vt.pool import NUMERIC_VALUE_TYPES
+from isobus.vt.pool import STRING_VALUE_TYPES
+from isobus.vt.pool import DiffPools
+from isobus.vt.shadow import SHADOW_VALUE
+from isobus.vt.shadow import SHADOW_ITEM
+from isobus.common import IBSException
+from isobus.common import NumericValue
+from isobus.log import log
+from isobus.cf import BuildISOBUSName
+
+
+class AsyncVTClient(VTClient):
+    """VT Client with coroutine commands, for driving several VTs and many
+    object updates from one asyncio event loop.
+    Every command sends the request and awaits the future for the matching
+    VT response, so nothing blocks the loop while waiting.
+    Every VTClient method which calls one of these commands is a coroutine
+    here too.
+    """
+
+    async def ClaimAddress(self, sa, ibsName, maxtime=3.0):
+        self.sa = await self._Response(self.StartAddressClaim(sa, ibsName),
+                                       "Address claim timed out", maxtime)
+
+    async def ConnectToVT(self, da):
+        self._InvalidateShadow()
+        try:
+            await self._Response(self.connection.ExpectStatusMessage(da))
+        except IBSException:
+            raise IBSException("Failed to connect to VT")
+
+        ibsName = BuildISOBUSName(functionInstance = self.functionInstance)
+        await self.ClaimAddress(self.sa, ibsName)
+        self.connection.SendWSMaintenance(True, self.sa, da)
+        await asyncio.sleep(0.5)
+        self.connection.StartWSMaintenace(self.sa, da)
+        self.alive = True
+        self.da = da
+        self._RegisterShadow()
+
+    async def LoadVersion(self, version):
+        self._CheckAlive()
+        self._InvalidateShadow()
+
+        log.debug('Loading version {0}...'.format(version))
+        data = await self._Response(
+                self.connection.SendLoadVersionCommand(version, self.sa, self.da))
+        if data[5] != 0:
+            raise IBSException("Did not load version, error code: {0}".format(data[5]))
+
+    async def StoreVersion(self, version):
+        self._CheckAlive()
+        log.debug('Storing version {0}'.format(version))
+
+        data = await self._Response(
+                self.connection.SendStoreVersioncommand(version, self.da, self.sa))
+        if data[5] != 0:
+            raise IBSException("Did not store version, error code: {0}".format(data[5]))
+
+    async def UploadPoolData(self, data, eoop=True):
+        self._CheckAlive()
+        self._InvalidateShadow()
+
+        memData = await self._Response(
+                self.connection.SendGetMemory(len(data), self.da, self.sa),
+                "No Get Memory Response received")
+        if memData[2] == 0x01:
+            raise IBSException('Not enough memory available')
+
+        # The (E)TP transfer itself is flow controlled by the VT, run it in
+        # an executor so the loop keeps serving other VTs meanwhile
+        loop = asyncio.get_running_loop()
+        transferred = await loop.run_in_executor(
+                None, self.connection.SendPoolUpload, self.da, self.sa, data)
+        if not transferred:
+            raise IBSException('Object pool transfer failed')
+
+        if eoop:
+            eoopData = await self._Response(
+                    self.connection.SendEndOfObjectPool(self.da, self.sa),
+                    "EoOP Response timed out", 5.0)
+            if eoopData[1] != 0:
+                raise IBSException("Received error code {0}".format(eoopData[1]))
+
+    async def UploadPoolFile(self, source, eoop=True):
+        with OpenPoolData(source) as data:
+            await self.UploadPoolData(data, eoop)
+
+    async def UploadPoolDelta(self, old, new, eoop=False):
+        delta, removed = DiffPools(old, new)
+        if removed:
+            log.warning('Objects {0} can not be removed by a pool update'.format(
+                ', '.join('0x{0:04X}'.format(objid) for objid in removed)))
+        if len(delta) > 0:
+            await self.UploadPoolData(delta, eoop)
+        self.SetObjectPool(new)
+        return removed
+
+    async def DeleteObjectPool(self):
+        self._CheckAlive()
+        self._InvalidateShadow()
+
+        data = await self._Response(
+                self.connection.SendDeleteObjectPool(self.da, self.sa), "Response timed out")
+        if data[1] != 0:
+            raise IBSException("Got error: {0}".format(data[1]))
+
+    async def ChangeActiveMask(self, wsid, maskid):
+        self._CheckAlive()
+
+        data = await self._Response(
+                self.connection.SendChangeActiveMask(wsid, maskid, self.sa, self.da))
+        if data[3] != 0:
+            raise IBSException("Error change active mask, error code: {0}".format(data[3]))
+        newMaskID = NumericValue.FromLEBytes(data[1:3]).Value()
+        log.debug("New active mask = 0X{:04X}".format(newMaskID))
+        return newMaskID
+
+    async def ChangeSKMask(self, maskid, skmaskid, alarm=False):
+        self._CheckAlive()
+
+        data = await self._Response(
+                self.connection.SendChangeSKMask(maskid, skmaskid, alarm, self.da, self.sa))
+        if data[5] != 0:
+            raise IBSException("Error change active mask, error code: {0}".format(data[5]))
+        return NumericValue.FromLEBytes(data[3:5]).Value()
+
+    async def ChangeAttribute(self, objid, attrid, value):
+        self._CheckAlive()
+        self._CheckObject(objid)
+        if self._Suppress((objid, attrid), value):
+            return
+
+        data = await self._Response(
+                self.connection.SendChangeAttribute(objid, attrid, value, self.da, self.sa))
+        if data[4] != 0:
+            raise IBSException("Error change attribute, error code: {0}".format(data[4]))
+        self._Acknowledge((objid, attrid), value)
+
+    async def ChangeNumericValue(self, objid, value):
+        self._CheckAlive()
+        self._CheckObject(objid, NUMERIC_VALUE_TYPES)
+        if self._Suppress((objid, SHADOW_VALUE), value):
+            return
+
+        data = await self._Response(
+                self.connection.SendChangeNumericValue(objid, value, vtsa = self.da, ecusa = self.sa))
+        if data[3] != 0:
+            raise IBSException("Error change numeric value, error code: {0}".format(data[3]))
+        self._Acknowledge((objid, SHADOW_VALUE), value)
+
+    async def ChangeStringValue(self, objid, value):
+        self._CheckAlive()
+        self._CheckObject(objid, STRING_VALUE_TYPES)
+        if self._Suppress((objid, SHADOW_VALUE), value):
+            return
+
+        data = await self._Response(
+                self.connection.SendChangeStringValue(objid, value, vtsa = self.da, ecusa = self.sa))
+        if data[5] != 0:
+            raise IBSException("Error change string value, error code: {0}".format(data[5]))
+        self._Acknowledge((objid, SHADOW_VALUE), value)
+
+    async def ChangeListItem(self, objid, index, value):
+        self._CheckAlive()
+        self._CheckObject(objid)
+        if self._Suppress((objid, (SHADOW_ITEM, index)), value):
+            return
+
+        data = await self._Response(
+                self.connection.SendChangeListItemCommand(self.da, self.sa, objid, index, value))
+        if data[6] != 0:
+            raise IBSException("Error change list item, error code: {0}".format(data[6]))
+        self._Acknowledge((objid, (SHADOW_ITEM, index)), value)
+
+    async def ESCInput(self):
+        self._CheckAlive()
+
+        data = await self._Response(self.connection.SendEscCommand(self.da, self.sa))
+        if data[3] == 1:
+            raise IBSException("No input object open")
+        elif data[3] != 0:
+            raise IBSException("Error code: {0}".format(data[3]))
+        return NumericValue.FromLEBytes(data[1:3]).Value()
+
+    async def _Response(self, future, timeoutMessage="No response received", maxtime=3.0):
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), maxtime)
+        except asyncio.TimeoutError:
+            raise IBSException(timeoutMessage)
+        finally:
+            # A timeout (or cancelled task) cancels the future, but its waiter
+            # stays in the interface's routing table until removed
+            if future.cancelled():
+                self.connection._RemoveWaiter(None, future)
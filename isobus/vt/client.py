@@ -1,28 +1,90 @@
+import io
+import mmap
 import time
+import contextlib
 from isobus.vt.interface import IBSVTInterface
+from isobus.vt.pipeline import VTCommandPipeline
+from isobus.vt.updater import VTValueUpdater
+from isobus.vt.upload import VTPoolUploadSession
+from isobus.vt.pool import NUMERIC_VALUE_TYPES
+from isobus.vt.pool import STRING_VALUE_TYPES
+from isobus.vt.pool import OBJECT_TYPES
+from isobus.vt.pool import DiffPools
+from isobus.vt.shadow import VTShadowCache
+from isobus.vt.shadow import SHADOW_VALUE
+from isobus.vt.shadow import SHADOW_ITEM
 from isobus.common import IBSException
+from isobus.common import IBSMessageData
 from isobus.log import log
-from isobus.ibsinterface import IBSRxHandler
 from isobus.cf import IBSControlFunction
 from isobus.cf import BuildISOBUSName
 
+@contextlib.contextmanager
+def OpenPoolData(source):
+    """ Memory map an object pool file (path or file object) and yield it as
+    IBSMessageData, so it is streamed from the mapping instead of read into memory
+    """
+    ownsFile = not hasattr(source, 'read')
+    poolfile = open(source, 'rb') if ownsFile else source
+    mapping = None
+    try:
+        try:
+            mapping = mmap.mmap(poolfile.fileno(), 0, access=mmap.ACCESS_READ)
+            data = IBSMessageData(mapping)
+        except (AttributeError, io.UnsupportedOperation):
+            # Not backed by a real file, e.g. BytesIO
+            data = IBSMessageData(poolfile.read())
+        except ValueError:
+            raise IBSException('Object pool file is empty')
+        try:
+            yield data
+        finally:
+            data.Release()
+    finally:
+        if mapping is not None:
+            mapping.close()
+        if ownsFile:
+            poolfile.close()
+
+
 class VTClient(IBSControlFunction):
     """VT Client (implement) simulation"""
     
     # Return True or False on commands based on success
 
-    def __init__(self, interface, channel) :
-        self.connection = IBSVTInterface(interface, channel)
-        self.sa = 0xFE
+    connectionClass = IBSVTInterface
+
+    def __init__(self, interface, channel, shared=False) :
+        IBSControlFunction.__init__(self, interface, channel, shared)
         self.da = 0xFF
         self.alive = False
-        self.functionInstance = 0x00
+        self.pool = None
+        self.shadow = None
 
     def SetSrc(self, sa):
         if sa >= 0 and sa <= 0xFE:
             self.sa = sa
+            self._RegisterShadow()
+
+    def SetObjectPool(self, pool):
+        """ Check object IDs of commands against pool (a VTObjectPool) before
+        sending them, None disables the check
+        """
+        self.pool = pool
+
+    def EnableShadowCache(self, enable=True):
+        """ Skip Change* commands which would write the value the VT already
+        acknowledged. The cache is cleared when the pool is (re)loaded or deleted
+        """
+        if enable and self.shadow is None:
+            self.shadow = VTShadowCache(self.da, self.sa)
+            self.connection.AddRxHandler(self.shadow)
+        elif not enable and self.shadow is not None:
+            self.connection.RemoveRxHandler(self.shadow)
+            self.shadow = None
 
     def ConnectToVT(self, da):
+        self._InvalidateShadow()
         gotStatus, _ = self.connection.WaitForStatusMessage(da)
         ibsName = BuildISOBUSName(functionInstance = self.functionInstance)
         if gotStatus:
@@ -32,17 +94,19 @@ class VTClient(IBSControlFunction):
             self.connection.StartWSMaintenace(self.sa, da)
             self.alive = True
             self.da = da
+            self._RegisterShadow()
         else:
             raise IBSException("Failed to connect to VT")
 
     def LoadVersion(self, version):
         self._CheckAlive()
+        self._InvalidateShadow()
 
-        self.connection.SendLoadVersionCommand(version, self.sa, self.da)
+        future = self.connection.SendLoadVersionCommand(version, self.sa, self.da)
         log.debug('Loading version {0}...'.format(version))
         
         # TODO wait for load version response max 3 status messages w/parsing = 0
-        [receivedResponse, error] = self.connection.WaitLoadVersionResponse(self.da, self.sa)
+        [receivedResponse, error] = self.connection.WaitLoadVersionResponse(self.da, self.sa, future)
         if receivedResponse and (error == 0):
             pass
         else:
@@ -52,10 +116,10 @@ class VTClient(IBSControlFunction):
         self._CheckAlive()
         log.debug('Storing version {0}'.format(version))
 
-        self.connection.SendStoreVersioncommand(version, self.da, self.sa)
+        future = self.connection.SendStoreVersioncommand(version, self.da, self.sa)
         
         # TODO wait for load version response max 3 status messages w/parsing = 0
-        [receivedResponse, error] = self.connection.WaitStoreVersionResponse(self.da, self.sa)
+        [receivedResponse, error] = self.connection.WaitStoreVersionResponse(self.da, self.sa, future)
         if receivedResponse and (error == 0):
             pass
         else:
@@ -64,19 +128,21 @@ class VTClient(IBSControlFunction):
 
     def UploadPoolData(self, data, eoop=True):
         self._CheckAlive()
+        self._InvalidateShadow()
 
-        self.connection.SendGetMemory(len(data), self.da, self.sa)
+        future = self.connection.SendGetMemory(len(data), self.da, self.sa)
         [receivedMemResp, version, enoughMemory] = self.connection.WaitForGetMemoryResponse(
-                self.da, self.sa)
+                self.da, self.sa, future)
 
         if receivedMemResp and enoughMemory:
 
-            self.connection.SendPoolUpload(self.da, self.sa, data)
+            if not self.connection.SendPoolUpload(self.da, self.sa, data):
+                raise IBSException('Object pool transfer failed')
 
             if eoop:
-                self.connection.SendEndOfObjectPool(self.da, self.sa)
+                future = self.connection.SendEndOfObjectPool(self.da, self.sa)
                 [received, error] = self.connection.WaitEndOfObjectPoolResponse(
-                        self.da, self.sa)
+                        self.da, self.sa, future)
                 if received and error == 0:
                     pass
                 elif received:
@@ -90,14 +156,42 @@ class VTClient(IBSControlFunction):
 
 
 
+    def UploadPoolFile(self, source, eoop=True):
+        """ Upload an object pool from a file path or file object, the file is
+        memory mapped so memory use does not grow with the pool size
+        """
+        with OpenPoolData(source) as data:
+            self.UploadPoolData(data, eoop)
+
+    def UploadPoolDelta(self, old, new, eoop=False):
+        """ Upload only the objects of new (a VTObjectPool) which were added or
+        changed compared to old, the pool which is on the VT. Returns the IDs of
+        objects which are only in old, these stay on the VT
+        """
+        delta, removed = DiffPools(old, new)
+        if removed:
+            log.warning('Objects {0} can not be removed by a pool update'.format(
+                ', '.join('0x{0:04X}'.format(objid) for objid in removed)))
+        if len(delta) > 0:
+            self.UploadPoolData(delta, eoop)
+        self.SetObjectPool(new)
+        return removed
+
+    def UploadSession(self, data, boundaries=None, segmentSize=64 * 1024):
+        """ Returns a VTPoolUploadSession for data, which can be resumed after a
+        failed transfer without sending the acknowledged segments again
+        """
+        return VTPoolUploadSession(self, data, boundaries, segmentSize)
+
     def DeleteObjectPool(self):
         self._CheckAlive()
+        self._InvalidateShadow()
 
-        self.connection.SendDeleteObjectPool(self.da, self.sa)
+        future = self.connection.SendDeleteObjectPool(self.da, self.sa)
 
         # TODO wait for load version response max 3 status messages w/parsing = 0
         [receivedResponse, error] = self.connection.WaitDeleteObjectPoolResponse(
-                self.da, self.sa)
+                self.da, self.sa, future)
         if receivedResponse and (error == 0):
             pass
         elif receivedResponse:
@@ -110,10 +204,10 @@ class VTClient(IBSControlFunction):
     def ChangeActiveMask(self, wsid, maskid):
         self._CheckAlive()
 
-        self.connection.SendChangeActiveMask(wsid, maskid, self.sa, self.da)
+        future = self.connection.SendChangeActiveMask(wsid, maskid, self.sa, self.da)
 
         [receivedResponse, newMaskID, error] = (
-                self.connection.WaitForChangeActiveMaskResponse(self.da, self.sa))
+                self.connection.WaitForChangeActiveMaskResponse(self.da, self.sa, future))
 
         if receivedResponse and (error == 0):
             log.debug("New active mask = 0X{:04X}".format(newMaskID))
@@ -127,10 +221,10 @@ class VTClient(IBSControlFunction):
     def ChangeSKMask(self, maskid, skmaskid, alarm=False):
         self._CheckAlive()
 
-        self.connection.SendChangeSKMask(maskid, skmaskid, alarm, self.da, self.sa)
+        future = self.connection.SendChangeSKMask(maskid, skmaskid, alarm, self.da, self.sa)
 
         [receivedResponse, error, newSKMaskID] = (
-                self.connection.WaitForChangeSKMaskResponse(self.da, self.sa))
+                self.connection.WaitForChangeSKMaskResponse(self.da, self.sa, future))
         if receivedResponse and (error == 0):
             return newSKMaskID
         elif receivedResponse:
@@ -141,14 +235,17 @@ class VTClient(IBSControlFunction):
 
     def ChangeAttribute(self, objid, attrid, value):
         self._CheckAlive()
+        self._CheckObject(objid)
+        if self._Suppress((objid, attrid), value):
+            return
 
-        self.connection.SendChangeAttribute(objid, attrid, value, self.da, self.sa)
+        future = self.connection.SendChangeAttribute(objid, attrid, value, self.da, self.sa)
 
         [receivedResponse, error] = (
-                self.connection.WaitChangeAttributeResponse(self.da, self.sa))
+                self.connection.WaitChangeAttributeResponse(self.da, self.sa, future))
 
         if receivedResponse and (error == 0):
-            pass
+            self._Acknowledge((objid, attrid), value)
         elif receivedResponse:
             raise IBSException("Error change attribute, error code: {0}".format(error))
         else:
@@ -157,13 +254,16 @@ class VTClient(IBSControlFunction):
 
     def ChangeNumericValue(self, objid, value):
         self._CheckAlive()
+        self._CheckObject(objid, NUMERIC_VALUE_TYPES)
+        if self._Suppress((objid, SHADOW_VALUE), value):
+            return
 
-        self.connection.SendChangeNumericValue(objid, value, vtsa = self.da, ecusa = self.sa)
+        future = self.connection.SendChangeNumericValue(objid, value, vtsa = self.da, ecusa = self.sa)
         [receivedResponse, error] = (
-                self.connection.WaitForChangeNumericValueResponse(self.da, self.sa))
+                self.connection.WaitForChangeNumericValueResponse(self.da, self.sa, future))
 
         if receivedResponse and (error == 0):
-            pass
+            self._Acknowledge((objid, SHADOW_VALUE), value)
         elif receivedResponse:
             raise IBSException("Error change numeric value, error code: {0}".format(error))
         else:
@@ -171,13 +271,16 @@ class VTClient(IBSControlFunction):
 
     def ChangeStringValue(self, objid, value):
         self._CheckAlive()
+        self._CheckObject(objid, STRING_VALUE_TYPES)
+        if self._Suppress((objid, SHADOW_VALUE), value):
+            return
     
-        self.connection.SendChangeStringValue(objid, value, vtsa = self.da, ecusa = self.sa)
+        future = self.connection.SendChangeStringValue(objid, value, vtsa = self.da, ecusa = self.sa)
         [receivedResponse, error] = (
-                self.connection.WaitForChangeStringValueResponse(self.da, self.sa))
+                self.connection.WaitForChangeStringValueResponse(self.da, self.sa, future))
 
         if receivedResponse and (error == 0):
-            pass
+            self._Acknowledge((objid, SHADOW_VALUE), value)
         elif receivedResponse:
             raise IBSException("Error change string value, error code: {0}".format(error))
         else:
@@ -185,13 +288,16 @@ class VTClient(IBSControlFunction):
 
     def ChangeListItem(self, objid, index, value):
         self._CheckAlive()
+        self._CheckObject(objid)
+        if self._Suppress((objid, (SHADOW_ITEM, index)), value):
+            return
 
-        self.connection.SendChangeListItemCommand(self.da, self.sa, objid, index, value)
+        future = self.connection.SendChangeListItemCommand(self.da, self.sa, objid, index, value)
         [receivedResponse, error] = (
-                self.connection.WaitForChangeListItemResponse(self.da, self.sa))
+                self.connection.WaitForChangeListItemResponse(self.da, self.sa, future))
 
         if receivedResponse and (error == 0):
-            pass
+            self._Acknowledge((objid, (SHADOW_ITEM, index)), value)
         elif receivedResponse:
             raise IBSException("Error change list item, error code: {0}".format(error))
         else:
@@ -199,13 +305,28 @@ class VTClient(IBSControlFunction):
 
 
 
+    def Pipeline(self, depth=8):
+        """ Returns a VTCommandPipeline which keeps up to depth Change*
+        commands in flight instead of waiting for every response
+        """
+        self._CheckAlive()
+        return VTCommandPipeline(self, depth)
+
+    def Updater(self, rate=10.0, batch=None, maxPending=1024):
+        """ Returns a VTValueUpdater which sends only the latest numeric value
+        per object, rate times per second. Call Stop (or use it as a context
+        manager) when done
+        """
+        self._CheckAlive()
+        return VTValueUpdater(self, rate, batch, maxPending)
+
     def ESCInput(self):
         self._CheckAlive()
     
-        self.connection.SendEscCommand(self.da, self.sa)
+        future = self.connection.SendEscCommand(self.da, self.sa)
 
         [receivedResponse, error, escObject] = (
-        self.connection.WaitForESCResponse(self.da, self.sa))
+        self.connection.WaitForESCResponse(self.da, self.sa, future))
         
         if receivedResponse and (error == 0):
             return escObject
@@ -221,9 +342,51 @@ class VTClient(IBSControlFunction):
             self.connection.StopWSMaintenance(self.sa, self.da)
             self.alive = False
 
+    def Close(self):
+        """ Disconnect, then release the address and the connection """
+        if self.connection is not None:
+            self.DisconnectFromVT()
+            self.EnableShadowCache(False)
+        IBSControlFunction.Close(self)
+
     def IdentifyVTs(self):
         self.connection.SendIdentifyVT(self.sa)
 
     def _CheckAlive(self):
         if not self.alive:
             raise IBSException('Not connected to a VT')
+
+    def _CheckObject(self, objid, types=None):
+        if self.pool is None:
+            return
+        objtype = self.pool.ObjectType(objid)
+        if objtype is None:
+            raise IBSException('Invalid object ID 0x{0:04X}'.format(objid))
+        elif types is not None and objtype not in types:
+            raise IBSException('Object 0x{0:04X} ({1}) has no such value'.format(
+                objid, OBJECT_TYPES[objtype][0]))
+
+    def _Suppress(self, key, value):
+        return self.shadow is not None and self.shadow.Suppress(key, value)
+
+    def _Acknowledge(self, key, value):
+        if self.shadow is not None:
+            self.shadow.Store(key, value)
+
+    def _AddressChanged(self, sa):
+        IBSControlFunction._AddressChanged(self, sa)
+        self._RegisterShadow()
+
+    def _RegisterShadow(self):
+        """ Route the messages of the current VT session to the shadow cache """
+        shadow = self.shadow
+        if shadow is None or (shadow.sa, shadow.da) == (self.da, self.sa):
+            return
+        self.connection.RemoveRxHandler(shadow)
+        shadow.sa = self.da
+        shadow.da = self.sa
+        self.connection.AddRxHandler(shadow)
+
+    def _InvalidateShadow(self):
+        if self.shadow is not None:
+            self.shadow.Clear()
@@ -0,0 +1,143 @@
+import struct
+
+# ECU to VT command frames, one precompiled struct per function code.
+# Unused bytes are reserved and sent as 0xFF.
+# Every frame is a new bytes object: can.Message keeps a bytearray by
+# reference, so a reused buffer would change frames still queued by the bus
+# or by a TP session, and pack is faster than pack_into for 8 bytes anyway
+_RESERVED2 = b'\xFF' * 2
+_RESERVED3 = b'\xFF' * 3
+
+_CHANGE_ACTIVE_MASK   = struct.Struct('<BHH3s')
+_CHANGE_SK_MASK       = struct.Struct('<BBHH2s')
+_CHANGE_ATTRIBUTE     = struct.Struct('<BHBI')
+_CHANGE_NUMERIC_VALUE = struct.Struct('<BHBI')
+_CHANGE_STRING_HEADER = struct.Struct('<BHH')
+_CHANGE_LIST_ITEM     = struct.Struct('<BHBH2s')
+_GET_MEMORY           = struct.Struct('<BBI2s')
+_VERSION              = struct.Struct('<B7s')
+
+ESC_FRAME                 = b'\x92' + b'\xFF' * 7
+END_OF_OBJECT_POOL_FRAME  = b'\x12' + b'\xFF' * 7
+DELETE_OBJECT_POOL_FRAME  = b'\xB2' + b'\xFF' * 7
+IDENTIFY_VT_FRAME         = b'\xBB' + b'\xFF' * 7
+WS_MAINTENANCE_FRAME      = b'\xFF\x00\x03' + b'\xFF' * 5
+WS_MAINTENANCE_INIT_FRAME = b'\xFF\x01\x03' + b'\xFF' * 5
+
+
+def ChangeActiveMaskFrame(wsid, maskid):
+    return _CHANGE_ACTIVE_MASK.pack(0xAD, wsid, maskid, _RESERVED3)
+
+def ChangeSKMaskFrame(maskid, skmaskid, alarm):
+    return _CHANGE_SK_MASK.pack(0xAE, 0x02 if alarm else 0x01, maskid, skmaskid, _RESERVED2)
+
+def ChangeAttributeFrame(objid, attrid, value):
+    return _CHANGE_ATTRIBUTE.pack(0xAF, objid, attrid & 0xFF, value & 0xFFFFFFFF)
+
+def ChangeNumericValueFrame(objid, value):
+    return _CHANGE_NUMERIC_VALUE.pack(0xA8, objid, 0xFF, value & 0xFFFFFFFF)
+
+def ChangeStringValueFrame(objid, value):
+    if isinstance(value, str):
+        value = value.encode('latin-1')
+    # At least a full frame, shorter strings are padded
+    return _CHANGE_STRING_HEADER.pack(0xB3, objid, len(value)) + value.ljust(3, b'\xFF')
+
+def ChangeListItemFrame(objid, index, newid):
+    return _CHANGE_LIST_ITEM.pack(0xB1, objid, index & 0xFF, newid, _RESERVED2)
+
+def GetMemoryFrame(memRequired):
+    return _GET_MEMORY.pack(0xC0, 0xFF, memRequired, _RESERVED2)
+
+def LoadVersionFrame(version):
+    return _VERSION.pack(0xD1, version.encode('latin-1'))
+
+def StoreVersionFrame(version):
+    return _VERSION.pack(0xD0, version.encode('latin-1'))
+
+
+# Names of VT function codes (first data byte) in both directions
+VT_FUNCTIONS = {
+    0x00 : 'SoftKeyActivation',
+    0x01 : 'ButtonActivation',
+    0x02 : 'PointingEvent',
+    0x03 : 'VTSelectInputObject',
+    0x04 : 'VTESC',
+    0x05 : 'VTChangeNumericValue',
+    0x06 : 'VTChangeActiveMask',
+    0x07 : 'VTChangeSoftKeyMask',
+    0x08 : 'VTChangeStringValue',
+    0x11 : 'ObjectPoolTransfer',
+    0x12 : 'EndOfObjectPool',
+    0x92 : 'ESC',
+    0xA8 : 'ChangeNumericValue',
+    0xAD : 'ChangeActiveMask',
+    0xAE : 'ChangeSoftKeyMask',
+    0xAF : 'ChangeAttribute',
+    0xB1 : 'ChangeListItem',
+    0xB2 : 'DeleteObjectPool',
+    0xB3 : 'ChangeStringValue',
+    0xBB : 'IdentifyVT',
+    0xC0 : 'GetMemory',
+    0xD0 : 'StoreVersion',
+    0xD1 : 'LoadVersion',
+    0xFE : 'VTStatus',
+    0xFF : 'WorkingSetMaintenance',
+}
+
+# Field layouts per function code, (struct, field names) with None for the
+# function code and reserved bytes
+_ECU2VT_FIELDS = {
+    0xA8 : (_CHANGE_NUMERIC_VALUE, (None, 'objectID', None, 'value')),
+    0xAD : (struct.Struct('<BHH'), (None, 'workingSetID', 'maskID')),
+    0xAE : (struct.Struct('<BBHH'), (None, 'maskType', 'maskID', 'softKeyMaskID')),
+    0xAF : (_CHANGE_ATTRIBUTE, (None, 'objectID', 'attributeID', 'value')),
+    0xB1 : (struct.Struct('<BHBH'), (None, 'objectID', 'index', 'newObjectID')),
+    0xB3 : (_CHANGE_STRING_HEADER, (None, 'objectID', 'length')),
+    0xC0 : (struct.Struct('<BBI'), (None, None, 'memoryRequired')),
+    0xD0 : (_VERSION, (None, 'version')),
+    0xD1 : (_VERSION, (None, 'version')),
+    0xFF : (struct.Struct('<BBB'), (None, 'initiating', 'version')),
+}
+
+_VT2ECU_FIELDS = {
+    0x05 : (struct.Struct('<BHBI'), (None, 'objectID', None, 'value')),
+    0x08 : (struct.Struct('<BHB'), (None, 'objectID', 'length')),
+    0x12 : (struct.Struct('<BB'), (None, 'error')),
+    0x92 : (struct.Struct('<BHB'), (None, 'objectID', 'error')),
+    0xA8 : (struct.Struct('<BHBI'), (None, 'objectID', 'error', 'value')),
+    0xAD : (struct.Struct('<BHB'), (None, 'maskID', 'error')),
+    0xAE : (struct.Struct('<BHHB'), (None, 'maskID', 'softKeyMaskID', 'error')),
+    0xAF : (struct.Struct('<BHBB'), (None, 'objectID', 'attributeID', 'error')),
+    0xB1 : (struct.Struct('<BHBHB'), (None, 'objectID', 'index', 'newObjectID', 'error')),
+    0xB2 : (struct.Struct('<BB'), (None, 'error')),
+    0xB3 : (struct.Struct('<BHHB'), (None, None, 'objectID', 'error')),
+    0xC0 : (struct.Struct('<BBB'), (None, 'version', 'notEnoughMemory')),
+    0xD0 : (struct.Struct('<B4xB'), (None, 'error')),
+    0xD1 : (struct.Struct('<B4xB'), (None, 'error')),
+    0xFE : (struct.Struct('<BBHHBB'), (None, 'workingSetMaster', 'maskID', 'softKeyMaskID',
+                                      'busyCodes', 'function')),
+}
+
+
+def DecodeVTMessage(toVT, data):
+    """ Decode VT message data (ECU to VT if toVT, else VT to ECU). Returns
+    (function name, dict of fields), fields is empty for unknown layouts and
+    the name None for unknown function codes
+    """
+    if len(data) == 0:
+        return None, {}
+    function = data[0]
+    layout = (_ECU2VT_FIELDS if toVT else _VT2ECU_FIELDS).get(function)
+    fields = dict()
+    if layout is not None and len(data) >= layout[0].size:
+        for name, value in zip(layout[1], layout[0].unpack_from(data)):
+            if name is not None:
+                fields[name] = value
+        if function == 0xB3 and toVT:
+            fields['value'] = bytes(data[5:5 + fields['length']])
+        elif function in (0xD0, 0xD1) and toVT:
+            fields['version'] = fields['version'].decode('latin-1')
+    elif function == 0x11 and toVT:
+        fields['length'] = len(data) - 1
+    return VT_FUNCTIONS.get(function), fields
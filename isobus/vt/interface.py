@@ -3,96 +3,99 @@ import logging
 from isobus.common import NumericValue
 from isobus.ibsinterface import IBSInterface
 from isobus.common import IBSID
+from isobus.common import IBSMessageData
 from isobus.constants import *
 from isobus.log import log
 from isobus.common import IBSException
+from isobus.vt.commands import *
+
+
+def _MatchObjectID(objid, offset, extra=None):
+    """ Returns a function which checks that a response is for objid (LE at
+    offset), and optionally that the byte after it equals extra
+    """
+    lsb = objid & 0xFF
+    msb = (objid >> 8) & 0xFF
+    if extra is None:
+        return lambda data: data[offset] == lsb and data[offset + 1] == msb
+    extra = extra & 0xFF
+    return lambda data: (data[offset] == lsb and data[offset + 1] == msb
+                         and data[offset + 2] == extra)
 
 
 class IBSVTInterface(IBSInterface):
     """ Implements ISOBUS part 6 funcationality (Version 3)
-    Extends the ISOBUS general interface
+    Extends the ISOBUS general interface.
+    The Wait*Response methods take the future returned by the Send* command,
+    so concurrent senders each wait for their own response
     """
 
+    def _SendVTCommand(self, vtsa, ecusa, candata, match=None):
+        """ Send a command which the VT answers with the same function code,
+        the response is expected before sending so it can not be missed.
+        Returns the future for the response
+        """
+        future = self._ExpectIBSMessage(PGN_VT2ECU, vtsa, ecusa, candata[0], match)
+        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, candata)
+        return future
+
     def WaitForStatusMessage(self, vtsa):
         return self._WaitForIBSMessage(PGN_VT2ECU, vtsa, 0xFF, 0xFE)
 
-    def SendChangeActiveMask(self, wsid, maskid, sa, da):
-        candata = ([0xAD] 
-        + NumericValue(wsid).AsLEBytes(2) 
-        + NumericValue(maskid).AsLEBytes(2)
-        + [0xFF, 0xFF, 0xFF])
+    def ExpectStatusMessage(self, vtsa):
+        """ Returns a future for the next VT status message """
+        return self._ExpectIBSMessage(PGN_VT2ECU, vtsa, 0xFF, 0xFE)
 
-        self._SendIBSMessage(PGN_ECU2VT, da, sa, candata)
+    def SendChangeActiveMask(self, wsid, maskid, sa, da):
+        return self._SendVTCommand(da, sa, ChangeActiveMaskFrame(wsid, maskid))
 
-    def WaitForChangeActiveMaskResponse(self, vtsa, ecusa):
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xAD)
+    def WaitForChangeActiveMaskResponse(self, vtsa, ecusa, future=None):
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xAD, future=future)
         return received, NumericValue.FromLEBytes(data[1:3]).Value(), data[3]
 
     def SendChangeSKMask(self, maskid, skmaskid, alarm, vtsa, ecusa):
-        candata = [0xFF] * 8
-        if alarm:
-            candata = ([0xAE] 
-            + [0x02] 
-            + NumericValue(maskid).AsLEBytes(2)
-            + NumericValue(skmaskid).AsLEBytes(2)
-            + [0xFF, 0xFF])
-        else:
-            candata = ([0xAE] 
-            + [0x01] 
-            + NumericValue(maskid).AsLEBytes(2)
-            + NumericValue(skmaskid).AsLEBytes(2)
-            + [0xFF, 0xFF])
-
-        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, candata)
+        return self._SendVTCommand(vtsa, ecusa, ChangeSKMaskFrame(maskid, skmaskid, alarm))
 
-    def WaitForChangeSKMaskResponse(self, vtsa, ecusa):
+    def WaitForChangeSKMaskResponse(self, vtsa, ecusa, future=None):
         """ Wait for the Change Soft Key Mask response message
         Return True for received, error code, and new SK mask ID
         """
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xAE)
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xAE, future=future)
         return received, data[5], NumericValue.FromLEBytes(data[3:5]).Value()
 
 
     def SendChangeAttribute(self, objid, attrid, value, vtsa, ecusa):
-        candata = ([0xAF]
-                + NumericValue(objid).AsLEBytes(2)
-                + NumericValue(attrid).AsLEBytes(1)
-                + NumericValue(value).AsLEBytes(4))
+        return self._SendVTCommand(vtsa, ecusa, ChangeAttributeFrame(objid, attrid, value),
+                                   _MatchObjectID(objid, 1, attrid))
 
-        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, candata)
-
-    def WaitChangeAttributeResponse(self, vtsa, ecusa):
+    def WaitChangeAttributeResponse(self, vtsa, ecusa, future=None):
         """
         Wait for a response for the change attribute command
         Return True for received and Error code
         """
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xAF)
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xAF, future=future)
         return received, data[4]
 
     def SendEscCommand(self, vtsa, ecusa):
-        candata = [0x92] + (7 * [0xFF])
-        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, candata)
+        return self._SendVTCommand(vtsa, ecusa, ESC_FRAME)
 
-    def WaitForESCResponse(self, vtsa, ecusa):
+    def WaitForESCResponse(self, vtsa, ecusa, future=None):
         """
         Wait for ESC response
         @return True for received, error code and aborted input object ID
         """
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0x92)
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0x92, future=future)
         return received, data[3], NumericValue.FromLEBytes(data[1:3]).Value()
 
     def SendWSMaintenance(self, initiating, sa, da):
-        initBit = 0
-        if (initiating) :
-            initBit = 1
-
-        candata = [0xFF, (initBit & 0x1), 0x3, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
-        self._SendIBSMessage(PGN_ECU2VT, da, sa, candata)
+        if initiating:
+            self._SendIBSMessage(PGN_ECU2VT, da, sa, WS_MAINTENANCE_INIT_FRAME)
+        else:
+            self._SendIBSMessage(PGN_ECU2VT, da, sa, WS_MAINTENANCE_FRAME)
 
     def StartWSMaintenace(self, sa, da):
-        candata = [0xFF, 0x00, 0x3, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
         ibsid = IBSID(sa = sa, da = da, pgn = PGN_ECU2VT, prio = 6)
-        self.AddPeriodicMessage(ibsid, candata, 1.0)
+        self.AddPeriodicMessage(ibsid, WS_MAINTENANCE_FRAME, 1.0)
         
     def StopWSMaintenance(self, sa, da):
         # For socketcan_native, bit 32 (MSb) needs to be set for extended ID
@@ -102,35 +105,30 @@ class IBSVTInterface(IBSInterface):
         
     def SendLoadVersionCommand(self, version, sa, da):
         if len(version) == 7:
-            candata = [0xD1] + [ord(x) for x in version]
-            self._SendIBSMessage(PGN_ECU2VT, da, sa, candata)
+            return self._SendVTCommand(da, sa, LoadVersionFrame(version))
         else :
             raise IBSException("Version {0} is not 7 characters".format(version))
 
     def SendStoreVersioncommand(self, version, da, sa):
         if len(version) == 7:
-            candata = [0xD0] + [ord(x) for x in version]
-            self._SendIBSMessage(PGN_ECU2VT, da, sa, candata)
+            return self._SendVTCommand(da, sa, StoreVersionFrame(version))
         else :
             raise IBSException("Version {0} is not 7 characters".format(version))
 
-    def WaitLoadVersionResponse(self, vtsa, ecusa):
+    def WaitLoadVersionResponse(self, vtsa, ecusa, future=None):
         #TODO: Should wait 3 status messages w/parsing bit=0 i.o. 3 seconds
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xD1)
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xD1, future=future)
         return received, data[5]
     
-    def WaitStoreVersionResponse(self, vtsa, ecusa):
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xD0)
+    def WaitStoreVersionResponse(self, vtsa, ecusa, future=None):
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xD0, future=future)
         return received, data[5]
     
     def SendGetMemory(self, memRequired, vtsa, ecusa):
-       candata = (  [0xC0, 0xFF] 
-                  + NumericValue(memRequired).AsLEBytes(4)
-                  + [0xFF, 0xFF])
-       self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, candata)
+       return self._SendVTCommand(vtsa, ecusa, GetMemoryFrame(memRequired))
 
-    def WaitForGetMemoryResponse(self, vtsa, ecusa):
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xC0)
+    def WaitForGetMemoryResponse(self, vtsa, ecusa, future=None):
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xC0, future=future)
         version = data[1]
         enoughMemory = True
         if data[2] == 0x01:
@@ -138,72 +136,61 @@ class IBSVTInterface(IBSInterface):
         return received, version, enoughMemory
 
     def SendChangeNumericValue(self, objid, value, vtsa, ecusa):
-        candata =([0xA8] 
-                + NumericValue(objid).AsLEBytes(2) 
-                + [0xFF]
-                + NumericValue(value).AsLEBytes(4))
-        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, candata)
+        return self._SendVTCommand(vtsa, ecusa, ChangeNumericValueFrame(objid, value),
+                                   _MatchObjectID(objid, 1))
 
-    def WaitForChangeNumericValueResponse(self, vtsa, ecusa):
+    def WaitForChangeNumericValueResponse(self, vtsa, ecusa, future=None):
         """
         Return true for received, error code
         """
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xA8)
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xA8, future=future)
         return received, data[3]
 
     def SendChangeStringValue(self, objid, value, vtsa, ecusa):
         # TODO: Check for too  large strings!
-        stringData = [ord(x) for x in value]
+        return self._SendVTCommand(vtsa, ecusa, ChangeStringValueFrame(objid, value),
+                                   _MatchObjectID(objid, 3))
 
-        if len(stringData) < 3:
-            stringData = stringData + list([RESERVED] * (3 - len(stringData)))
-
-        candata =([0xB3] 
-                + NumericValue(objid).AsLEBytes(2) 
-                + NumericValue(len(value)).AsLEBytes(2)
-                + stringData)
-        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, candata)
-
-    def WaitForChangeStringValueResponse(self, vtsa, ecusa):
+    def WaitForChangeStringValueResponse(self, vtsa, ecusa, future=None):
         """
         Return true for received, error code
         """
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xB3)
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xB3, future=future)
         return received, data[5]
     
 
-    def SendPoolUpload(self, vtsa, ecusa, pooldata):
-        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, [0x11] + pooldata)
+    def SendPoolUpload(self, vtsa, ecusa, pooldata, progress=None):
+        """ pooldata can be bytes, a memoryview, an mmap or a list of ints,
+        it is sent without copying it. Returns True if the VT acknowledged the transfer
+        """
+        return self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, IBSMessageData(b'\x11', pooldata),
+                                    progress=progress)
 
     def SendEndOfObjectPool(self, vtsa, ecusa):
-        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, [0x12] + [0xFF] * 7)
+        return self._SendVTCommand(vtsa, ecusa, END_OF_OBJECT_POOL_FRAME)
 
-    def WaitEndOfObjectPoolResponse(self, vtsa, ecusa):
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0x12, 5.0)
+    def WaitEndOfObjectPoolResponse(self, vtsa, ecusa, future=None):
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0x12, 5.0, future)
         return received, data[1]
         # TODO: Return error codes + faulty objects?
 
     def SendDeleteObjectPool(self, vtsa, ecusa):
-        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, [0xB2] + (7 * [0xFF]))
+        return self._SendVTCommand(vtsa, ecusa, DELETE_OBJECT_POOL_FRAME)
     
-    def WaitDeleteObjectPoolResponse(self, vtsa, ecusa):
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xB2)
+    def WaitDeleteObjectPoolResponse(self, vtsa, ecusa, future=None):
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xB2, future=future)
         return received, data[1]
 
     def SendChangeListItemCommand(self, vtsa, ecusa, objectid, index, newid):
-        candata = ([0xB1] 
-                    + NumericValue(objectid).AsLEBytes(2) 
-                    + [index & 0xFF]
-                    + NumericValue(newid).AsLEBytes(2)
-                    + [RESERVED] * 2)
-        self._SendIBSMessage(PGN_ECU2VT, vtsa, ecusa, candata)
+        return self._SendVTCommand(vtsa, ecusa, ChangeListItemFrame(objectid, index, newid),
+                                   _MatchObjectID(objectid, 1, index))
 
-    def WaitForChangeListItemResponse(self, vtsa, ecusa):
-        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xB1)
+    def WaitForChangeListItemResponse(self, vtsa, ecusa, future=None):
+        [received, data] = self._WaitForIBSMessage(PGN_VT2ECU, vtsa, ecusa, 0xB1, future=future)
         return received, data[6]
 
     def SendIdentifyVT(self, sa):
         log.debug('Sending identify VT')
-        self._SendIBSMessage(PGN_ECU2VT, 0xFF, sa, [0xBB] + (7 * [0xFF]))
+        self._SendIBSMessage(PGN_ECU2VT, 0xFF, sa, IDENTIFY_VT_FRAME)
 
 
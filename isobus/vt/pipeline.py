@@ -0,0 +1,156 @@
+import time
+import collections
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from isobus.ibsinterface import IBSRxHandler
+from isobus.common import IBSException
+from isobus.constants import *
+from isobus.log import log
+from isobus.vt.pool import NUMERIC_VALUE_TYPES
+from isobus.vt.pool import STRING_VALUE_TYPES
+from isobus.vt.shadow import SHADOW_VALUE
+from isobus.vt.shadow import SHADOW_ITEM
+
+# VT busy codes (byte 7 of the VT status message) that stop pipelining
+VT_BUSY_EXECUTING_COMMAND = 0x04
+VT_BUSY_PARSING_POOL      = 0x10
+VT_BUSY_OUT_OF_MEMORY     = 0x80
+
+
+class VTStatusHandler(IBSRxHandler):
+    """ Keeps the last VT status message of one VT """
+
+    def __init__(self, vtsa):
+        IBSRxHandler.__init__(self, [PGN_VT2ECU], sa=vtsa, da=SA_GLOBAL, muxByte=0xFE)
+        self.busyCodes = 0x00
+
+    def RxMessage(self, ibsid, data):
+        self.busyCodes = data[6]
+
+
+class VTCommandPipeline():
+    """ Sends VT commands without waiting for each response, keeping up to
+    depth commands in flight. Responses are correlated by function code and
+    object ID. While the VT reports it is busy only one command is in flight.
+    Use as a context manager, or call Flush to wait for all responses.
+    Commands skipped by the client's shadow cache return None
+    """
+
+    BUSY_MASK = VT_BUSY_EXECUTING_COMMAND | VT_BUSY_PARSING_POOL | VT_BUSY_OUT_OF_MEMORY
+
+    def __init__(self, client, depth=8, maxtime=3.0):
+        if depth < 1:
+            raise IBSException('Pipeline depth must be at least 1')
+        self.client = client
+        self.depth = depth
+        self.maxtime = maxtime
+        self.errors = list()
+        self._inflight = collections.deque()
+        self._status = VTStatusHandler(client.da)
+        client.connection.AddRxHandler(self._status)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.Flush()
+        finally:
+            self.Close()
+
+    def Close(self):
+        for future, _, _, _, _ in self._inflight:
+            self.client.connection._RemoveWaiter(None, future)
+        self._inflight.clear()
+        self.client.connection.RemoveRxHandler(self._status)
+
+    def ChangeNumericValue(self, objid, value):
+        self.client._CheckObject(objid, NUMERIC_VALUE_TYPES)
+        if self.client._Suppress((objid, SHADOW_VALUE), value):
+            return None
+        self._WaitForSlot()
+        future = self.client.connection.SendChangeNumericValue(
+                objid, value, vtsa = self.client.da, ecusa = self.client.sa)
+        self._Track(future, 3, 'change numeric value 0x{0:04X}'.format(objid),
+                    ((objid, SHADOW_VALUE), value))
+        return future
+
+    def ChangeAttribute(self, objid, attrid, value):
+        self.client._CheckObject(objid)
+        if self.client._Suppress((objid, attrid), value):
+            return None
+        self._WaitForSlot()
+        future = self.client.connection.SendChangeAttribute(
+                objid, attrid, value, self.client.da, self.client.sa)
+        self._Track(future, 4, 'change attribute 0x{0:04X}/{1}'.format(objid, attrid),
+                    ((objid, attrid), value))
+        return future
+
+    def ChangeStringValue(self, objid, value):
+        self.client._CheckObject(objid, STRING_VALUE_TYPES)
+        if self.client._Suppress((objid, SHADOW_VALUE), value):
+            return None
+        self._WaitForSlot()
+        future = self.client.connection.SendChangeStringValue(
+                objid, value, vtsa = self.client.da, ecusa = self.client.sa)
+        self._Track(future, 5, 'change string value 0x{0:04X}'.format(objid),
+                    ((objid, SHADOW_VALUE), value))
+        return future
+
+    def ChangeListItem(self, objid, index, value):
+        self.client._CheckObject(objid)
+        if self.client._Suppress((objid, (SHADOW_ITEM, index)), value):
+            return None
+        self._WaitForSlot()
+        future = self.client.connection.SendChangeListItemCommand(
+                self.client.da, self.client.sa, objid, index, value)
+        self._Track(future, 6, 'change list item 0x{0:04X}[{1}]'.format(objid, index),
+                    ((objid, (SHADOW_ITEM, index)), value))
+        return future
+
+    def Flush(self):
+        """ Wait for all outstanding responses, raise if any command failed """
+        errors = self.Drain()
+        if len(errors) > 0:
+            raise IBSException('{0} pipelined command(s) failed: {1}'.format(
+                len(errors), ', '.join(errors)))
+
+    def Drain(self):
+        """ Wait for all outstanding responses, return (and forget) the
+        descriptions of the commands which failed
+        """
+        while len(self._inflight) > 0:
+            self._CompleteOldest()
+        errors = self.errors
+        self.errors = list()
+        return errors
+
+    def _Window(self):
+        if self._status.busyCodes & self.BUSY_MASK:
+            return 1
+        return self.depth
+
+    def _WaitForSlot(self):
+        self.client._CheckAlive()
+        while len(self._inflight) >= self._Window():
+            self._CompleteOldest()
+
+    def _Track(self, future, errorByte, description, shadow):
+        self._inflight.append((future, errorByte, description, shadow, time.time()))
+
+    def _CompleteOldest(self):
+        future, errorByte, description, shadow, sendtime = self._inflight.popleft()
+        error = None
+        try:
+            data = future.result(max(0.0, sendtime + self.maxtime - time.time()))
+            if data[errorByte] != 0:
+                error = '{0}: error code {1}'.format(description, data[errorByte])
+            else:
+                self.client._Acknowledge(*shadow)
+        except FutureTimeoutError:
+            self.client.connection._RemoveWaiter(None, future)
+            error = '{0}: no response received'.format(description)
+        if error is not None:
+            log.debug('(Pipeline) {0}'.format(error))
+            self.errors.append(error)
@@ -0,0 +1,328 @@
+import struct
+
+from isobus.common import IBSException
+from isobus.common import IBSMessageData
+
+# Field specs per object type (ISO 11783-6, version 4), after the common
+# object ID (2 bytes) and type (1 byte). A field is (name, struct format),
+# (name, BYTES, length field) or (name, LIST, count field, item format)
+BYTES = '*bytes'
+LIST  = '*list'
+
+_MACROS = ('macros', LIST, 'numMacros', 'BB')
+_CHILDREN = ('objects', LIST, 'numObjects', 'Hhh')
+
+OBJECT_TYPES = {
+    0  : ('WorkingSet', [('bgColour', 'B'), ('selectable', 'B'), ('activeMask', 'H'),
+                         ('numObjects', 'B'), ('numMacros', 'B'), ('numLanguages', 'B'),
+                         _CHILDREN, _MACROS, ('languages', LIST, 'numLanguages', '2s')]),
+    1  : ('DataMask', [('bgColour', 'B'), ('softKeyMask', 'H'), ('numObjects', 'B'),
+                       ('numMacros', 'B'), _CHILDREN, _MACROS]),
+    2  : ('AlarmMask', [('bgColour', 'B'), ('softKeyMask', 'H'), ('priority', 'B'),
+                        ('acousticSignal', 'B'), ('numObjects', 'B'), ('numMacros', 'B'),
+                        _CHILDREN, _MACROS]),
+    3  : ('Container', [('width', 'H'), ('height', 'H'), ('hidden', 'B'), ('numObjects', 'B'),
+                        ('numMacros', 'B'), _CHILDREN, _MACROS]),
+    4  : ('SoftKeyMask', [('bgColour', 'B'), ('numObjects', 'B'), ('numMacros', 'B'),
+                          ('objects', LIST, 'numObjects', 'H'), _MACROS]),
+    5  : ('Key', [('bgColour', 'B'), ('keyCode', 'B'), ('numObjects', 'B'), ('numMacros', 'B'),
+                  _CHILDREN, _MACROS]),
+    6  : ('Button', [('width', 'H'), ('height', 'H'), ('bgColour', 'B'), ('borderColour', 'B'),
+                     ('keyCode', 'B'), ('options', 'B'), ('numObjects', 'B'), ('numMacros', 'B'),
+                     _CHILDREN, _MACROS]),
+    7  : ('InputBoolean', [('bgColour', 'B'), ('width', 'H'), ('foregroundColour', 'H'),
+                           ('variableReference', 'H'), ('value', 'B'), ('enabled', 'B'),
+                           ('numMacros', 'B'), _MACROS]),
+    8  : ('InputString', [('width', 'H'), ('height', 'H'), ('bgColour', 'B'),
+                          ('fontAttributes', 'H'), ('inputAttributes', 'H'), ('options', 'B'),
+                          ('variableReference', 'H'), ('justification', 'B'), ('length', 'B'),
+                          ('value', BYTES, 'length'), ('enabled', 'B'), ('numMacros', 'B'),
+                          _MACROS]),
+    9  : ('InputNumber', [('width', 'H'), ('height', 'H'), ('bgColour', 'B'),
+                          ('fontAttributes', 'H'), ('options', 'B'), ('variableReference', 'H'),
+                          ('value', 'I'), ('minValue', 'I'), ('maxValue', 'I'), ('offset', 'i'),
+                          ('scale', 'f'), ('numDecimals', 'B'), ('format', 'B'),
+                          ('justification', 'B'), ('options2', 'B'), ('numMacros', 'B'),
+                          _MACROS]),
+    10 : ('InputList', [('width', 'H'), ('height', 'H'), ('variableReference', 'H'),
+                        ('value', 'B'), ('numItems', 'B'), ('options', 'B'), ('numMacros', 'B'),
+                        ('items', LIST, 'numItems', 'H'), _MACROS]),
+    11 : ('OutputString', [('width', 'H'), ('height', 'H'), ('bgColour', 'B'),
+                           ('fontAttributes', 'H'), ('options', 'B'), ('variableReference', 'H'),
+                           ('justification', 'B'), ('length', 'H'), ('value', BYTES, 'length'),
+                           ('numMacros', 'B'), _MACROS]),
+    12 : ('OutputNumber', [('width', 'H'), ('height', 'H'), ('bgColour', 'B'),
+                           ('fontAttributes', 'H'), ('options', 'B'), ('variableReference', 'H'),
+                           ('value', 'I'), ('offset', 'i'), ('scale', 'f'), ('numDecimals', 'B'),
+                           ('format', 'B'), ('justification', 'B'), ('numMacros', 'B'), _MACROS]),
+    13 : ('Line', [('lineAttributes', 'H'), ('width', 'H'), ('height', 'H'),
+                   ('lineDirection', 'B'), ('numMacros', 'B'), _MACROS]),
+    14 : ('Rectangle', [('lineAttributes', 'H'), ('width', 'H'), ('height', 'H'),
+                        ('lineSuppression', 'B'), ('fillAttributes', 'H'), ('numMacros', 'B'),
+                        _MACROS]),
+    15 : ('Ellipse', [('lineAttributes', 'H'), ('width', 'H'), ('height', 'H'),
+                      ('ellipseType', 'B'), ('startAngle', 'B'), ('endAngle', 'B'),
+                      ('fillAttributes', 'H'), ('numMacros', 'B'), _MACROS]),
+    16 : ('Polygon', [('width', 'H'), ('height', 'H'), ('lineAttributes', 'H'),
+                      ('fillAttributes', 'H'), ('polygonType', 'B'), ('numPoints', 'B'),
+                      ('numMacros', 'B'), ('points', LIST, 'numPoints', 'HH'), _MACROS]),
+    17 : ('Meter', [('width', 'H'), ('needleColour', 'B'), ('borderColour', 'B'),
+                    ('arcAndTickColour', 'B'), ('options', 'B'), ('numTicks', 'B'),
+                    ('startAngle', 'B'), ('endAngle', 'B'), ('minValue', 'H'), ('maxValue', 'H'),
+                    ('variableReference', 'H'), ('value', 'H'), ('numMacros', 'B'), _MACROS]),
+    18 : ('LinearBarGraph', [('width', 'H'), ('height', 'H'), ('colour', 'B'),
+                             ('targetLineColour', 'B'), ('options', 'B'), ('numTicks', 'B'),
+                             ('minValue', 'H'), ('maxValue', 'H'), ('variableReference', 'H'),
+                             ('value', 'H'), ('targetValueVariableReference', 'H'),
+                             ('targetValue', 'H'), ('numMacros', 'B'), _MACROS]),
+    19 : ('ArchedBarGraph', [('width', 'H'), ('height', 'H'), ('colour', 'B'),
+                             ('targetLineColour', 'B'), ('options', 'B'), ('startAngle', 'B'),
+                             ('endAngle', 'B'), ('barGraphWidth', 'H'), ('minValue', 'H'),
+                             ('maxValue', 'H'), ('variableReference', 'H'), ('value', 'H'),
+                             ('targetValueVariableReference', 'H'), ('targetValue', 'H'),
+                             ('numMacros', 'B'), _MACROS]),
+    20 : ('PictureGraphic', [('width', 'H'), ('actualWidth', 'H'), ('actualHeight', 'H'),
+                             ('format', 'B'), ('options', 'B'), ('transparencyColour', 'B'),
+                             ('numRawBytes', 'I'), ('numMacros', 'B'),
+                             ('rawData', BYTES, 'numRawBytes'), _MACROS]),
+    21 : ('NumberVariable', [('value', 'I')]),
+    22 : ('StringVariable', [('length', 'H'), ('value', BYTES, 'length')]),
+    23 : ('FontAttributes', [('fontColour', 'B'), ('fontSize', 'B'), ('fontType', 'B'),
+                             ('fontStyle', 'B'), ('numMacros', 'B'), _MACROS]),
+    24 : ('LineAttributes', [('lineColour', 'B'), ('lineWidth', 'B'), ('lineArt', 'H'),
+                             ('numMacros', 'B'), _MACROS]),
+    25 : ('FillAttributes', [('fillType', 'B'), ('fillColour', 'B'), ('fillPattern', 'H'),
+                             ('numMacros', 'B'), _MACROS]),
+    26 : ('InputAttributes', [('validationType', 'B'), ('length', 'B'),
+                              ('validationString', BYTES, 'length'), ('numMacros', 'B'),
+                              _MACROS]),
+    27 : ('ObjectPointer', [('value', 'H')]),
+    28 : ('Macro', [('numBytes', 'H'), ('commands', BYTES, 'numBytes')]),
+    29 : ('AuxiliaryFunction', [('bgColour', 'B'), ('functionType', 'B'), ('numObjects', 'B'),
+                                _CHILDREN]),
+    30 : ('AuxiliaryInput', [('bgColour', 'B'), ('functionType', 'B'), ('inputId', 'B'),
+                             ('numObjects', 'B'), _CHILDREN]),
+    31 : ('AuxiliaryFunction2', [('bgColour', 'B'), ('functionAttributes', 'B'),
+                                 ('numObjects', 'B'), _CHILDREN]),
+    32 : ('AuxiliaryInput2', [('bgColour', 'B'), ('functionAttributes', 'B'),
+                              ('numObjects', 'B'), _CHILDREN]),
+    33 : ('AuxiliaryControlDesignator2', [('pointerType', 'B'), ('auxiliaryObject', 'H')]),
+    34 : ('WindowMask', [('width', 'B'), ('height', 'B'), ('windowType', 'B'),
+                         ('bgColour', 'B'), ('options', 'B'), ('name', 'H'),
+                         ('windowTitle', 'H'), ('windowIcon', 'H'), ('numObjectRefs', 'B'),
+                         ('numObjects', 'B'), ('numMacros', 'B'),
+                         ('objectRefs', LIST, 'numObjectRefs', 'H'), _CHILDREN, _MACROS]),
+    35 : ('KeyGroup', [('options', 'B'), ('name', 'H'), ('keyGroupIcon', 'H'),
+                       ('numKeys', 'B'), ('numMacros', 'B'), ('keys', LIST, 'numKeys', 'H'),
+                       _MACROS]),
+    36 : ('GraphicsContext', [('viewportWidth', 'H'), ('viewportHeight', 'H'),
+                              ('viewportX', 'h'), ('viewportY', 'h'), ('canvasWidth', 'H'),
+                              ('canvasHeight', 'H'), ('viewportZoom', 'f'), ('cursorX', 'h'),
+                              ('cursorY', 'h'), ('foregroundColour', 'B'), ('bgColour', 'B'),
+                              ('fontAttributes', 'H'), ('lineAttributes', 'H'),
+                              ('fillAttributes', 'H'), ('format', 'B'), ('options', 'B'),
+                              ('transparencyColour', 'B')]),
+    37 : ('OutputList', [('width', 'H'), ('height', 'H'), ('variableReference', 'H'),
+                         ('value', 'B'), ('numItems', 'B'), ('numMacros', 'B'),
+                         ('items', LIST, 'numItems', 'H'), _MACROS]),
+    38 : ('ExtendedInputAttributes', None), # Nested code planes, see _ExtendedInputAttributes
+    39 : ('ColourMap', [('numIndexes', 'H'), ('indexes', BYTES, 'numIndexes')]),
+    40 : ('ObjectLabelReferenceList', [('numLabels', 'H'),
+                                       ('labels', LIST, 'numLabels', 'HHBH')]),
+}
+
+# Object types with a value for Change Numeric Value / Change String Value
+NUMERIC_VALUE_TYPES = frozenset([7, 9, 10, 12, 17, 18, 19, 21, 27, 37])
+STRING_VALUE_TYPES  = frozenset([8, 11, 22])
+
+
+def _CompileSpec(spec):
+    """ Turn a field spec into steps: (name, kind, struct, count field) with
+    consecutive plain fields merged into one struct
+    """
+    steps = list()
+    counts = set(field[2] for field in spec if field[1] in (BYTES, LIST))
+    for field in spec:
+        if field[1] == BYTES:
+            steps.append((field[0], BYTES, None, field[2]))
+        elif field[1] == LIST:
+            steps.append((field[0], LIST, struct.Struct('<' + field[3]), field[2]))
+        else:
+            steps.append((field[0], None, struct.Struct('<' + field[1]), field[0] in counts))
+    return steps
+
+_STEPS = dict((objtype, _CompileSpec(spec))
+              for objtype, (name, spec) in OBJECT_TYPES.items() if spec is not None)
+
+
+def _Walk(objtype, data, offset, decode):
+    """ Walk the fields of an object starting at offset (the object ID).
+    Returns the object length and, if decode, a dict with its attributes
+    """
+    if objtype == 38:
+        return _ExtendedInputAttributes(data, offset, decode)
+    steps = _STEPS.get(objtype)
+    if steps is None:
+        raise IBSException('Unsupported object type {0} at offset {1}'.format(objtype, offset))
+
+    attributes = dict() if decode else None
+    values = dict()
+    pos = offset + 3
+    for name, kind, fmt, extra in steps:
+        if kind is None:
+            if decode or extra:
+                value = fmt.unpack_from(data, pos)[0]
+                values[name] = value
+                if decode:
+                    attributes[name] = value
+            pos += fmt.size
+        elif kind == BYTES:
+            n = values[extra]
+            if decode:
+                attributes[name] = bytes(data[pos:pos + n])
+            pos += n
+        else:
+            n = values[extra]
+            if decode:
+                items = [fmt.unpack_from(data, pos + i * fmt.size) for i in range(n)]
+                attributes[name] = [item[0] if len(item) == 1 else item for item in items]
+            pos += n * fmt.size
+    return pos - offset, attributes
+
+
+def _ExtendedInputAttributes(data, offset, decode):
+    pos = offset + 3
+    validationType, numCodePlanes = data[pos], data[pos + 1]
+    pos += 2
+    codePlanes = list()
+    for n in range(numCodePlanes):
+        codePlane, numRanges = data[pos], data[pos + 1]
+        pos += 2
+        if decode:
+            ranges = [struct.unpack_from('<HH', data, pos + i * 4) for i in range(numRanges)]
+            codePlanes.append((codePlane, ranges))
+        pos += numRanges * 4
+    attributes = None
+    if decode:
+        attributes = dict(validationType=validationType, codePlanes=codePlanes)
+    return pos - offset, attributes
+
+
+class VTPoolObject():
+    """ One object of a VTObjectPool, the attributes are decoded on first use """
+    __slots__ = ('pool', 'objid', 'offset', 'length', 'type', '_attributes')
+
+    def __init__(self, pool, objid, offset, length, objtype):
+        self.pool = pool
+        self.objid = objid
+        self.offset = offset
+        self.length = length
+        self.type = objtype
+        self._attributes = None
+
+    @property
+    def typeName(self):
+        return OBJECT_TYPES[self.type][0]
+
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            _, self._attributes = _Walk(self.type, self.pool.data, self.offset, True)
+        return self._attributes
+
+    def Raw(self):
+        """ The object as it is in the pool, as a memoryview """
+        return self.pool.data[self.offset:self.offset + self.length]
+
+    def __repr__(self):
+        return '<{0} 0x{1:04X}>'.format(self.typeName, self.objid)
+
+
+class VTObjectPool():
+    """ An object pool (IOP) parsed into an index of object ID -> (offset,
+    length, type). Object bodies are only decoded when an object is accessed
+    """
+
+    def __init__(self, data):
+        if isinstance(data, IBSMessageData):
+            parts = data.Parts()
+            data = parts[0] if len(parts) == 1 else bytes(data)
+        self.data = memoryview(data)
+        self._index = dict()
+        self._objects = dict()
+
+        offset = 0
+        size = len(self.data)
+        while offset < size:
+            if offset + 3 > size:
+                raise IBSException('Truncated object at offset {0}'.format(offset))
+            objid = self.data[offset] | (self.data[offset + 1] << 8)
+            objtype = self.data[offset + 2]
+            try:
+                length, _ = _Walk(objtype, self.data, offset, False)
+            except (struct.error, IndexError, KeyError):
+                raise IBSException('Truncated object 0x{0:04X} at offset {1}'.format(
+                    objid, offset))
+            if offset + length > size:
+                raise IBSException('Truncated object 0x{0:04X} at offset {1}'.format(
+                    objid, offset))
+            # A later definition replaces an earlier one, like on the VT
+            self._index[objid] = (offset, length, objtype)
+            offset += length
+
+    @classmethod
+    def FromFile(cls, filename):
+        with open(filename, 'rb') as iopfile:
+            return cls(iopfile.read())
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, objid):
+        return objid in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __getitem__(self, objid):
+        return self.Object(objid)
+
+    def Object(self, objid):
+        obj = self._objects.get(objid)
+        if obj is None:
+            try:
+                offset, length, objtype = self._index[objid]
+            except KeyError:
+                raise IBSException('Object 0x{0:04X} not in pool'.format(objid))
+            obj = VTPoolObject(self, objid, offset, length, objtype)
+            self._objects[objid] = obj
+        return obj
+
+    def ObjectType(self, objid):
+        """ Type of objid, or None if it is not in the pool """
+        entry = self._index.get(objid)
+        return entry[2] if entry is not None else None
+
+    def Boundaries(self):
+        """ Sorted offsets at which objects start, e.g. for VTPoolUploadSession """
+        return sorted(entry[0] for entry in self._index.values())
+
+
+def DiffPools(old, new):
+    """ Compare two VTObjectPools. Returns the objects of new which are not in
+    old or differ from it, as IBSMessageData referencing new's buffer (ready
+    for a partial Object Pool Transfer), and the IDs which are only in old.
+    Objects can not be deleted by a transfer, so the latter are only reported
+    """
+    changed = list()
+    for objid, (offset, length, objtype) in new._index.items():
+        entry = old._index.get(objid)
+        if (entry is None or entry[1:] != (length, objtype)
+                or old.data[entry[0]:entry[0] + length] != new.data[offset:offset + length]):
+            changed.append((offset, length))
+
+    # Keep the order of new, so objects still follow their references
+    changed.sort()
+    removed = [objid for objid in old if objid not in new]
+    return IBSMessageData(*[new.data[offset:offset + length]
+                            for offset, length in changed]), removed
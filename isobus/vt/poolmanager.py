@@ -0,0 +1,93 @@
+import base64
+import hashlib
+import json
+import os
+
+from isobus.vt.client import OpenPoolData
+from isobus.vt.asyncclient import AsyncVTClient
+from isobus.common import IBSException
+from isobus.common import IBSMessageData
+from isobus.log import log
+
+
+def PoolVersionLabel(data):
+    """ 7 character version label derived from the SHA-1 of the pool data """
+    digest = hashlib.sha1()
+    if not isinstance(data, IBSMessageData):
+        data = IBSMessageData(data)
+    for part in data.Parts():
+        digest.update(part)
+    return base64.b32encode(digest.digest()).decode('ascii')[:7]
+
+
+class VTPoolManager():
+    """ Activates an object pool on the connected VT with as little transfer as
+    possible: the version label is derived from the pool contents, so when the
+    VT already stored this pool a Load Version is enough. Otherwise the pool is
+    uploaded and stored under that label.
+    indexPath is an optional JSON file remembering which versions every VT
+    (by NAME) holds; a VT that is known not to hold the version is not asked
+    """
+
+    def __init__(self, client, indexPath=None):
+        if isinstance(client, AsyncVTClient):
+            raise IBSException('VTPoolManager needs a VTClient, not an AsyncVTClient')
+        self.client = client
+        self.indexPath = indexPath
+        self.index = dict() # VT NAME (hex) -> list of version labels
+        if indexPath is not None and os.path.exists(indexPath):
+            with open(indexPath, 'r') as indexfile:
+                self.index = json.load(indexfile)
+
+    def Activate(self, source):
+        """ Make the pool in source (path, file object or buffer) the active
+        pool. Returns the version label and whether it had to be uploaded
+        """
+        if isinstance(source, str) or hasattr(source, 'read'):
+            with OpenPoolData(source) as data:
+                return self._Activate(data)
+        return self._Activate(IBSMessageData(source))
+
+    def _Activate(self, data):
+        label = PoolVersionLabel(data)
+        vtName = self._VTName()
+        versions = self.index.get(vtName)
+
+        if versions is None or label in versions:
+            try:
+                self.client.LoadVersion(label)
+                log.debug('(PoolManager) Loaded version {0}'.format(label))
+                self._Remember(vtName, label)
+                return label, False
+            except IBSException as e:
+                log.debug('(PoolManager) Load version {0} failed: {1}'.format(label, e))
+                self._Forget(vtName, label)
+
+        self.client.UploadPoolData(data)
+        self.client.StoreVersion(label)
+        log.debug('(PoolManager) Uploaded and stored version {0}'.format(label))
+        self._Remember(vtName, label)
+        return label, True
+
+    def _VTName(self):
+        received, name = self.client.connection.RequestName(self.client.sa, self.client.da)
+        if not received:
+            raise IBSException('VT did not answer the address claim request')
+        return '{0:016X}'.format(name)
+
+    def _Remember(self, vtName, label):
+        versions = self.index.setdefault(vtName, list())
+        if label not in versions:
+            versions.append(label)
+            self._Save()
+
+    def _Forget(self, vtName, label):
+        versions = self.index.get(vtName)
+        if versions is not None and label in versions:
+            versions.remove(label)
+            self._Save()
+
+    def _Save(self):
+        if self.indexPath is not None:
+            with open(self.indexPath, 'w') as indexfile:
+                json.dump(self.index, indexfile, indent=2, sort_keys=True)
@@ -0,0 +1,272 @@
+import collections
+import struct
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from isobus.ibsinterface import IBSInterface
+from isobus.ibsinterface import IBSRxHandler
+from isobus.common import IBSException
+from isobus.common import IBSID
+from isobus.constants import *
+from isobus.log import log
+from isobus.cf import BuildISOBUSName
+from isobus.addressclaim import IBSAddressClaimer
+from isobus.vt.commands import VT_FUNCTIONS
+from isobus.vt.pool import VTObjectPool
+
+# Error codes of the VT responses
+VT_ERROR_INVALID_OBJECT   = 0x01
+VT_ERROR_INVALID_VALUE    = 0x02
+VT_ERROR_NO_INPUT_OPEN    = 0x01
+VT_ERROR_POOL             = 0x01
+VT_ERROR_VERSION_UNKNOWN  = 0x02
+VT_ERROR_NO_MEMORY        = 0x04
+
+_RESPONSE_PADDING = b'\xFF' * 8
+
+_OBJECT_VALUE   = struct.Struct('<HBI')
+_OBJECT_ATTR    = struct.Struct('<HBI')
+_OBJECT_STRING  = struct.Struct('<HH')
+_OBJECT_ITEM    = struct.Struct('<HBH')
+_MASKS          = struct.Struct('<HH')
+_SK_MASK        = struct.Struct('<BHH')
+_MEMORY         = struct.Struct('<BI')
+
+
+class VTWorkingSet():
+    """ State the simulated VT keeps for one working set (by source address) """
+
+    def __init__(self, sa):
+        self.sa = sa
+        self.poolData = bytearray()
+        self.pool = None
+        self.activeMask = 0xFFFF
+        self.softKeyMasks = dict()
+        self.values = dict()
+        self.attributes = dict()
+        self.lastMaintenance = None
+
+
+class _VTCommandHandler(IBSRxHandler):
+    """ Passes the ECU to VT messages for the server's address to it """
+
+    def __init__(self, server):
+        IBSRxHandler.__init__(self, [PGN_ECU2VT], da=server.sa)
+        self.server = server
+
+    def RxMessage(self, ibsid, data):
+        self.server._Command(ibsid, data)
+
+
+class VTServer():
+    """ Simulated VT, answering the commands of any number of working sets
+    (VTClients) on a virtual bus or vcan, e.g. to load test clients without
+    a terminal. Every response is sent latency seconds after the command,
+    from one scheduler thread so the order of responses is deterministic.
+    Stored versions are only kept in memory. The server claims and defends sa
+    with ibsName, by default a VT NAME with 0x100000 + sa as identity number
+    so it differs from the NAME of a default VTClient
+    """
+
+    def __init__(self, interface, channel, sa=0x26, latency=0.0, memory=16 * 1024 * 1024,
+                 version=4, statusPeriod=1.0, ibsName=None):
+        self.sa = sa
+        self.ibsName = (ibsName if ibsName is not None
+                        else BuildISOBUSName(function = FUNCTION_VT, idNumber = 0x100000 + sa))
+        self.latency = latency
+        self.memory = memory
+        self.version = version
+        self.statusPeriod = statusPeriod
+        self.workingSets = dict()
+        self.versions = collections.defaultdict(dict)
+        self.commands = collections.Counter()
+        self._lock = threading.Lock()
+        self._activeWS = None
+        self._handlers = {
+            0x11 : self._ObjectPoolTransfer,
+            0x12 : self._EndOfObjectPool,
+            0x92 : self._ESC,
+            0xA8 : self._ChangeNumericValue,
+            0xAD : self._ChangeActiveMask,
+            0xAE : self._ChangeSKMask,
+            0xAF : self._ChangeAttribute,
+            0xB1 : self._ChangeListItem,
+            0xB2 : self._DeleteObjectPool,
+            0xB3 : self._ChangeStringValue,
+            0xC0 : self._GetMemory,
+            0xD0 : self._StoreVersion,
+            0xD1 : self._LoadVersion,
+            0xFF : self._WSMaintenance,
+        }
+
+        self.connection = IBSInterface(interface, channel)
+        self.claimer = IBSAddressClaimer(self.connection, self.ibsName)
+        try:
+            self.claimer.Start(sa).result(3.0)
+        except (IBSException, FutureTimeoutError):
+            self.claimer.Stop()
+            self.connection.Shutdown()
+            raise IBSException('VT server could not claim address 0x{0:02X}'.format(sa))
+        self._handler = _VTCommandHandler(self)
+        self.connection.AddRxHandler(self._handler)
+        self._statusID = IBSID(da = SA_GLOBAL, sa = sa, pgn = PGN_VT2ECU, prio = 6)
+        self._status = self._StatusData()
+        self.connection.AddPeriodicMessage(self._statusID, self._status, statusPeriod)
+
+    def Shutdown(self):
+        self.connection.StopPeriodicMessage(self._statusID)
+        self.connection.RemoveRxHandler(self._handler)
+        self.claimer.Stop()
+        self.connection.Shutdown()
+
+    def Statistics(self):
+        """ Number of commands received per function name """
+        with self._lock:
+            return dict((VT_FUNCTIONS.get(function, '0x{0:02X}'.format(function)), n)
+                        for function, n in self.commands.items())
+
+    def _Command(self, ibsid, data):
+        if len(data) == 0:
+            return
+        function = data[0]
+        handler = self._handlers.get(function)
+        with self._lock:
+            self.commands[function] += 1
+            ws = self.workingSets.get(ibsid.sa)
+            if ws is None:
+                ws = self.workingSets[ibsid.sa] = VTWorkingSet(ibsid.sa)
+                log.debug('(VT) New working set {0:02X}'.format(ibsid.sa))
+            if handler is None:
+                return
+            try:
+                response = handler(ws, data)
+            except (IndexError, struct.error):
+                log.debug('(VT) Malformed command {0:02X} from {1:02X}'.format(
+                    function, ibsid.sa))
+                return
+        if response is not None:
+            self._Respond(ibsid.sa, bytes([function]) + response)
+        self._UpdateStatus()
+
+    def _Respond(self, da, data):
+        data = data + _RESPONSE_PADDING[:max(0, 8 - len(data))]
+        if self.latency > 0:
+            self.connection.scheduler.CallLater(
+                    self.latency, self.connection._SendIBSMessage, PGN_VT2ECU, da, self.sa, data)
+        else:
+            self.connection._SendIBSMessage(PGN_VT2ECU, da, self.sa, data)
+
+    def _StatusData(self):
+        with self._lock:
+            ws = self.workingSets.get(self._activeWS)
+            return bytes([0xFE, self._activeWS if ws is not None else SA_NULL]
+                         + list(_MASKS.pack(ws.activeMask if ws is not None else 0xFFFF,
+                                            ws.softKeyMasks.get(ws.activeMask, 0xFFFF)
+                                            if ws is not None else 0xFFFF))
+                         + [0x00, 0xFF])
+
+    def _UpdateStatus(self):
+        # The periodic status is only modified when the active working set or masks changed
+        data = self._StatusData()
+        if data != self._status:
+            self._status = data
+            self.connection.ModifyPeriodicMessage(self._statusID, data)
+
+    def _CheckObject(self, ws, objid):
+        return ws.pool is None or objid in ws.pool
+
+    # Command handlers, called with _lock held. They return the response
+    # after the function code, or None for no response
+
+    def _WSMaintenance(self, ws, data):
+        ws.lastMaintenance = time.time()
+        if self._activeWS is None:
+            self._activeWS = ws.sa
+        return None
+
+    def _GetMemory(self, ws, data):
+        _, required = _MEMORY.unpack_from(data, 1)
+        return bytes([self.version, 0x00 if required <= self.memory else 0x01])
+
+    def _ObjectPoolTransfer(self, ws, data):
+        ws.poolData += data[1:]
+        return None
+
+    def _EndOfObjectPool(self, ws, data):
+        try:
+            ws.pool = VTObjectPool(bytes(ws.poolData))
+        except IBSException as e:
+            log.debug('(VT) Pool of {0:02X} rejected: {1}'.format(ws.sa, e.args[0]))
+            return bytes([VT_ERROR_POOL, 0xFF, 0xFF, 0xFF, 0xFF, 0x00])
+        for objid in ws.pool:
+            if ws.pool.ObjectType(objid) == 0:
+                ws.activeMask = ws.pool[objid].attributes['activeMask']
+                break
+        return bytes([0x00, 0xFF, 0xFF, 0xFF, 0xFF, 0x00])
+
+    def _DeleteObjectPool(self, ws, data):
+        ws.poolData = bytearray()
+        ws.pool = None
+        ws.values.clear()
+        ws.attributes.clear()
+        return bytes([0x00])
+
+    def _StoreVersion(self, ws, data):
+        if ws.pool is None:
+            return b'\xFF' * 4 + bytes([VT_ERROR_POOL])
+        self.versions[ws.sa][bytes(data[1:8])] = bytes(ws.poolData)
+        return b'\xFF' * 4 + bytes([0x00])
+
+    def _LoadVersion(self, ws, data):
+        stored = self.versions[ws.sa].get(bytes(data[1:8]))
+        if stored is None:
+            return b'\xFF' * 4 + bytes([VT_ERROR_VERSION_UNKNOWN])
+        ws.poolData = bytearray(stored)
+        ws.pool = VTObjectPool(stored)
+        return b'\xFF' * 4 + bytes([0x00])
+
+    def _ChangeNumericValue(self, ws, data):
+        objid, _, value = _OBJECT_VALUE.unpack_from(data, 1)
+        error = 0x00 if self._CheckObject(ws, objid) else VT_ERROR_INVALID_OBJECT
+        if error == 0:
+            ws.values[objid] = value
+        return _OBJECT_VALUE.pack(objid, error, value)
+
+    def _ChangeAttribute(self, ws, data):
+        objid, attrid, value = _OBJECT_ATTR.unpack_from(data, 1)
+        error = 0x00 if self._CheckObject(ws, objid) else VT_ERROR_INVALID_OBJECT
+        if error == 0:
+            ws.attributes[(objid, attrid)] = value
+        return struct.pack('<HBB', objid, attrid, error)
+
+    def _ChangeStringValue(self, ws, data):
+        objid, length = _OBJECT_STRING.unpack_from(data, 1)
+        error = 0x00 if self._CheckObject(ws, objid) else VT_ERROR_INVALID_OBJECT
+        if error == 0:
+            ws.values[objid] = bytes(data[5:5 + length])
+        return b'\xFF\xFF' + struct.pack('<HB', objid, error)
+
+    def _ChangeListItem(self, ws, data):
+        objid, index, newid = _OBJECT_ITEM.unpack_from(data, 1)
+        error = 0x00 if self._CheckObject(ws, objid) else VT_ERROR_INVALID_OBJECT
+        if error == 0:
+            ws.attributes[(objid, ('item', index))] = newid
+        return _OBJECT_ITEM.pack(objid, index, newid) + bytes([error])
+
+    def _ChangeActiveMask(self, ws, data):
+        _, maskid = _MASKS.unpack_from(data, 1)
+        error = 0x00 if self._CheckObject(ws, maskid) else VT_ERROR_INVALID_OBJECT
+        if error == 0:
+            ws.activeMask = maskid
+        return struct.pack('<HB', ws.activeMask, error)
+
+    def _ChangeSKMask(self, ws, data):
+        _, maskid, skmaskid = _SK_MASK.unpack_from(data, 1)
+        error = 0x00 if self._CheckObject(ws, skmaskid) else VT_ERROR_INVALID_OBJECT
+        if error == 0:
+            ws.softKeyMasks[maskid] = skmaskid
+        return _MASKS.pack(maskid, skmaskid) + bytes([error])
+
+    def _ESC(self, ws, data):
+        return struct.pack('<HB', 0xFFFF, VT_ERROR_NO_INPUT_OPEN)
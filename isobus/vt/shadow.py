@@ -0,0 +1,58 @@
+import threading
+
+from isobus.ibsinterface import IBSRxHandler
+from isobus.constants import *
+
+# Shadow keys are (objid, attribute): an attribute ID for Change Attribute,
+# SHADOW_VALUE for numeric and string values, (SHADOW_ITEM, index) for list items
+SHADOW_VALUE = 'value'
+SHADOW_ITEM  = 'item'
+
+# VT to ECU messages for values the operator changed on the VT
+_VT_CHANGE_NUMERIC_VALUE = 0x05
+_VT_CHANGE_STRING_VALUE  = 0x08
+
+
+class VTShadowCache(IBSRxHandler):
+    """ Last values the VT acknowledged per (object, attribute), so writing an
+    unchanged value can be skipped. Values the operator changes on the VT
+    (input objects) are forgotten when the VT reports them. Only messages from
+    vtsa to ecusa, the client's VT session, are seen
+    """
+
+    def __init__(self, vtsa, ecusa):
+        IBSRxHandler.__init__(self, [PGN_VT2ECU], sa=vtsa, da=ecusa)
+        self._lock = threading.Lock()
+        self._values = dict()
+
+    def Suppress(self, key, value):
+        """ True if value is what the VT already has for key. Otherwise the
+        key is forgotten until the new value is acknowledged with Store
+        """
+        with self._lock:
+            if key in self._values and self._values[key] == value:
+                return True
+            self._values.pop(key, None)
+            if isinstance(key[1], int):
+                # Attributes like a variable reference also change the value shown
+                self._values.pop((key[0], SHADOW_VALUE), None)
+            return False
+
+    def Store(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def Clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def __len__(self):
+        return len(self._values)
+
+    def RxMessage(self, ibsid, data):
+        if data[0] in (_VT_CHANGE_NUMERIC_VALUE, _VT_CHANGE_STRING_VALUE):
+            # The changed input object may write through a variable reference,
+            # so all values are forgotten
+            with self._lock:
+                for key in [key for key in self._values if key[1] == SHADOW_VALUE]:
+                    del self._values[key]
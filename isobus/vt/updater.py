@@ -0,0 +1,134 @@
+import threading
+import time
+
+from isobus.common import IBSException
+from isobus.log import log
+
+
+class VTValueUpdater():
+    """ Coalesces ChangeNumericValue writes: only the latest pending value per
+    object ID is kept, and pending values are sent rate times per second,
+    lowest priority number first, through a VTCommandPipeline. Update never
+    blocks on the bus, so callers can write as fast as readings arrive.
+    At most maxPending object IDs are pending, beyond that the update with the
+    highest priority number is dropped. At most batch values are sent per
+    flush (None sends all), the rest stay pending and keep coalescing
+    """
+
+    def __init__(self, client, rate=10.0, batch=None, maxPending=1024, depth=8):
+        if rate <= 0:
+            raise IBSException('Update rate must be positive')
+        self.client = client
+        self.interval = 1.0 / rate
+        self.batch = batch
+        self.maxPending = maxPending
+        self.updates = 0
+        self.merged = 0
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self._pipeline = client.Pipeline(depth)
+        self._pending = dict()
+        self._sequence = 0
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._Run, name='isobus-vt-updater')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Stop(exc_type is None)
+
+    def Update(self, objid, value, priority=0):
+        """ Queue value for objid, replacing a pending value for it """
+        with self._cond:
+            if not self._running:
+                raise IBSException('Updater is stopped')
+            self.updates += 1
+            entry = self._pending.get(objid)
+            if entry is not None:
+                self.merged += 1
+                # Keep the place in the queue and the most urgent priority
+                self._pending[objid] = (min(priority, entry[0]), entry[1], value)
+                return
+            if len(self._pending) >= self.maxPending:
+                victim = max(self._pending, key=lambda key: self._pending[key][:2])
+                if self._pending[victim][0] <= priority:
+                    self.dropped += 1
+                    return
+                del self._pending[victim]
+                self.dropped += 1
+            self._pending[objid] = (priority, self._sequence, value)
+            self._sequence += 1
+
+    def Pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def Statistics(self):
+        with self._cond:
+            return {'updates' : self.updates, 'merged' : self.merged,
+                    'dropped' : self.dropped, 'sent' : self.sent,
+                    'failed' : self.failed, 'pending' : len(self._pending)}
+
+    def Stop(self, flush=True):
+        """ Stop the updater, sending what is still pending if flush is set """
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        try:
+            if flush:
+                self.batch = None
+                self._Flush()
+        finally:
+            self._pipeline.Close()
+
+    def _Run(self):
+        deadline = time.monotonic()
+        while True:
+            with self._cond:
+                deadline += self.interval
+                delay = deadline - time.monotonic()
+                if delay < 0:
+                    # Fell behind, do not try to catch up with a burst
+                    deadline -= delay
+                    delay = 0
+                while self._running and delay > 0:
+                    self._cond.wait(delay)
+                    delay = deadline - time.monotonic()
+                if not self._running:
+                    return
+            try:
+                self._Flush()
+            except Exception:
+                log.exception('(Updater) Flush failed')
+
+    def _Flush(self):
+        with self._cond:
+            if len(self._pending) == 0:
+                return
+            order = sorted(self._pending.items(), key=lambda item: item[1][:2])
+            if self.batch is not None:
+                order = order[:self.batch]
+            for objid, _ in order:
+                del self._pending[objid]
+
+        sent = 0
+        for objid, (_, _, value) in order:
+            try:
+                if self._pipeline.ChangeNumericValue(objid, value) is not None:
+                    sent += 1
+            except IBSException as e:
+                log.debug('(Updater) 0x{0:04X}: {1}'.format(objid, e.args[0]))
+                with self._cond:
+                    self.failed += 1
+        errors = self._pipeline.Drain()
+        with self._cond:
+            self.sent += sent - len(errors)
+            self.failed += len(errors)
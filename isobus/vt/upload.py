@@ -0,0 +1,97 @@
+from isobus.common import IBSException
+from isobus.common import IBSMessageData
+from isobus.log import log
+
+
+class VTPoolUploadSession():
+    """ Uploads an object pool in one or more Object Pool Transfer messages and
+    remembers which ones the VT acknowledged, so Run can be called again after
+    a failure and only sends what is missing.
+    An Object Pool Transfer may not split an object, so the pool is only split
+    at boundaries (offsets of object starts, e.g. from an IOP parser), into
+    segments of about segmentSize bytes. Without boundaries the pool is a
+    single segment
+    """
+
+    def __init__(self, client, data, boundaries=None, segmentSize=64 * 1024):
+        self.client = client
+        self.data = data if isinstance(data, IBSMessageData) else IBSMessageData(data)
+        self.segments = self._Split(len(self.data), boundaries, segmentSize)
+        self.done = [False] * len(self.segments)
+        self.acknowledged = [0] * len(self.segments) # bytes, per segment
+        self.memoryChecked = False
+        self.finished = False
+
+    def Progress(self):
+        """ Returns (acknowledged bytes, total bytes) """
+        return sum(self.acknowledged), len(self.data)
+
+    def Run(self, eoop=True):
+        """ Send all segments which have not been acknowledged yet, then the
+        End of Object Pool if eoop. Raises IBSException on failure, calling Run
+        again resumes from the first unacknowledged segment
+        """
+        self.client._CheckAlive()
+        connection = self.client.connection
+
+        if not self.memoryChecked:
+            future = connection.SendGetMemory(len(self.data), self.client.da, self.client.sa)
+            [receivedMemResp, version, enoughMemory] = connection.WaitForGetMemoryResponse(
+                    self.client.da, self.client.sa, future)
+            if not receivedMemResp:
+                raise IBSException('No Get Memory Response received')
+            elif not enoughMemory:
+                raise IBSException('Not enough memory available')
+            self.memoryChecked = True
+
+        for index, (start, end) in enumerate(self.segments):
+            if self.done[index]:
+                continue
+
+            log.debug('(Upload) Segment {0}/{1}, bytes {2} - {3}'.format(
+                index + 1, len(self.segments), start, end - 1))
+            progress = lambda packets, index=index: self._Acknowledged(index, packets)
+            if not connection.SendPoolUpload(self.client.da, self.client.sa,
+                                             self.data.Slice(start, end), progress):
+                done, total = self.Progress()
+                raise IBSException('Object pool transfer failed at {0} of {1} bytes'.format(
+                    done, total))
+            self.done[index] = True
+            self.acknowledged[index] = end - start
+
+        if eoop and not self.finished:
+            future = connection.SendEndOfObjectPool(self.client.da, self.client.sa)
+            [received, error] = connection.WaitEndOfObjectPoolResponse(
+                    self.client.da, self.client.sa, future)
+            if received and error == 0:
+                self.finished = True
+            elif received:
+                raise IBSException("Received error code {0}".format(error))
+            else:
+                raise IBSException("EoOP Response timed out")
+
+        # The uploaded objects replace the ones the shadow cache remembers
+        self.client._InvalidateShadow()
+
+    def _Acknowledged(self, index, packets):
+        # The first byte of every transfer is the function code
+        start, end = self.segments[index]
+        self.acknowledged[index] = max(0, min(end - start, packets * 7 - 1))
+
+    @staticmethod
+    def _Split(size, boundaries, segmentSize):
+        if not boundaries:
+            return [(0, size)]
+
+        segments = list()
+        start = 0
+        last = 0
+        for boundary in sorted(boundaries) + [size]:
+            if boundary <= start or boundary > size:
+                continue
+            if boundary - start > segmentSize and last > start:
+                segments.append((start, last))
+                start = last
+            last = boundary
+        segments.append((start, size))
+        return segments
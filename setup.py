@@ -46,11 +46,13 @@ setup(
 
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
 
-    install_requires=['python-can'],
+    install_requires=['python-can>=2.1,<4.0'],
 
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'numpy': ['numpy'],
+        'arrow': ['pyarrow'],
     },
 
     # If there are data files included in your packages that need to be
@@ -69,6 +71,8 @@ setup(
     entry_points={
         'console_scripts': [
             'vtclient=isobus.bin.vtclient:main',
+            'ibsdecode=isobus.bin.ibsdecode:main',
+            'vtserver=isobus.bin.vtserver:main',
         ],
     },
 )
@@ -0,0 +1,186 @@
+import heapq
+import itertools
+import threading
+import unittest
+
+from isobus.addressclaim import CLAIM_CLAIMED
+from isobus.addressclaim import CLAIM_FAILED
+from isobus.addressclaim import IBSAddressClaimer
+from isobus.addressclaim import IBSNameTable
+from isobus.cf import BuildISOBUSName
+from isobus.common import IBSException
+from isobus.common import IBSID
+from isobus.common import IBSRxHandler
+from isobus.common import NumericValue
+from isobus.constants import *
+from isobus.ibsinterface import IBSInterface
+from isobus.scheduler import IBSScheduledCall
+
+
+class _Network():
+    """ A bus and a scheduler on a simulated clock, every message is
+    delivered to every interface, including the sender
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.interfaces = list()
+        self.sent = list()
+        self._queue = list()
+        self._counter = itertools.count()
+
+    def CallLater(self, delay, callback, *args):
+        call = IBSScheduledCall(self.now + delay, callback, args)
+        heapq.heappush(self._queue, (call.when, next(self._counter), call))
+        return call
+
+    def Send(self, ibsid, data):
+        self.sent.append((ibsid.pgn, ibsid.sa, list(data)))
+        self.CallLater(0, self._Deliver, ibsid, list(data))
+
+    def _Deliver(self, ibsid, data):
+        for interface in self.interfaces:
+            for handler in list(interface.handlers):
+                handler.RxMessage(ibsid, data)
+
+    def Run(self, seconds):
+        end = self.now + seconds
+        while self._queue and self._queue[0][0] <= end:
+            when, _, call = heapq.heappop(self._queue)
+            self.now = when
+            if not call.cancelled:
+                call.callback(*call.args)
+        self.now = end
+
+
+class _Interface():
+
+    def __init__(self, network):
+        self.network = network
+        self.scheduler = network
+        self.localAddresses = set()
+        self.names = IBSNameTable()
+        self.handlers = [self.names]
+        network.interfaces.append(self)
+
+    def AddRxHandler(self, handler):
+        self.handlers.append(handler)
+
+    def RemoveRxHandler(self, handler):
+        self.handlers.remove(handler)
+
+    def SendRequestAddressClaim(self, sa):
+        self.network.Send(IBSID(SA_GLOBAL, sa, PGN_REQUEST),
+                          [PGN_ADDRCLAIM & 0xFF, (PGN_ADDRCLAIM >> 8) & 0xFF, PGN_ADDRCLAIM >> 16])
+
+    def SendAddressClaim(self, ibsName, sa):
+        self.network.Send(IBSID(SA_GLOBAL, sa, PGN_ADDRCLAIM), NumericValue(ibsName).AsLEBytes(8))
+        self.names.Claimed(sa, ibsName)
+        if sa != SA_NULL:
+            self.localAddresses.add(sa)
+
+    def _DropLocalAddress(self, sa):
+        self.localAddresses.discard(sa)
+
+
+class AddressClaimTest(unittest.TestCase):
+
+    def setUp(self):
+        self.network = _Network()
+
+    def _Claimer(self, ibsName):
+        return IBSAddressClaimer(_Interface(self.network), ibsName)
+
+    def test_uncontested(self):
+        claimer = self._Claimer(BuildISOBUSName(idNumber = 1))
+        future = claimer.Start(0x90)
+        self.network.Run(1.0)
+        self.assertEqual(future.result(0), 0x90)
+        self.assertEqual(claimer.state, CLAIM_CLAIMED)
+
+    def test_configurable_loser_moves(self):
+        loser = self._Claimer(BuildISOBUSName(configurable = 1, idNumber = 5))
+        lost = loser.Start(0x90)
+        self.network.Run(1.0)
+        self.assertEqual(lost.result(0), 0x90)
+
+        # A lower NAME takes the address, the loser picks a dynamic one
+        winner = self._Claimer(BuildISOBUSName(idNumber = 1))
+        won = winner.Start(0x90)
+        self.network.Run(1.0)
+        self.assertEqual(won.result(0), 0x90)
+        self.assertEqual(loser.state, CLAIM_CLAIMED)
+        self.assertEqual(loser.address, 0x80)
+        self.assertNotIn(0x90, loser.interface.localAddresses)
+        self.assertEqual(winner.interface.names.Address(loser.ibsName), 0x80)
+
+    def test_simultaneous_claims(self):
+        loser = self._Claimer(BuildISOBUSName(configurable = 1, idNumber = 5))
+        winner = self._Claimer(BuildISOBUSName(idNumber = 1))
+        lost = loser.Start(0x90)
+        won = winner.Start(0x90)
+        self.network.Run(2.0)
+        self.assertEqual(won.result(0), 0x90)
+        self.assertEqual(lost.result(0), 0x80)
+        self.assertEqual(loser.interface.names.Items(), winner.interface.names.Items())
+
+    def test_not_configurable_cannot_claim(self):
+        winner = self._Claimer(BuildISOBUSName(idNumber = 1))
+        winner.Start(0x90)
+        self.network.Run(1.0)
+
+        loser = self._Claimer(BuildISOBUSName(idNumber = 9))
+        future = loser.Start(0x90)
+        self.network.Run(1.0)
+        self.assertRaises(IBSException, future.result, 0)
+        self.assertEqual(loser.state, CLAIM_FAILED)
+        self.assertEqual(loser.address, SA_NULL)
+        # The winner keeps its address, the loser's cannot claim is on the bus
+        self.assertEqual(winner.state, CLAIM_CLAIMED)
+        self.assertEqual(winner.interface.names.Name(0x90), winner.ibsName)
+        cannotClaim = (PGN_ADDRCLAIM, SA_NULL, list(NumericValue(loser.ibsName).AsLEBytes(8)))
+        self.assertIn(cannotClaim, self.network.sent)
+
+
+class _Received(IBSRxHandler):
+
+    def __init__(self, pgn):
+        IBSRxHandler.__init__(self, [pgn])
+        self.messages = list()
+        self.event = threading.Event()
+
+    def RxMessage(self, ibsid, data):
+        self.messages.append((ibsid.sa, ibsid.da, bytes(data)))
+        self.event.set()
+
+
+class ClaimedAddressTest(unittest.TestCase):
+    """ Two interfaces on a virtual bus, with CAN filters """
+
+    def setUp(self):
+        self.local = IBSInterface('virtual', 'test_claimed_address')
+        self.remote = IBSInterface('virtual', 'test_claimed_address')
+
+    def tearDown(self):
+        self.local.Shutdown()
+        self.remote.Shutdown()
+
+    def test_tp_to_claimed_address(self):
+        received = _Received(PGN_ECU2VT)
+        self.local.AddRxHandler(received)
+        self.local.SendAddressClaim(BuildISOBUSName(idNumber = 1), 0x80)
+
+        data = bytes(range(20))
+        self.assertTrue(self.remote._SendIBSMessage(PGN_ECU2VT, 0x80, 0x26, data))
+        self.assertTrue(received.event.wait(1.0))
+        self.assertEqual(received.messages, [(0x26, 0x80, data)])
+
+    def test_dropped_address_filtered(self):
+        self.local.SendAddressClaim(BuildISOBUSName(idNumber = 1), 0x80)
+        self.assertTrue(self.local._Accepted(PGN_TP_CM, 0x26, 0x80))
+        self.local._DropLocalAddress(0x80)
+        self.assertFalse(self.local._Accepted(PGN_TP_CM, 0x26, 0x80))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from isobus.busmanager import busManager
+from isobus.cf import IBSControlFunction
+from isobus.ibsinterface import IBSInterface
+from isobus.vt.client import VTClient
+from isobus.vt.interface import IBSVTInterface
+
+
+class BusManagerTest(unittest.TestCase):
+
+    def test_shared(self):
+        cf = IBSControlFunction('virtual', 'test_busmanager', shared=True)
+        client = VTClient('virtual', 'test_busmanager', shared=True)
+        self.assertIs(cf.connection, client.connection)
+        self.assertEqual(busManager.Users('virtual', 'test_busmanager'), 2)
+        connection = cf.connection
+        cf.Close()
+        self.assertIsNotNone(connection.notifier)
+        client.Close()
+        self.assertEqual(busManager.Users('virtual', 'test_busmanager'), 0)
+        self.assertIsNone(connection.notifier)
+
+    def test_own(self):
+        cf = IBSControlFunction('virtual', 'test_busmanager_own')
+        client = VTClient('virtual', 'test_busmanager_own')
+        self.assertIs(type(cf.connection), IBSInterface)
+        self.assertIsInstance(client.connection, IBSVTInterface)
+        self.assertEqual(busManager.Users('virtual', 'test_busmanager_own'), 0)
+        for control in (cf, client):
+            connection = control.connection
+            control.Close()
+            self.assertIsNone(connection.notifier)
+            self.assertIsNone(control.connection)
+
+
+if __name__ == '__main__':
+    unittest.main()
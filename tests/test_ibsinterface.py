@@ -0,0 +1,28 @@
+import unittest
+from concurrent.futures import Future
+
+from isobus.constants import *
+from isobus.ibsinterface import IBSInterface
+
+
+class SendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.interface = IBSInterface('virtual', 'test_send')
+
+    def tearDown(self):
+        self.interface.Shutdown()
+
+    def test_single_frame(self):
+        self.assertTrue(self.interface._SendIBSMessage(PGN_ECU2VT, 0x26, 0x80, [0x92] + [0xFF] * 7))
+
+    def test_broadcast(self):
+        self.assertIsInstance(self.interface._SendIBSMessage(0xFE00, SA_GLOBAL, 0x80, bytes(20)),
+                              Future)
+
+    def test_broadcast_too_large(self):
+        self.assertIs(self.interface._SendIBSMessage(0xFE00, SA_GLOBAL, 0x80, bytes(1786)), False)
+
+
+if __name__ == '__main__':
+    unittest.main()
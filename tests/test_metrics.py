@@ -0,0 +1,90 @@
+import unittest
+
+from isobus.common import IBSID
+from isobus.constants import *
+from isobus.ibsinterface import IBSInterface
+from isobus.metrics import IBSMetrics
+from isobus.metrics import RX
+from isobus.metrics import TX
+
+
+class PrometheusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = IBSMetrics()
+
+    def _Lines(self):
+        text = self.metrics.Prometheus()
+        self.assertTrue(text.endswith('\n'))
+        return text.splitlines()
+
+    def test_frames(self):
+        self.metrics.Frame(TX, IBSID(0x26, 0x80, PGN_ECU2VT), 8)
+        self.metrics.Frame(TX, IBSID(0x26, 0x80, PGN_ECU2VT), 8)
+        self.metrics.Frame(RX, IBSID(0x80, 0x26, PGN_VT2ECU), 5)
+        lines = self._Lines()
+        self.assertIn('# TYPE isobus_frames_total counter', lines)
+        self.assertIn('isobus_frames_total{direction="tx",pgn="E700",sa="80"} 2', lines)
+        self.assertIn('isobus_frames_total{direction="rx",pgn="E600",sa="26"} 1', lines)
+        self.assertIn('isobus_bytes_total{direction="tx",pgn="E700",sa="80"} 16', lines)
+
+    def test_response_histogram(self):
+        self.metrics.Response(PGN_VT2ECU, 0xA8, 0.004)
+        self.metrics.Response(PGN_VT2ECU, 0xA8, 0.2)
+        self.metrics.Timeout(PGN_VT2ECU, 0xA8)
+        lines = self._Lines()
+        labels = 'function="ChangeNumericValue",pgn="E600"'
+        self.assertIn('# TYPE isobus_response_seconds histogram', lines)
+        # Buckets are cumulative and end with +Inf
+        self.assertIn('isobus_response_seconds_bucket{function="ChangeNumericValue",'
+                      'le="0.0025",pgn="E600"} 0', lines)
+        self.assertIn('isobus_response_seconds_bucket{function="ChangeNumericValue",'
+                      'le="0.005",pgn="E600"} 1', lines)
+        self.assertIn('isobus_response_seconds_bucket{function="ChangeNumericValue",'
+                      'le="0.25",pgn="E600"} 2', lines)
+        self.assertIn('isobus_response_seconds_bucket{function="ChangeNumericValue",'
+                      'le="+Inf",pgn="E600"} 2', lines)
+        self.assertIn('isobus_response_seconds_count{' + labels + '} 2', lines)
+        self.assertIn('isobus_response_timeouts_total{' + labels + '} 1', lines)
+
+    def test_sessions(self):
+        self.metrics.Session('tp', TX, 0.3, True, retransmits=3)
+        self.metrics.Session('etp', RX, 2.0, False)
+        lines = self._Lines()
+        self.assertIn('isobus_session_seconds_count{direction="tx",protocol="tp",result="ok"} 1',
+                      lines)
+        self.assertIn('isobus_session_seconds_count{direction="rx",protocol="etp",'
+                      'result="failed"} 1', lines)
+        self.assertIn('isobus_retransmitted_packets_total{direction="tx",protocol="tp"} 3', lines)
+
+    def test_prefix(self):
+        lines = self.metrics.Prometheus(prefix='tractor').splitlines()
+        self.assertIn('# TYPE tractor_bus_load_ratio gauge', lines)
+        self.assertTrue(all(line.startswith(('# HELP tractor_', '# TYPE tractor_', 'tractor_'))
+                            for line in lines))
+
+
+class InterfaceMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.interface = IBSInterface('virtual', 'test_metrics')
+        self.interface.EnableMetrics()
+
+    def tearDown(self):
+        self.interface.Shutdown()
+
+    def test_transport_waits_not_recorded(self):
+        # A TP sender waiting for CTS, which never comes
+        key = (PGN_TP_CM, 0x26, 0x80, None)
+        future = self.interface._AddWaiter(key, None)
+        self.interface._RemoveWaiter(key, future)
+        self.assertEqual(self.interface.metrics.timeouts, {})
+
+        key = (PGN_VT2ECU, 0x26, 0x80, 0xA8)
+        future = self.interface._AddWaiter(key, None)
+        self.interface._RemoveWaiter(key, future)
+        self.assertEqual(self.interface.metrics.timeouts, {(PGN_VT2ECU, 0xA8): 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import struct
+import unittest
+
+from isobus.common import IBSException
+from isobus.vt.pool import DiffPools
+from isobus.vt.pool import VTObjectPool
+
+
+def _Object(objid, objtype, body):
+    return struct.pack('<HB', objid, objtype) + body
+
+def _WorkingSet(objid, mask, children):
+    return _Object(objid, 0, struct.pack('<BBHBBB', 1, 1, mask, len(children), 0, 1)
+                   + b''.join(struct.pack('<Hhh', child, 0, 0) for child in children) + b'en')
+
+def _DataMask(objid, children):
+    return _Object(objid, 1, struct.pack('<BHBB', 0, 0xFFFF, len(children), 0)
+                   + b''.join(struct.pack('<Hhh', child, 5, 5) for child in children))
+
+def _OutputNumber(objid, value):
+    return _Object(objid, 12, struct.pack('<HHBHBHIifBBBB', 50, 20, 0, 0xFFFF, 0, 0xFFFF,
+                                          value, 0, 1.0, 0, 0, 0, 0))
+
+def _OutputString(objid, value):
+    return _Object(objid, 11, struct.pack('<HHBHBHBH', 50, 20, 0, 0xFFFF, 0, 0xFFFF, 0,
+                                          len(value)) + value + b'\x00')
+
+def _NumberVariable(objid, value):
+    return _Object(objid, 21, struct.pack('<I', value))
+
+
+class PoolParserTest(unittest.TestCase):
+
+    def test_index(self):
+        objects = [_WorkingSet(0, 1000, [1000]), _DataMask(1000, [1001]),
+                   _OutputNumber(1001, 42), _NumberVariable(2000, 5)]
+        pool = VTObjectPool(b''.join(objects))
+        self.assertEqual(len(pool), 4)
+        self.assertEqual(pool.Boundaries(), [0, len(objects[0]),
+                                             len(objects[0]) + len(objects[1]),
+                                             len(b''.join(objects[:3]))])
+        self.assertEqual(pool.ObjectType(1001), 12)
+        self.assertEqual(pool[1001].typeName, 'OutputNumber')
+        self.assertEqual(bytes(pool[2000].Raw()), _NumberVariable(2000, 5))
+        self.assertNotIn(3000, pool)
+        self.assertRaises(IBSException, pool.Object, 3000)
+
+    def test_attributes(self):
+        macro = _Object(4000, 28, struct.pack('<H', 3) + b'\xA8\x01\x02')
+        softKeys = _Object(4001, 4, struct.pack('<BBB', 3, 2, 0) + struct.pack('<HH', 5000, 5001))
+        polygon = _Object(4002, 16, struct.pack('<HHHHBBB', 10, 20, 0xFFFF, 0xFFFF, 0, 2, 0)
+                          + struct.pack('<HHHH', 1, 2, 3, 4))
+        codePlanes = _Object(4003, 38, bytes([1, 1, 0, 2]) + struct.pack('<HHHH', 0x20, 0x7E,
+                                                                          0xA0, 0xFF))
+        pool = VTObjectPool(_WorkingSet(0, 1000, [1000]) + macro + softKeys + polygon
+                            + codePlanes)
+
+        self.assertEqual(pool[0].attributes['activeMask'], 1000)
+        self.assertEqual(pool[0].attributes['objects'], [(1000, 0, 0)])
+        self.assertEqual(pool[0].attributes['languages'], [b'en'])
+        self.assertEqual(pool[4000].attributes['commands'], b'\xA8\x01\x02')
+        self.assertEqual(pool[4001].attributes['objects'], [5000, 5001])
+        self.assertEqual(pool[4002].attributes['points'], [(1, 2), (3, 4)])
+        self.assertEqual(pool[4003].attributes['codePlanes'], [(0, [(0x20, 0x7E), (0xA0, 0xFF)])])
+
+    def test_later_definition_replaces(self):
+        pool = VTObjectPool(_NumberVariable(2000, 5) + _NumberVariable(2000, 6))
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool[2000].attributes['value'], 6)
+
+    def test_truncated(self):
+        data = _WorkingSet(0, 1000, [1000]) + _OutputString(1002, b'hello')
+        self.assertRaises(IBSException, VTObjectPool, data[:-3])
+        # Too short for the ID and type
+        self.assertRaises(IBSException, VTObjectPool, data + b'\x01\x00')
+        # The string length runs past the end
+        self.assertRaises(IBSException, VTObjectPool,
+                          _Object(1002, 11, struct.pack('<HHBHBHBH', 50, 20, 0, 0xFFFF, 0,
+                                                        0xFFFF, 0, 100) + b'hello\x00'))
+
+    def test_unsupported_type(self):
+        self.assertRaises(IBSException, VTObjectPool, _Object(5, 99, b'\x00' * 8))
+
+
+class DiffPoolsTest(unittest.TestCase):
+
+    def _Pool(self, number=7, string=b'hello', variable=True):
+        data = (_WorkingSet(0, 1000, [1000])
+                + _DataMask(1000, [1001, 1002])
+                + _OutputNumber(1001, number)
+                + _OutputString(1002, string))
+        if variable:
+            data += _NumberVariable(2000, 5)
+        return VTObjectPool(data)
+
+    def test_same(self):
+        changed, removed = DiffPools(self._Pool(), self._Pool())
+        self.assertEqual(len(changed), 0)
+        self.assertEqual(removed, [])
+
+    def test_changed_objects(self):
+        old = self._Pool()
+        new = self._Pool(number=8, string=b'hello world')
+        changed, removed = DiffPools(old, new)
+        self.assertEqual(list(VTObjectPool(changed)), [1001, 1002])
+        self.assertEqual(VTObjectPool(changed)[1001].attributes['value'], 8)
+        self.assertEqual(bytes(changed), bytes(new[1001].Raw()) + bytes(new[1002].Raw()))
+        self.assertEqual(removed, [])
+
+    def test_added_and_removed(self):
+        without = self._Pool(variable=False)
+        withVariable = self._Pool()
+        changed, removed = DiffPools(without, withVariable)
+        self.assertEqual(list(VTObjectPool(changed)), [2000])
+        self.assertEqual(removed, [])
+
+        changed, removed = DiffPools(withVariable, without)
+        self.assertEqual(len(changed), 0)
+        self.assertEqual(removed, [2000])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from isobus.common import IBSID
+from isobus.constants import *
+from isobus.vt.client import VTClient
+from isobus.vt.shadow import SHADOW_VALUE
+
+
+class ShadowCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = VTClient('virtual', 'test_shadow')
+        self.client.SetSrc(0x80)
+        self.client.EnableShadowCache()
+        # As ConnectToVT does once the VT answered
+        self.client.da = 0x26
+        self.client._RegisterShadow()
+        self.client._Acknowledge((0x1000, SHADOW_VALUE), 5)
+
+    def tearDown(self):
+        self.client.Close()
+
+    def _VTChangeNumericValue(self, vtsa, ecusa):
+        self.client.connection._DispatchIBSMessage(
+                IBSID(ecusa, vtsa, PGN_VT2ECU), [0x05, 0x00, 0x20, 0xFF, 7, 0, 0, 0])
+
+    def test_own_session(self):
+        self.assertTrue(self.client._Suppress((0x1000, SHADOW_VALUE), 5))
+        self._VTChangeNumericValue(0x26, 0x80)
+        self.assertFalse(self.client._Suppress((0x1000, SHADOW_VALUE), 5))
+
+    def test_other_sessions_ignored(self):
+        self._VTChangeNumericValue(0x27, 0x80) # another VT
+        self._VTChangeNumericValue(0x26, 0x81) # another working set
+        self.assertTrue(self.client._Suppress((0x1000, SHADOW_VALUE), 5))
+
+    def test_address_change(self):
+        self.client._AddressChanged(0x90)
+        self._VTChangeNumericValue(0x26, 0x80)
+        self.assertTrue(self.client._Suppress((0x1000, SHADOW_VALUE), 5))
+        self._VTChangeNumericValue(0x26, 0x90)
+        self.assertFalse(self.client._Suppress((0x1000, SHADOW_VALUE), 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import unittest
+
+from isobus.common import IBSID
+from isobus.common import IBSMessageData
+from isobus.constants import *
+from isobus.scheduler import IBSScheduledCall
+from isobus.tp import IBSTPReceiver
+from isobus.tp import IBSTxSession
+
+
+class _Scheduler():
+    """ Keeps the scheduled calls, the test runs them """
+
+    def __init__(self):
+        self.calls = list()
+
+    def CallLater(self, delay, callback, *args):
+        call = IBSScheduledCall(delay, callback, args)
+        self.calls.append(call)
+        return call
+
+    def RunAll(self):
+        calls, self.calls = self.calls, list()
+        for call in calls:
+            if not call.cancelled:
+                call.callback(*call.args)
+
+
+class _Interface():
+    """ Records what the receiver sends and delivers, instead of a bus """
+
+    def __init__(self, localAddresses):
+        self.localAddresses = set(localAddresses)
+        self.metrics = None
+        self.scheduler = _Scheduler()
+        self.sent = list()
+        self.delivered = list()
+
+    def _SendIBSMessage(self, pgn, da, sa, data):
+        self.sent.append((pgn, da, sa, list(data)))
+
+    def _DispatchIBSMessage(self, ibsid, data):
+        self.delivered.append((ibsid, bytes(data)))
+
+
+class TPReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.interface = _Interface([0x26])
+        self.receiver = IBSTPReceiver(self.interface)
+        self.payload = bytes(range(256)) + bytes(range(24)) # 280 bytes, 40 packets
+
+    def _RTS(self):
+        size = len(self.payload)
+        self.receiver.RxMessage(IBSID(0x26, 0x80, PGN_TP_CM),
+                                [TP_RTS, size & 0xFF, size >> 8, 40, 0xFF, 0x00, 0xE7, 0x00])
+
+    def _DT(self, packet):
+        chunk = self.payload[(packet - 1) * 7:packet * 7]
+        self.receiver.RxMessage(IBSID(0x26, 0x80, PGN_TP_DT),
+                                bytes([packet]) + chunk + b'\xFF' * (7 - len(chunk)))
+
+    def _CTS(self):
+        return [(data[1], data[2]) for pgn, da, sa, data in self.interface.sent
+                if data[0] == TP_CTS]
+
+    def test_in_order(self):
+        self._RTS()
+        for packet in range(1, 41):
+            self._DT(packet)
+        self.assertEqual(self._CTS(), [(16, 1), (16, 17), (8, 33)])
+        self.assertEqual(self.interface.sent[-1][3][0], TP_EOMA)
+        ibsid, data = self.interface.delivered[0]
+        self.assertEqual((ibsid.pgn, ibsid.sa, ibsid.da), (PGN_ECU2VT, 0x80, 0x26))
+        self.assertEqual(data, self.payload)
+
+    def test_lost_packet_asked_once(self):
+        self._RTS()
+        for packet in range(1, 17):
+            if packet != 3:
+                self._DT(packet)
+        # One CTS for the lost packet, not one per packet after it
+        self.assertEqual(self._CTS(), [(16, 1), (14, 3)])
+        for packet in range(3, 41):
+            self._DT(packet)
+        self.assertEqual(self._CTS(), [(16, 1), (14, 3), (16, 17), (8, 33)])
+        self.assertEqual(self.interface.delivered[0][1], self.payload)
+
+    def test_not_for_us(self):
+        self.receiver.RxMessage(IBSID(0x27, 0x80, PGN_TP_CM),
+                                [TP_RTS, 20, 0, 3, 0xFF, 0x00, 0xE7, 0x00])
+        self.assertEqual(self.interface.sent, [])
+        self.assertEqual(self.receiver.ActiveSessions(), 0)
+
+    def test_sweep_on_scheduler(self):
+        self._RTS()
+        self.assertEqual([call.when for call in self.interface.scheduler.calls], [TP_T1 / 3.0])
+        self._DT(1)
+        # One sweep at a time
+        self.assertEqual(len(self.interface.scheduler.calls), 1)
+
+        now = self.receiver._Now()
+        self.receiver._Now = lambda: now + TP_T1 + 0.1
+        self.interface.scheduler.RunAll()
+        self.assertEqual(self.receiver.ActiveSessions(), 0)
+        self.assertEqual(self.interface.sent[-1][3][:2], [TP_ABORT, ABORT_TIMEOUT])
+        self.assertEqual(self.interface.scheduler.calls, [])
+
+    def test_passive_session_expires(self):
+        receiver = IBSTPReceiver(None, passive=True)
+        receiver._Now = lambda: 10.0
+        receiver.RxMessage(IBSID(0x26, 0x80, PGN_TP_CM),
+                           [TP_RTS, 20, 0, 3, 0xFF, 0x00, 0xE7, 0x00])
+        receiver.Expire(10.0 + TP_T2 / 2)
+        self.assertEqual(receiver.ActiveSessions(), 1)
+        receiver.Expire(10.0 + TP_T2 * 2)
+        self.assertEqual(receiver.ActiveSessions(), 0)
+
+
+class _TxInterface():
+    """ Answers the sender with the given CTS/EoMA messages in turn, and fails
+    every data frame after the first sendable ones
+    """
+
+    def __init__(self, replies, sendable):
+        self.replies = list(replies)
+        self.sendable = sendable
+        self.frames = list()
+        self.messages = list()
+        self.removed = 0
+
+    def _AddWaiter(self, key, match):
+        return object()
+
+    def _RemoveWaiter(self, key, future):
+        self.removed += 1
+
+    def _WaitForFuture(self, key, future, maxtime):
+        if not self.replies:
+            return False, None
+        return True, self.replies.pop(0)
+
+    def _SendCANMessage(self, canid, candata):
+        self.messages.append(list(candata))
+
+    def _SendCANFrame(self, canid, candata):
+        if len(self.frames) >= self.sendable:
+            return False
+        self.frames.append(bytes(candata))
+        return True
+
+
+class TPSenderTest(unittest.TestCase):
+
+    def _Session(self, interface):
+        return IBSTxSession(interface, PGN_ECU2VT, 0x26, 0x80,
+                            IBSMessageData(bytes(range(70))), False) # 10 packets
+
+    def test_complete(self):
+        interface = _TxInterface([[TP_CTS, 10, 1, 0xFF, 0xFF, 0x00, 0xE7, 0x00],
+                                  [TP_EOMA, 70, 0, 10, 0xFF, 0x00, 0xE7, 0x00]], 10)
+        self.assertTrue(self._Session(interface).Run())
+        self.assertEqual([frame[0] for frame in interface.frames], list(range(1, 11)))
+
+    def test_abort_on_failed_send(self):
+        interface = _TxInterface([[TP_CTS, 10, 1, 0xFF, 0xFF, 0x00, 0xE7, 0x00]], 4)
+        self.assertFalse(self._Session(interface).Run())
+        # Nothing is sent after the failed packet but the abort
+        self.assertEqual(len(interface.frames), 4)
+        self.assertEqual(interface.messages[-1][:2], [TP_ABORT, ABORT_RESOURCES])
+        self.assertEqual(interface.removed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()